@@ -1,10 +1,20 @@
 # Import necessary libraries
 import streamlit as st
 import pandas as pd
+import numpy as np
 import json
 import os
+import hashlib
+import functools
+import threading
+import queue
+import atexit
 from datetime import date, datetime
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from array import array
+from bisect import bisect_left, insort
+import heapq
+from concurrent.futures import ThreadPoolExecutor
 import uuid
 import time
 from datetime import timedelta
@@ -81,31 +91,42 @@ def load_data():
         # 1. Пытаемся загрузить из GitHub
         if GITHUB_TOKEN and GIST_ID:
             try:
-                resp = requests.get(f"https://api.github.com/gists/{GIST_ID}", headers=github_headers())
-                if resp.status_code == 200:
-                    gist_data = resp.json()
-                    if "center_data.json" in gist_data["files"]:
-                        content = gist_data["files"]["center_data.json"]["content"]
-                        if content.strip():
-                            remote_data = json.loads(content)
-                            if isinstance(remote_data, dict) and 'students' in remote_data:
-                                st.success(f"Данные загружены из GitHub (обновлено: {gist_data['updated_at']})")
-                                return remote_data
-                            else:
-                                st.warning("Данные из GitHub имеют неверную структуру")
-                else:
-                    st.warning(f"Ошибка загрузки из GitHub: {resp.status_code} {resp.text}")
+                # Иначе загрузка вернёт версию без ещё не отправленных изменений
+                if not flush_pending_sync():
+                    raise RuntimeError("есть неотправленные изменения")
+                remote_data, gist_meta, modified = fetch_gist_document()
+                if remote_data is not None:
+                    if isinstance(remote_data, dict) and 'students' in remote_data:
+                        # После старого единого файла первое сохранение выгрузит все разделы
+                        shared = get_shared_document()
+                        shared.legacy_layout = not gist_meta['sectioned']
+                        shared.fingerprints = {}
+                        shared.version = gist_meta['version']
+                        # Разделы сериализуются один раз: для отпечатков Gist и локальной копии
+                        contents = {key: serialize_section(value) for key, value in remote_data.items()}
+                        if not shared.legacy_layout:
+                            remember_saved_sections(remote_data, contents)
+                        write_local_sections(contents)
+                        source = "GitHub" if modified else "кэша (в GitHub без изменений)"
+                        st.success(f"Данные загружены из {source} (обновлено: {gist_meta['updated_at']})")
+                        return remote_data
+                    else:
+                        st.warning("Данные из GitHub имеют неверную структуру")
             except Exception as e:
                 st.warning(f"Ошибка загрузки из GitHub: {str(e)}")
 
                 
-        # 2. Fallback на локальный файл
-        if os.path.exists(DATA_FILE):
+        # 2. Fallback на локальные разделы (единый файл — пока разделов на диске ещё нет)
+        if os.path.isdir(DATA_SECTIONS_FOLDER) or os.path.exists(DATA_FILE):
             try:
-                with open(DATA_FILE, 'r', encoding='utf-8') as f:
-                    local_data = json.load(f)
-                    st.warning("Используются локальные данные")
-                    return local_data
+                local_data = load_local_sections()
+                if local_data is None:
+                    with open(DATA_FILE, 'r', encoding='utf-8') as f:
+                        local_data = json.load(f)
+                # Состояние Gist неизвестно — при сохранении выгружаем все разделы
+                get_shared_document().fingerprints = {}
+                st.warning("Используются локальные данные")
+                return local_data
             except Exception as e:
                 st.error(f"Ошибка чтения локального файла: {str(e)}")
                 
@@ -116,12 +137,363 @@ def load_data():
     st.warning("Используются начальные данные")
     return initial_data.copy()
 
-def github_headers():
-    """Возвращает заголовки для GitHub API"""
-    if not GITHUB_TOKEN:
-        st.warning("GitHub токен не настроен! Работаем локально.")
+# --- Клиент GitHub API ---
+# Все обращения к GitHub идут через один клиент: пул keep-alive соединений,
+# таймауты, повторы с экспоненциальной задержкой и учёт оставшегося лимита.
+GITHUB_API = "https://api.github.com"
+GITHUB_TIMEOUT = (5, 30)  # (соединение, чтение), секунды
+GITHUB_MAX_RETRIES = 3
+GITHUB_BACKOFF_SECONDS = 1
+GITHUB_MAX_WAIT_SECONDS = 60  # Дольше ждать сброса лимита внутри запроса нет смысла
+
+class GitHubClient:
+    """Пул соединений к api.github.com с повторами и метриками лимита"""
+
+    def __init__(self, token):
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({
+            "Authorization": f"token {token}",
+            "Accept": "application/vnd.github.v3+json"
+        })
+        self.lock = threading.Lock()
+        self.rate_limit = None
+        self.rate_remaining = None
+        self.rate_reset = None
+        self.requests_made = 0
+        self.not_modified = 0
+        self.retries = 0
+
+    def request(self, method, url, retry=True, **kwargs):
+        """
+        Выполняет запрос; url — путь API ('/gists/...') или полный адрес.
+        5xx и сетевые ошибки повторяются только для идемпотентных запросов,
+        исчерпанный лимит (403/429) — для любых: такой запрос не выполнялся.
+        """
+        if url.startswith('/'):
+            url = GITHUB_API + url
+        kwargs.setdefault('timeout', GITHUB_TIMEOUT)
+        idempotent = retry and method.upper() != 'POST'
+        for attempt in range(GITHUB_MAX_RETRIES + 1):
+            last_attempt = attempt == GITHUB_MAX_RETRIES
+            try:
+                resp = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if not idempotent or last_attempt:
+                    raise
+                self._wait(attempt)
+                continue
+
+            self._record(resp)
+            wait = self._rate_limit_wait(resp)
+            if wait is not None:
+                if not retry or last_attempt or wait > GITHUB_MAX_WAIT_SECONDS:
+                    return resp
+                self._wait(attempt, wait)
+            elif resp.status_code >= 500 and idempotent and not last_attempt:
+                self._wait(attempt)
+            else:
+                return resp
+        return resp
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request('PATCH', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def _record(self, resp):
+        with self.lock:
+            self.requests_made += 1
+            if resp.status_code == 304:
+                self.not_modified += 1
+            if 'X-RateLimit-Remaining' in resp.headers:
+                self.rate_remaining = int(resp.headers['X-RateLimit-Remaining'])
+                self.rate_limit = int(resp.headers.get('X-RateLimit-Limit', 0)) or self.rate_limit
+                self.rate_reset = int(resp.headers.get('X-RateLimit-Reset', 0)) or self.rate_reset
+
+    @staticmethod
+    def _rate_limit_wait(resp):
+        """Сколько ждать до повтора, если ответ — исчерпанный лимит, иначе None"""
+        if resp.status_code not in (403, 429):
+            return None
+        if resp.headers.get('Retry-After'):
+            return int(resp.headers['Retry-After'])
+        if resp.headers.get('X-RateLimit-Remaining') == '0':
+            return max(int(resp.headers.get('X-RateLimit-Reset', 0)) - time.time(), 0)
+        return None  # Обычный отказ в доступе
+
+    def _wait(self, attempt, seconds=None):
+        with self.lock:
+            self.retries += 1
+        time.sleep(seconds if seconds is not None else GITHUB_BACKOFF_SECONDS * 2 ** attempt)
+
+    def quota(self):
+        """Метрики лимита API для отображения"""
+        with self.lock:
+            return {
+                'limit': self.rate_limit,
+                'remaining': self.rate_remaining,
+                'reset': datetime.fromtimestamp(self.rate_reset) if self.rate_reset else None,
+                'requests': self.requests_made,
+                'not_modified': self.not_modified,
+                'retries': self.retries
+            }
+
+@st.cache_resource
+def get_github_client(token):
+    """Один клиент (и пул соединений) на процесс сервера"""
+    return GitHubClient(token)
+
+def github_client():
+    return get_github_client(GITHUB_TOKEN)
+
+# --- Секционное хранение в Gist ---
+# Каждый раздел верхнего уровня (students, payments, attendance, ...) хранится
+# в отдельном файле Gist, поэтому при сохранении отправляются только изменённые разделы.
+GIST_LEGACY_FILE = 'center_data.json'
+GIST_SECTION_PREFIX = 'center_data__'
+
+def json_serializer(obj):
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError(f"Type {type(obj)} not serializable")
+
+def section_file_name(section):
+    """Имя файла Gist для раздела данных"""
+    return f"{GIST_SECTION_PREFIX}{section}.json"
+
+def section_from_file_name(file_name):
+    """Раздел данных по имени файла Gist или None для посторонних файлов"""
+    if file_name.startswith(GIST_SECTION_PREFIX) and file_name.endswith('.json'):
+        return file_name[len(GIST_SECTION_PREFIX):-len('.json')] or None
+    return None
+
+def is_sectioned_gist(files):
+    """Проверяет, что Gist уже переведён на хранение по разделам"""
+    return any(section_from_file_name(name) for name in files)
+
+def read_gist_file(file_info):
+    """Возвращает содержимое файла Gist, догружая усечённые (>1 МБ) файлы по raw_url"""
+    if file_info.get('truncated') and file_info.get('raw_url'):
+        resp = github_client().get(file_info['raw_url'])
+        resp.raise_for_status()
+        return resp.text
+    return file_info.get('content', '')
+
+def assemble_gist_document(files):
+    """Собирает документ из файлов Gist: сначала по разделам, иначе из единого center_data.json"""
+    sections = {}
+    for name, file_info in files.items():
+        section = section_from_file_name(name)
+        if section:
+            content = read_gist_file(file_info)
+            sections[section] = json.loads(content) if content.strip() else None
+    if sections:
+        return sections
+
+    if GIST_LEGACY_FILE in files:
+        content = read_gist_file(files[GIST_LEGACY_FILE])
+        if content.strip():
+            return json.loads(content)
+    return None
+
+# --- Условные запросы к Gist ---
+# GitHub отдаёт ETag, а ответ 304 на запрос с If-None-Match не расходует лимит API.
+# Последний ETag и разобранный документ хранятся на диске рядом с DATA_FILE.
+GIST_CACHE_FILE = os.path.splitext(DATA_FILE)[0] + '.gist_cache.json'
+
+class GistCache:
+    """Последний полученный из Gist документ вместе с его ETag"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.gist_id = None
+        self.etag = None
+        self.meta = {}
+        self.document_text = None
+        # Для опроса последней версии достаточно памяти: ответ крошечный
+        self.commits_etag = None
+        self.commits_version = None
+        self._read()
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+            self.gist_id = cached['gist_id']
+            self.etag = cached['etag']
+            self.meta = cached['meta']
+            self.document_text = serialize_section(cached['document'])
+        except (OSError, ValueError, KeyError, TypeError):
+            self.etag = None  # Повреждённый кэш просто не используем
+
+    def validator(self, gist_id):
+        """ETag для If-None-Match или None, если кэш относится к другому Gist"""
+        with self.lock:
+            if self.gist_id == gist_id and self.etag and self.document_text is not None:
+                return self.etag
+            return None
+
+    def document(self):
+        """Свежая копия закэшированного документа и его метаданные"""
+        with self.lock:
+            return json.loads(self.document_text), dict(self.meta)
+
+    def store(self, gist_id, etag, meta, document):
+        with self.lock:
+            self.gist_id = gist_id
+            self.etag = etag
+            self.meta = meta
+            self.document_text = serialize_section(document)
+            try:
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump({'gist_id': gist_id, 'etag': etag, 'meta': meta, 'document': document},
+                              f, ensure_ascii=False, default=json_serializer)
+                os.replace(tmp_path, self.path)
+            except OSError:
+                pass  # Без дискового кэша следующий старт просто скачает Gist целиком
+
+@st.cache_resource
+def get_gist_cache():
+    return GistCache(GIST_CACHE_FILE)
+
+def fetch_gist_document():
+    """
+    Загружает документ из Gist условным запросом.
+    Возвращает (документ, метаданные, изменился ли Gist); при ответе 304
+    документ берётся из кэша без повторной загрузки и разбора файлов.
+    """
+    cache = get_gist_cache()
+    headers = {}
+    etag = cache.validator(GIST_ID)
+    if etag:
+        headers['If-None-Match'] = etag
+    resp = github_client().get(f"/gists/{GIST_ID}", headers=headers)
+    if resp.status_code == 304:
+        document, meta = cache.document()
+        return document, meta, False
+    if resp.status_code != 200:
+        raise RuntimeError(f"{resp.status_code} {resp.text}")
+
+    gist = resp.json()
+    files = gist["files"]
+    document = assemble_gist_document(files)
+    meta = {
+        'updated_at': gist.get('updated_at'),
+        'version': (gist.get('history') or [{}])[0].get('version'),
+        'sectioned': is_sectioned_gist(files),
+        'files': {
+            name: info.get('size', 0) for name, info in files.items()
+            if section_from_file_name(name) or name == GIST_LEGACY_FILE
+        }
+    }
+    if isinstance(document, dict) and 'students' in document and resp.headers.get('ETag'):
+        cache.store(GIST_ID, resp.headers['ETag'], meta, document)
+    return document, meta, True
+
+def serialize_section(value):
+    """Компактная сериализация раздела для отправки в Gist"""
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'), default=json_serializer)
+
+def section_fingerprint(content):
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+def remember_saved_sections(data, contents=None):
+    """Запоминает отпечатки разделов, совпадающих с содержимым Gist"""
+    contents = contents or {key: serialize_section(value) for key, value in data.items()}
+    fingerprints = get_shared_document().fingerprints
+    for section, content in contents.items():
+        fingerprints[section] = section_fingerprint(content)
+
+def collect_dirty_sections(data, sections=None, contents=None):
+    """
+    Возвращает изменённые разделы {раздел: содержимое} и список удалённых разделов.
+    Если sections передан, проверяются только эти разделы и разделы, которых ещё нет в Gist.
+    contents — уже сериализованные разделы, чтобы не сериализовать их повторно.
+    """
+    fingerprints = get_shared_document().fingerprints
+    if sections is None:
+        candidates = list(data.keys())
+    else:
+        candidates = [s for s in data if s in sections or s not in fingerprints]
+
+    dirty = {}
+    for section in candidates:
+        content = contents[section] if contents and section in contents else serialize_section(data[section])
+        if fingerprints.get(section) != section_fingerprint(content):
+            dirty[section] = content
+
+    removed = [] if sections is not None else [s for s in fingerprints if s not in data]
+    return dirty, removed
+
+# --- Локальное хранение по разделам ---
+# Локальная копия лежит в папке DATA_SECTIONS_FOLDER по файлу на раздел (имена как в Gist),
+# и сохранение переписывает только файлы изменённых разделов. Единый DATA_FILE читается,
+# лишь пока папки разделов ещё нет; первое сохранение запишет в неё все разделы.
+DATA_SECTIONS_FOLDER = os.path.splitext(DATA_FILE)[0] + '_sections'
+
+def local_section_path(section):
+    return os.path.join(DATA_SECTIONS_FOLDER, section_file_name(section))
+
+def load_local_sections():
+    """Документ из папки разделов или None, если локальных разделов ещё нет"""
+    if not os.path.isdir(DATA_SECTIONS_FOLDER):
         return None
-    return {"Authorization": f"token {GITHUB_TOKEN}"}
+    document = {}
+    for name in os.listdir(DATA_SECTIONS_FOLDER):
+        section = section_from_file_name(name)
+        if section:
+            with open(os.path.join(DATA_SECTIONS_FOLDER, name), 'r', encoding='utf-8') as f:
+                document[section] = json.load(f)
+    return document or None
+
+def local_section_fingerprints():
+    """Отпечатки файлов разделов на диске: читаются один раз на процесс, дальше их ведёт запись"""
+    shared = get_shared_document()
+    if shared.local_fingerprints is None:
+        fingerprints = {}
+        if os.path.isdir(DATA_SECTIONS_FOLDER):
+            for name in os.listdir(DATA_SECTIONS_FOLDER):
+                section = section_from_file_name(name)
+                if section:
+                    with open(os.path.join(DATA_SECTIONS_FOLDER, name), 'r', encoding='utf-8') as f:
+                        fingerprints[section] = section_fingerprint(f.read())
+        shared.local_fingerprints = fingerprints
+    return shared.local_fingerprints
+
+def write_local_sections(contents, removed=()):
+    """Переписывает файлы разделов, содержимое которых отличается от диска; возвращает их список"""
+    fingerprints = local_section_fingerprints()
+    written = []
+    for section, content in contents.items():
+        fingerprint = section_fingerprint(content)
+        if fingerprints.get(section) == fingerprint:
+            continue
+        os.makedirs(DATA_SECTIONS_FOLDER, exist_ok=True)
+        path = local_section_path(section)
+        # Через временный файл, чтобы сбой посреди записи не оставил раздел обрезанным
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(path + '.tmp', path)
+        fingerprints[section] = fingerprint
+        written.append(section)
+    for section in removed:
+        if os.path.exists(local_section_path(section)):
+            os.remove(local_section_path(section))
+        fingerprints.pop(section, None)
+    return written
 
 # Функция для безопасного преобразования времени
 def safe_time_parse(time_str):
@@ -138,118 +510,1507 @@ def safe_time_parse(time_str):
         return datetime.min.time()
 
 def archive_data():
-    """Переносит старые данные в отдельный архивный Gist"""
+    """Переносит закрытые месяцы оплат и посещаемости в помесячный архив, не дожидаясь смены месяца"""
     try:
-        old_data = st.session_state.data.copy()
-        for key in ['_temp', '_cache']:
-            old_data.pop(key, None)
+        with committing():
+            moved = roll_partitions(st.session_state.data)
+        if moved:
+            st.success(f"В архив перенесено записей: {moved}")
+        elif not GITHUB_TOKEN:
+            st.info("GitHub не настроен: архив не ведётся, все записи остаются в рабочих данных")
+        else:
+            st.info(f"Закрытых месяцев нет: в данных только записи начиная с {live_window_start()}")
+        return True
+    except Exception as e:
+        st.error(f"Ошибка архивации: {str(e)}")
+        return False
+
 
-        def json_serializer(obj):
-            if isinstance(obj, (datetime, date)):
-                return obj.isoformat()
-            raise TypeError(f"Type {type(obj)} not serializable")
+# --- Отложенная синхронизация с Gist ---
+# Сохранения из обработчиков кнопок не ждут GitHub: изменённые разделы ставятся
+# в очередь, а фоновый поток объединяет их и отправляет одним PATCH раз в интервал.
+SYNC_INTERVAL_SECONDS = 5
+SYNC_QUEUE_SIZE = 100
+
+class GistSyncWorker:
+    """Фоновый поток записи в Gist с объединением серий сохранений"""
+
+    def __init__(self, gist_id, token, interval=SYNC_INTERVAL_SECONDS):
+        self.gist_id = gist_id
+        self.client = get_github_client(token)
+        self.interval = interval
+        self.queue = queue.Queue(maxsize=SYNC_QUEUE_SIZE)
+        self.pending = {}
+        self.pending_since = None
+        self.status = 'synced'
+        self.last_error = None
+        self.last_synced_at = None
+        self.last_version = None
+        self._send_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="gist-sync", daemon=True)
+        self._thread.start()
+
+    def submit(self, files):
+        """Ставит файлы {имя: {"content": ...} | None} в очередь на отправку"""
+        try:
+            self.queue.put(files, timeout=SYNC_INTERVAL_SECONDS)
+        except queue.Full:
+            return False
+        self.status = 'pending'
+        return True
 
-        json_str = json.dumps(old_data, indent=4, ensure_ascii=False, default=json_serializer)
+    def _drain(self):
+        """Переносит всё из очереди в pending; более поздние версии файлов заменяют ранние"""
+        while True:
+            try:
+                files = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if self.pending_since is None:
+                self.pending_since = time.monotonic()
+            self.pending.update(files)
+
+    def _send_pending(self):
+        with self._send_lock:
+            self._drain()
+            if not self.pending:
+                return True
+            batch, self.pending, self.pending_since = self.pending, {}, None
+            try:
+                resp = self.client.patch(f"/gists/{self.gist_id}", json={"files": batch})
+                ok = resp.status_code == 200
+                error = None if ok else f"{resp.status_code} {resp.text[:200]}"
+            except Exception as e:
+                ok, error = False, str(e)
+
+            if ok:
+                self.last_synced_at = datetime.now()
+                # Версия, созданная нашей записью, не должна вызывать перезагрузку документа
+                self.last_version = (resp.json().get("history") or [{}])[0].get("version")
+                self.last_error = None
+                self.status = 'pending' if self.pending or not self.queue.empty() else 'synced'
+                return True
 
-        headers = github_headers()
-        if not headers:
+            # Возвращаем неотправленные файлы, не затирая более свежие версии
+            for name, content in batch.items():
+                self.pending.setdefault(name, content)
+            self.pending_since = self.pending_since or time.monotonic()
+            self.last_error = error
+            self.status = 'failed'
             return False
 
-        resp = requests.post(
-            "https://api.github.com/gists",
-            headers=headers,
-            json={
-                "description": f"Архив от {datetime.now().strftime('%Y-%m-%d %H:%M')}",
-                "public": False,
-                "files": {"archive_center_data.json": {"content": json_str}}
-            }
+    def _run(self):
+        while True:
+            try:
+                files = self.queue.get(timeout=1)
+                with self._send_lock:
+                    if self.pending_since is None:
+                        self.pending_since = time.monotonic()
+                    self.pending.update(files)
+            except queue.Empty:
+                pass
+            if self.pending_since is not None and time.monotonic() - self.pending_since >= self.interval:
+                self._send_pending()
+
+    def flush(self):
+        """Немедленно отправляет всё накопленное (выход из системы, остановка сервера)"""
+        return self._send_pending()
+
+    def pending_count(self):
+        return len(self.pending) + self.queue.qsize()
+
+@st.cache_resource
+def get_sync_worker(gist_id, token):
+    """Один поток синхронизации на процесс сервера"""
+    worker = GistSyncWorker(gist_id, token)
+    atexit.register(worker.flush)
+    return worker
+
+def flush_pending_sync():
+    """Дожидается отправки отложенных изменений (перед загрузкой данных и при выходе)"""
+    if GITHUB_TOKEN and GIST_ID:
+        return get_sync_worker(GIST_ID, GITHUB_TOKEN).flush()
+    return True
+
+def show_sync_status():
+    """Индикатор состояния отложенной синхронизации в боковой панели"""
+    if not (GITHUB_TOKEN and GIST_ID):
+        st.sidebar.caption("💾 Только локальное сохранение")
+        return
+    worker = get_sync_worker(GIST_ID, GITHUB_TOKEN)
+    if worker.status == 'failed':
+        st.sidebar.error(f"🔴 Ошибка синхронизации: {worker.last_error}")
+        if st.sidebar.button("🔁 Повторить синхронизацию"):
+            worker.flush()
+            st.rerun()
+    elif worker.status == 'pending':
+        st.sidebar.warning(f"🟡 Ожидает синхронизации ({worker.pending_count()})")
+    else:
+        synced_at = worker.last_synced_at.strftime('%H:%M:%S') if worker.last_synced_at else "—"
+        st.sidebar.caption(f"🟢 Синхронизировано с GitHub ({synced_at})")
+
+    quota = github_client().quota()
+    if quota['remaining'] is not None:
+        reset_at = quota['reset'].strftime('%H:%M') if quota['reset'] else "—"
+        st.sidebar.caption(
+            f"Лимит GitHub API: {quota['remaining']}/{quota['limit']} (сброс в {reset_at}); "
+            f"запросов {quota['requests']}, без изменений (304) {quota['not_modified']}, повторов {quota['retries']}"
         )
 
-        if resp.status_code == 201:
-            gist_data = resp.json()
-            st.session_state.data.setdefault('_archives', []).append({
-                'url': gist_data['html_url'],
-                'created': datetime.now().isoformat(),
-                'id': gist_data['id'],
-                'size': len(json_str)
-            })
-            st.session_state.data['payments'] = []
-            st.session_state.data['attendance'] = {}
-            if save_data(st.session_state.data):
-                st.success(f"Архив создан: {gist_data['html_url']}")
-                return True
-        else:
-            st.error(f"Ошибка архивации: {resp.status_code} {resp.text}")
-        return False
+def save_data(data, sections=None):
+    """
+    Сохраняет изменённые разделы локально (по файлу на раздел) и ставит их в очередь на отправку в Gist.
+    sections — разделы, которые точно менялись (например ['attendance']); без него
+    изменения определяются сравнением отпечатков всех разделов.
+    Сериализуются только проверяемые разделы, один раз для диска и Gist, и под блокировкой
+    записи, а не под блокировкой документа, которую берёт каждый перезапуск страницы.
+    Сохранение другого документа (восстановление версии, очистка) делает его общим для всех сессий.
+    """
+    shared = get_shared_document()
+    try:
+        with shared.write_lock:
+            replaced = data is not shared.data
+            if replaced:
+                shared.install(data)
+                st.session_state.data = data
+
+            gist_enabled = bool(GITHUB_TOKEN and GIST_ID)
+            local_fingerprints = local_section_fingerprints()
+            # Разделы, которых ещё нет на диске или в Gist, проверяются при любом сохранении
+            known = [local_fingerprints] + ([shared.fingerprints] if gist_enabled else [])
+            candidates = [s for s in data if sections is None or s in sections
+                          or any(s not in fingerprints for fingerprints in known)]
+            contents = {section: serialize_section(data[section]) for section in candidates}
+
+            # Локальное сохранение
+            removed_local = [] if sections is not None else [s for s in local_fingerprints if s not in data]
+            changed = write_local_sections(contents, removed_local) + removed_local
+            # Изменённые разделы уходят в Gist через фоновую очередь
+            if gist_enabled:
+                dirty, removed = collect_dirty_sections(data, sections, contents)
+                changed = sorted(set(changed) | set(dirty) | set(removed))
+                files = {section_file_name(section): {"content": content} for section, content in dirty.items()}
+                files.update({section_file_name(section): None for section in removed})
+                if shared.legacy_layout:
+                    # Переход со старого единого файла: все разделы уже в files
+                    files[GIST_LEGACY_FILE] = None
+
+                if files:
+                    if not get_sync_worker(GIST_ID, GITHUB_TOKEN).submit(files):
+                        st.error("Очередь синхронизации переполнена, изменения сохранены только локально")
+                        return False
+                    # Неудачные отправки повторяются фоновым потоком, поэтому отпечатки обновляем сразу
+                    remember_saved_sections(data, dirty)
+                    for section in removed:
+                        shared.fingerprints.pop(section, None)
+                    shared.legacy_layout = False
+
+            # Новый документ проверяется целиком, текущий — только по изменённым записям
+            store = shared.store
+            integrity_errors = store.validate_all() if replaced else store.validate_changes()
+            if not replaced:
+                store.after_save(sections)
+                with shared.lock:
+                    shared.revision += 1
+                    shared.touch_sections(changed)
+
+        for error in integrity_errors:
+            st.error(f"Ошибка целостности: {error}")
+                
+        return True
+        
     except Exception as e:
-        st.error(f"Ошибка архивации: {str(e)}")
+        st.error(f"Ошибка сохранения: {str(e)}")
         return False
 
 
-def save_data(data):
-    """Сохраняет данные локально и в Gist через API"""
-    try:
-        def json_serializer(obj):
-            if isinstance(obj, (datetime, date)):
-                return obj.isoformat()
-            raise TypeError(f"Type {type(obj)} not serializable")
+# --- Кэш производных данных по ревизии ---
+# save_data увеличивает номер ревизии, поэтому производные представления (поиск,
+# отчётные таблицы, счётчики) живут между переходами по страницам и сбрасываются
+# ровно тогда, когда данные изменились.
+def get_data_revision():
+    """Ревизия общего документа: сам объект данных и номер сохранения"""
+    shared = get_shared_document()
+    return id(shared.data), shared.revision
+
+def memoize_by_revision(func):
+    """Кэширует результат функции до следующего изменения данных (общий для всех сессий)"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        shared = get_shared_document()
+        revision = get_data_revision()
+        cache = shared.memo
+        if cache['revision'] != revision:
+            cache = {'revision': revision, 'values': {}}
+            shared.memo = cache
+        key = (func.__name__, args, tuple(sorted(kwargs.items())))
+        if key not in cache['values']:
+            cache['values'][key] = func(*args, **kwargs)
+        return cache['values'][key]
+    return wrapper
+
+def memoize_by_sections(*sections):
+    """Как memoize_by_revision, но кэш сбрасывается только при изменении перечисленных разделов"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            shared = get_shared_document()
+            stamp = tuple(shared.section_revisions[section] for section in sections)
+            cache = shared.section_memo.get(func.__name__)
+            if cache is None or cache['stamp'] != stamp:
+                cache = {'stamp': stamp, 'values': {}}
+                shared.section_memo[func.__name__] = cache
+            key = (args, tuple(sorted(kwargs.items())))
+            if key not in cache['values']:
+                cache['values'][key] = func(*args, **kwargs)
+            return cache['values'][key]
+        return wrapper
+    return decorator
 
-        json_str = json.dumps(data, indent=4, ensure_ascii=False, default=json_serializer)
 
-        # Локальное сохранение
-        with open(DATA_FILE, 'w', encoding='utf-8') as f:
-            f.write(json_str)
+# --- Ссылки по id ---
+# Направления (вместе с поднаправлениями «Основное (Имя)») и преподаватели связаны с остальными
+# записями по id: поля *_id рядом с прежними полями-названиями. Названия остаются отображаемыми
+# копиями для страниц, CSV и экспорта. Если название ссылки есть среди текущих, id берётся по нему
+# (так правки названий в таблицах переносятся в id); если названия больше нет, оно
+# восстанавливается по id. Переименование обновляет копии только у ссылающихся записей.
+# Поле-название, поле-id, пространство имён, список ли это
+REFERENCE_FIELDS = {
+    'schedule': (('direction', 'direction_id', 'directions', False), ('teacher', 'teacher_id', 'teachers', False)),
+    'single_lessons': (('direction', 'direction_id', 'directions', False), ('teacher', 'teacher_id', 'teachers', False)),
+    'payments': (('direction', 'direction_id', 'directions', False),),
+    'materials': (('direction', 'direction_id', 'directions', False),),
+    'students': (('directions', 'direction_ids', 'directions', True),),
+    'teachers': (('directions', 'direction_ids', 'directions', True),),
+    'classrooms': (('directions', 'direction_ids', 'directions', True),),
+    'subdirections': (('parent', 'parent_id', 'directions', False),),
+}
 
-        # Сохранение в GitHub
-        if GITHUB_TOKEN and GIST_ID:
-            headers = github_headers()
-            if not headers:
-                return False
-
-            resp = requests.patch(
-                f"https://api.github.com/gists/{GIST_ID}",
-                headers=headers,
-                json={"files": {"center_data.json": {"content": json_str}}}
-            )
+def build_reference_maps(data):
+    """{'names': {пространство: {id: название}}, 'ids': {пространство: {название: id}}}"""
+    main_names = {d['id']: d['name'] for d in data.get('directions', []) if d.get('id')}
+    main_ids = {}
+    for direction_id, name in main_names.items():
+        main_ids.setdefault(name, direction_id)
+    direction_names = dict(main_names)
+    for sub in data.get('subdirections', []):
+        if sub.get('id'):
+            parent = sub.get('parent') if sub.get('parent') in main_ids else main_names.get(sub.get('parent_id'), sub.get('parent'))
+            direction_names[sub['id']] = f"{parent} ({sub.get('name')})"
+    names = {
+        'directions': direction_names,
+        'teachers': {t['id']: t['name'] for t in data.get('teachers', []) if t.get('id')},
+    }
+    ids = {}
+    for namespace, by_id in names.items():
+        ids[namespace] = {}
+        for record_id, name in by_id.items():
+            ids[namespace].setdefault(name, record_id)
+    return {'names': names, 'ids': ids}
+
+def resolve_references(section, record, maps):
+    """Проставляет id ссылок записи по названиям, а устаревшие названия восстанавливает по id"""
+    for name_field, id_field, namespace, is_list in REFERENCE_FIELDS.get(section, ()):
+        ids, names = maps['ids'][namespace], maps['names'][namespace]
+        value = record.get(name_field)
+        if is_list:
+            if isinstance(value, list):
+                # Как и для одиночных ссылок: неизвестное название восстанавливается по id той же позиции
+                old_ids = record.get(id_field) or []
+                resolved = []
+                for i, name in enumerate(value):
+                    old_id = old_ids[i] if i < len(old_ids) else None
+                    if name not in ids and old_id in names:
+                        value[i] = names[old_id]
+                        resolved.append(old_id)
+                    else:
+                        resolved.append(ids.get(name))
+                record[id_field] = resolved
+        elif value in ids:
+            record[id_field] = ids[value]
+        elif record.get(id_field) in names:
+            record[name_field] = names[record[id_field]]
+
+def migrate_references(data):
+    """Переводит документ на ссылки по id: выдаёт недостающие id и заполняет поля *_id"""
+    # id недостающим записям выдаются при загрузке, а не при отрисовке страниц
+    for section in ('directions', 'subdirections', 'students', 'teachers'):
+        for record in data.get(section, []):
+            record.setdefault('id', str(uuid.uuid4()))
+    maps = build_reference_maps(data)
+    for section in REFERENCE_FIELDS:
+        for record in data.get(section, []):
+            resolve_references(section, record, maps)
+
+
+# --- Индексированное хранилище данных ---
+class AttendanceTable:
+    """
+    Колоночная таблица отметок посещаемости (дата, занятие, ученик, был, оплачено, примечание)
+    со вторичными индексами по ученику, занятию и дате. Таблица только дополняется:
+    изменение отметки добавляет новую строку, а актуальная строка для ключа
+    (дата, занятие, ученик) хранится в live. Поля отметки сверх колонок (редкие) лежат
+    в разреженном словаре extras по номеру строки.
+
+    Источником данных остаётся вложенный словарь дата → занятие → ученик в data['attendance']
+    (его сохраняют, архивируют и правят страницы); таблица — индекс поверх него для выборок
+    по ученику, занятию и дате. Колонки ссылаются на те же строки-ключи, что и словарь, так что
+    дополнительная память — это массивы строк и индексы, а не копии отметок.
+    from_nested/to_nested переводят между форматами без потери полей.
+    """
+
+    COLUMNS = ('present', 'paid', 'note')
+
+    def __init__(self, source=None):
+        self.source = source
+        self.dates = []
+        self.lesson_ids = []
+        self.student_ids = []
+        self.present = array('b')
+        self.paid = array('b')
+        self.notes = []
+        self.extras = {}
+        self.live = {}
+        self.by_student = defaultdict(list)
+        self.by_lesson = defaultdict(list)
+        self.by_date = defaultdict(list)
+
+    @classmethod
+    def from_nested(cls, attendance):
+        table = cls(attendance)
+        for day, lessons in attendance.items():
+            for lesson_id, marks in lessons.items():
+                for student_id, mark in marks.items():
+                    table.append(day, lesson_id, student_id, mark)
+        return table
+
+    def to_nested(self):
+        attendance = {}
+        for row in sorted(self.live.values()):
+            attendance.setdefault(self.dates[row], {}).setdefault(self.lesson_ids[row], {})[self.student_ids[row]] = self.mark(row)
+        return attendance
+
+    def append(self, day, lesson_id, student_id, mark):
+        row = len(self.dates)
+        self.dates.append(day)
+        self.lesson_ids.append(lesson_id)
+        self.student_ids.append(student_id)
+        self.present.append(bool(mark.get('present')))
+        self.paid.append(bool(mark.get('paid')))
+        self.notes.append(mark.get('note', ''))
+        extra = {field: value for field, value in mark.items() if field not in self.COLUMNS}
+        if extra:
+            self.extras[row] = extra
+        key = (day, lesson_id, student_id)
+        # Индексы хранят строку для ключа, пока он жив; актуальная строка берётся из live.
+        # После удаления и повторной отметки ключ попадает в индекс ещё раз — _scan это учитывает
+        if key not in self.live:
+            self.by_student[student_id].append(row)
+            self.by_lesson[lesson_id].append(row)
+            self.by_date[day].append(row)
+        self.live[key] = row
+        self._maybe_compact()
+        return row
+
+    def remove(self, day, lesson_id, student_id):
+        self.live.pop((day, lesson_id, student_id), None)
+        self._maybe_compact()
+
+    def mark(self, row):
+        """Словарь отметки строки в формате data['attendance']"""
+        return {
+            **self.extras.get(row, {}),
+            'present': bool(self.present[row]), 'paid': bool(self.paid[row]), 'note': self.notes[row]
+        }
 
-            if resp.status_code == 200:
-                st.success("Данные синхронизированы с GitHub!")
+    def record(self, row):
+        return {
+            **self.mark(row),
+            'date': self.dates[row], 'lesson_id': self.lesson_ids[row], 'student_id': self.student_ids[row]
+        }
+
+    def _scan(self, rows):
+        """Актуальные записи для строк индекса"""
+        result, seen = [], set()
+        for row in rows:
+            current = self.live.get((self.dates[row], self.lesson_ids[row], self.student_ids[row]))
+            if current is not None and current not in seen:
+                seen.add(current)
+                result.append(self.record(current))
+        return result
+
+    def for_student(self, student_id):
+        return self._scan(self.by_student.get(student_id, ()))
+
+    def for_lesson(self, lesson_id):
+        return self._scan(self.by_lesson.get(lesson_id, ()))
+
+    def on_date(self, day):
+        return self._scan(self.by_date.get(day, ()))
+
+    def _maybe_compact(self):
+        """Пересобирает колонки, когда устаревших строк становится больше актуальных"""
+        if len(self.dates) > 1000 and len(self.dates) > 2 * len(self.live):
+            compacted = AttendanceTable(self.source)
+            for row in sorted(self.live.values()):
+                compacted.append(self.dates[row], self.lesson_ids[row], self.student_ids[row], self.mark(row))
+            self.__dict__.update(compacted.__dict__)
+
+class ConflictIndex:
+    """
+    Занятость преподавателей и классов по дням недели: для каждого (вид, ресурс, день)
+    отсортированный по началу список интервалов (начало, конец, id занятия) в минутах.
+    Проверка одного занятия — бинарный поиск плюс просмотр пересекающихся соседей;
+    longest ограничивает, насколько раньше может начаться пересекающийся интервал.
+    """
+
+    def __init__(self):
+        self.intervals = defaultdict(list)
+        self.longest = defaultdict(int)
+
+    @staticmethod
+    def keys(lesson):
+        """Ресурсы занятия: преподаватель (по id, иначе по имени) и класс, если указан"""
+        teacher = lesson.get('teacher_id') or lesson.get('teacher')
+        if teacher:
+            yield ('teacher', teacher, lesson.get('day'))
+        if lesson.get('classroom'):
+            yield ('classroom', lesson['classroom'], lesson.get('day'))
+
+    @staticmethod
+    def span(lesson):
+        return time_to_minutes(lesson.get('start_time', '00:00')), time_to_minutes(lesson.get('end_time', '00:00'))
+
+    def add(self, lesson):
+        start, end = self.span(lesson)
+        if end <= start:
+            return
+        for key in self.keys(lesson):
+            insort(self.intervals[key], (start, end, lesson.get('id')))
+            self.longest[key] = max(self.longest[key], end - start)
+
+    def remove(self, lesson):
+        start, end = self.span(lesson)
+        for key in self.keys(lesson):
+            bucket = self.intervals.get(key, [])
+            i = bisect_left(bucket, (start, end, lesson.get('id')))
+            if i < len(bucket) and bucket[i] == (start, end, lesson.get('id')):
+                del bucket[i]
+
+    def clear(self):
+        self.intervals.clear()
+        self.longest.clear()
+
+    def find(self, lesson, ignore_id=None):
+        """Пересечения занятия с проиндексированными: [(вид, ресурс, id занятия)]"""
+        start, end = self.span(lesson)
+        conflicts = []
+        if end <= start:
+            return conflicts
+        for key in self.keys(lesson):
+            bucket = self.intervals.get(key, [])
+            i = bisect_left(bucket, (start - self.longest[key] + 1,))
+            while i < len(bucket) and bucket[i][0] < end:
+                other_start, other_end, other_id = bucket[i]
+                if other_end > start and other_id != ignore_id:
+                    conflicts.append((key[0], key[1], other_id))
+                i += 1
+        return conflicts
+
+    @classmethod
+    def sweep(cls, lessons):
+        """Все пересечения набора занятий одним проходом по началам: [(вид, ресурс, день, занятие, занятие)]"""
+        events = defaultdict(list)
+        for lesson in lessons:
+            start, end = cls.span(lesson)
+            if end > start:
+                for key in cls.keys(lesson):
+                    events[key].append((start, end, lesson))
+        collisions = []
+        for key, intervals in events.items():
+            intervals.sort(key=lambda item: item[:2])
+            active = []  # куча (конец, номер, занятие) ещё не закончившихся занятий
+            for number, (start, end, lesson) in enumerate(intervals):
+                while active and active[0][0] <= start:
+                    heapq.heappop(active)
+                collisions.extend((*key, other, lesson) for _, _, other in active)
+                heapq.heappush(active, (end, number, lesson))
+        return collisions
+
+def synchronized(method):
+    """Метод DataStore под его блокировкой: индексы не перестраиваются параллельно из разных сессий"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+class DataStore:
+    """
+    Хеш-индексы поверх st.session_state.data: по id, по имени, ученики по направлению,
+    занятия по дню недели, интервалы занятости преподавателей и классов, оплаты по ученику,
+    уникальный ключ оплаты, покрытие занятий
+    оплатами и таблица посещаемости, а также обратные ссылки для каскадного удаления и
+    переименований (направление/преподаватель по id → ссылающиеся записи, ученик → разовые
+    занятия). При индексации у записей проставляются id ссылок. Изменения через insert/update/delete
+    (и set_attendance/remove_attendance) поддерживают индексы инкрементально; разделы,
+    изменённые напрямую, перестраиваются лениво после save_data.
+    """
+
+    ID_SECTIONS = ('students', 'teachers', 'parents', 'directions', 'schedule', 'payments', 'single_lessons')
+    NAME_SECTIONS = ('students', 'teachers', 'parents', 'directions')
+    SUBSCRIPTION_TYPES = ('Абонемент',)
+    SINGLE_PAYMENT_TYPES = ('Разовое', 'Пробное')
+    # Ссылки, проверяемые при сохранении: (раздел, поле, целевой раздел, индекс обратных ссылок, текст ошибки)
+    REFERENCES = (
+        ('payments', 'student_id', 'students', 'payments_by_student', "платеж для несуществующего ученика"),
+        ('single_lessons', 'student_id', 'students', 'single_lessons_by_student',
+         "разовое занятие для несуществующего ученика"),
+    )
+
+    def __init__(self, data):
+        self.data = data
+        self.by_id = {}
+        self.by_name = {}
+        self.students_by_direction = defaultdict(dict)
+        self.lessons_by_day = defaultdict(dict)
+        self.schedule_conflicts = ConflictIndex()
+        # раздел -> ('directions' | 'teachers', id цели) -> {id записи: запись}
+        self.referrers = defaultdict(lambda: defaultdict(dict))
+        self._references = None  # (отпечаток, build_reference_maps), см. _reference_maps
+        self.single_lessons_by_student = defaultdict(dict)
+        self.payments_by_student = defaultdict(dict)
+        # Покрытие оплатами (счётчики, чтобы удаление одной из дублирующих оплат не снимало покрытие):
+        # (ученик, направление, 'ГГГГ-ММ') — абонементы, (ученик, направление, 'ГГГГ-ММ-ДД') —
+        # разовые и пробные, а также любые оплаты за день
+        self.subscription_coverage = defaultdict(int)
+        self.single_coverage = defaultdict(int)
+        self.payments_by_day = defaultdict(int)
+        # (ученик, направление, 'ГГГГ-ММ-ДД', тип) -> оплата; основа upsert_payment
+        self.payments_by_key = {}
+        # (месяц, число записей партиции) -> {ключ: оплата} для архивных месяцев
+        self.archived_payment_keys = {}
+        # (месяц, число записей партиции) -> покрытие архивными оплатами, см. _archived_coverage
+        self.archived_coverage = {}
+        self._attendance = None  # AttendanceTable, строится при первом обращении
+        self._attendance_signature = None
+        self.stale = set(self.ID_SECTIONS)
+        self.touched = set()
+        self._signatures = {}
+        # Записи, изменённые через API с прошлого сохранения, — для проверки целостности
+        self.changed_ids = defaultdict(set)
+        self.removed_ids = defaultdict(set)
+        # Построение индексов и изменения выполняются по очереди для всех сессий процесса.
+        # Порядок захвата: сначала замки SharedDocument (правка и сохранение), затем этот — не наоборот
+        self.lock = threading.RLock()
+
+    # --- построение индексов ---
+    def _signature(self, section):
+        records = self.data.get(section, [])
+        return id(records), len(records)
+
+    @synchronized
+    def _ensure(self, section):
+        """Перестраивает раздел, если он устарел или список был заменён/изменён в обход API"""
+        if section in self.stale or self._signatures.get(section) != self._signature(section):
+            self._rebuild(section)
+
+    def _rebuild(self, section):
+        self.by_id[section] = {}
+        self.referrers.pop(section, None)
+        if section in self.NAME_SECTIONS:
+            self.by_name[section] = defaultdict(list)
+        if section in ('directions', 'teachers'):
+            self._references = None
+        if section == 'students':
+            self.students_by_direction.clear()
+        elif section == 'schedule':
+            self.lessons_by_day.clear()
+            self.schedule_conflicts.clear()
+        elif section == 'single_lessons':
+            self.single_lessons_by_student.clear()
+        elif section == 'payments':
+            self.payments_by_student.clear()
+            self.subscription_coverage.clear()
+            self.single_coverage.clear()
+            self.payments_by_day.clear()
+            self.payments_by_key.clear()
+
+        for record in self.data.get(section, []):
+            self._index(section, record)
+        self.stale.discard(section)
+        self._signatures[section] = self._signature(section)
+
+    def _index(self, section, record):
+        record_id = record.get('id')
+        if section in REFERENCE_FIELDS:
+            resolve_references(section, record, self._reference_maps())
+            self._index_references(section, record)
+        self.by_id[section][record_id] = record
+        if section in self.NAME_SECTIONS:
+            self.by_name[section][record.get('name')].append(record)
+        if section == 'students':
+            for direction in record.get('directions') or []:
+                self.students_by_direction[direction][record_id] = record
+        elif section == 'schedule':
+            self.lessons_by_day[record.get('day')][record_id] = record
+            self.schedule_conflicts.add(record)
+        elif section == 'single_lessons':
+            self.single_lessons_by_student[record.get('student_id')][record_id] = record
+        elif section == 'payments':
+            self.payments_by_student[record.get('student_id')][record_id] = record
+            self.payments_by_key.setdefault(self.payment_key(record), record)
+            for counts, key in self._coverage_keys(record):
+                counts[key] += 1
+
+    def _unindex(self, section, record):
+        record_id = record.get('id')
+        self.by_id[section].pop(record_id, None)
+        self._unindex_references(section, record)
+        if section in self.NAME_SECTIONS:
+            same_name = self.by_name[section].get(record.get('name'), [])
+            same_name[:] = [r for r in same_name if r is not record]
+        if section == 'students':
+            for direction in record.get('directions') or []:
+                self.students_by_direction[direction].pop(record_id, None)
+        elif section == 'schedule':
+            self.lessons_by_day[record.get('day')].pop(record_id, None)
+            self.schedule_conflicts.remove(record)
+        elif section == 'single_lessons':
+            self.single_lessons_by_student[record.get('student_id')].pop(record_id, None)
+        elif section == 'payments':
+            self.payments_by_student[record.get('student_id')].pop(record_id, None)
+            key = self.payment_key(record)
+            if self.payments_by_key.get(key) is record:
+                # В старых данных бывают дубли: ключ переходит к оставшейся такой же оплате
+                del self.payments_by_key[key]
+                for other in self.payments_by_student[record.get('student_id')].values():
+                    if self.payment_key(other) == key:
+                        self.payments_by_key[key] = other
+                        break
+            for counts, key in self._coverage_keys(record):
+                counts[key] -= 1
+                if counts[key] <= 0:
+                    del counts[key]
+
+    def _reference_targets(self, section, record):
+        for _, id_field, namespace, is_list in REFERENCE_FIELDS.get(section, ()):
+            for target_id in (record.get(id_field) or [] if is_list else [record.get(id_field)]):
+                if target_id:
+                    yield namespace, target_id
+
+    def _index_references(self, section, record):
+        for target in self._reference_targets(section, record):
+            self.referrers[section][target][record.get('id')] = record
+
+    def _unindex_references(self, section, record):
+        for target in self._reference_targets(section, record):
+            self.referrers[section][target].pop(record.get('id'), None)
+
+    def _reference_maps(self):
+        """Кэш разрешения имён: пересчитывается при изменении направлений, поднаправлений или преподавателей"""
+        fingerprint = tuple(self._signature(section) for section in ('directions', 'subdirections', 'teachers'))
+        if self._references is None or self._references[0] != fingerprint:
+            self._references = (fingerprint, build_reference_maps(self.data))
+        return self._references[1]
+
+    @staticmethod
+    def payment_key(payment):
+        """Ключ уникальности оплаты: ученик, направление, день, тип"""
+        return (payment.get('student_id'), payment.get('direction'),
+                str(payment.get('date') or '')[:10], payment.get('type'))
+
+    def _coverage_keys(self, payment):
+        """Ячейки индексов покрытия, которые занимает оплата"""
+        day = str(payment.get('date') or '')[:10]
+        if not day:
+            return []
+        student_id, direction = payment.get('student_id'), payment.get('direction')
+        keys = [(self.payments_by_day, (student_id, direction, day))]
+        if payment.get('type') in self.SUBSCRIPTION_TYPES:
+            keys.append((self.subscription_coverage, (student_id, direction, day[:7])))
+        elif payment.get('type') in self.SINGLE_PAYMENT_TYPES:
+            keys.append((self.single_coverage, (student_id, direction, day)))
+        return keys
+
+    @synchronized
+    def invalidate(self, sections=None):
+        """Помечает разделы для перестройки при следующем обращении"""
+        self.stale.update(self.ID_SECTIONS if sections is None else set(sections) & set(self.ID_SECTIONS))
+        if sections is None or set(sections) & {'directions', 'subdirections', 'teachers'}:
+            self._references = None
+        if sections is None or 'attendance' in sections:
+            self._attendance = None
+
+    @synchronized
+    def after_save(self, sections=None):
+        """Разделы, изменённые только через API, остаются актуальными; остальные перестраиваются"""
+        candidates = set(self.ID_SECTIONS + ('attendance',) if sections is None else sections)
+        self.invalidate(candidates - self.touched)
+        self.touched.clear()
+
+    # --- чтение ---
+    @synchronized
+    def get(self, section, record_id):
+        self._ensure(section)
+        return self.by_id[section].get(record_id)
+
+    @synchronized
+    def find_by_name(self, section, name):
+        matches = self.find_all_by_name(section, name)
+        return matches[0] if matches else None
+
+    @synchronized
+    def find_all_by_name(self, section, name):
+        self._ensure(section)
+        return list(self.by_name[section].get(name, []))
+
+    @synchronized
+    def students_in_direction(self, direction_name):
+        self._ensure('students')
+        return list(self.students_by_direction.get(direction_name, {}).values())
+
+    @synchronized
+    def lessons_on_day(self, day):
+        self._ensure('schedule')
+        return list(self.lessons_by_day.get(day, {}).values())
+
+    @synchronized
+    def resolve(self, section, record):
+        """Копия записи с проставленными id ссылок (для проверки до вставки)"""
+        record = dict(record)
+        if section in REFERENCE_FIELDS:
+            resolve_references(section, record, self._reference_maps())
+        return record
+
+    @synchronized
+    def lesson_conflicts(self, lesson, ignore_id=None):
+        """Занятия расписания, пересекающиеся с lesson по преподавателю или классу"""
+        self._ensure('schedule')
+        return [(kind, resource, self.by_id['schedule'][lesson_id])
+                for kind, resource, lesson_id in self.schedule_conflicts.find(self.resolve('schedule', lesson),
+                                                                              ignore_id)]
+
+    @synchronized
+    def payments_of_student(self, student_id):
+        self._ensure('payments')
+        return list(self.payments_by_student.get(student_id, {}).values())
+
+    @synchronized
+    def records(self, section):
+        """Записи раздела с проставленными id ссылок"""
+        self._ensure(section)
+        return self.data.get(section, [])
+
+    @synchronized
+    def reference_names(self, namespace):
+        """id -> отображаемое название ('directions' вместе с поднаправлениями, 'teachers')"""
+        return self._reference_maps()['names'][namespace]
+
+    @synchronized
+    def lessons_of_teacher(self, teacher_id):
+        self._ensure('schedule')
+        return list(self.referrers['schedule'].get(('teachers', teacher_id), {}).values())
+
+    @synchronized
+    def single_lessons_of_student(self, student_id):
+        self._ensure('single_lessons')
+        return list(self.single_lessons_by_student.get(student_id, {}).values())
+
+    def _attendance_days(self):
+        attendance = self.data.get('attendance')
+        return id(attendance), len(attendance or {})
+
+    @synchronized
+    def attendance(self):
+        """Таблица посещаемости; перестраивается, если словарь посещаемости заменён или изменён в обход API"""
+        if self._attendance is None or self._attendance_signature != self._attendance_days():
+            self._attendance = AttendanceTable.from_nested(self.data.setdefault('attendance', {}))
+            self._attendance_signature = self._attendance_days()
+        return self._attendance
+
+    @synchronized
+    def attendance_of_student(self, student_id):
+        return self.attendance().for_student(student_id)
+
+    @synchronized
+    def attendance_of_lesson(self, lesson_id):
+        return self.attendance().for_lesson(lesson_id)
+
+    @synchronized
+    def attendance_on(self, day):
+        return self.attendance().on_date(day)
+
+    @synchronized
+    def is_lesson_paid(self, student_id, directions, day):
+        """Покрыто ли занятие дня day абонементом этого месяца или разовой/пробной оплатой этого дня"""
+        self._ensure('payments')
+        day = str(day)[:10]
+        archived = self._archived_coverage(day[:7])
+        return any(
+            (student_id, direction, day[:7]) in self.subscription_coverage
+            or (student_id, direction, day) in self.single_coverage
+            or (student_id, direction, day[:7]) in archived['subscription']
+            or (student_id, direction, day) in archived['single']
+            for direction in directions
+        )
+
+    @synchronized
+    def has_payment_on(self, student_id, directions, day):
+        """Есть ли оплата любого типа за день day по одному из направлений"""
+        self._ensure('payments')
+        day = str(day)[:10]
+        archived = self._archived_coverage(day[:7])
+        return any((student_id, direction, day) in self.payments_by_day
+                   or (student_id, direction, day) in archived['day']
+                   for direction in directions)
+
+    NO_COVERAGE = {'day': frozenset(), 'subscription': frozenset(), 'single': frozenset()}
+
+    def _archived_coverage(self, month):
+        """Ключи покрытия оплатами архивного месяца в виде множеств {'day', 'subscription', 'single'}.
+
+        Оплаты закрытых месяцев лежат в партициях, поэтому без этого занятия архивного месяца
+        выглядели бы неоплаченными. Партиция читается один раз на (месяц, число записей).
+        """
+        meta = self.data.get('_partitions', {}).get('payments', {})
+        if month not in meta:
+            return self.NO_COVERAGE
+        stamp = (month, meta[month].get('count'))
+        if stamp not in self.archived_coverage:
+            names = {id(self.payments_by_day): 'day', id(self.subscription_coverage): 'subscription',
+                     id(self.single_coverage): 'single'}
+            coverage = {name: set() for name in names.values()}
+            for payment in read_archived_partition('payments', month, self.data):
+                for index, key in self._coverage_keys(payment):
+                    coverage[names[id(index)]].add(key)
+            self.archived_coverage[stamp] = coverage
+        return self.archived_coverage[stamp]
+
+    # --- изменение ---
+    @synchronized
+    def insert(self, section, record):
+        self._ensure(section)
+        record.setdefault('id', str(uuid.uuid4()))
+        self.data.setdefault(section, []).append(record)
+        self._index(section, record)
+        self._signatures[section] = self._signature(section)
+        self.touched.add(section)
+        self.changed_ids[section].add(record['id'])
+        return record
+
+    def upsert_payment(self, record):
+        """Добавляет оплату, если оплаты с тем же ключом ещё нет.
+
+        Возвращает (оплата, создана): при повторе — уже существующую запись и False,
+        поэтому повторный клик или импорт того же файла не создают двойного начисления.
+        Для месяцев, перенесённых в архив, ключ проверяется и по архивной партиции.
+        """
+        with self.lock:
+            self._ensure('payments')
+            existing = self.payments_by_key.get(self.payment_key(record)) or self._archived_payment(record)
+            if existing is not None:
+                return existing, False
+            return self.insert('payments', record), True
+
+    def _archived_payment(self, record):
+        """Оплата с тем же ключом в архивной партиции месяца (ключи партиции кэшируются по числу записей)"""
+        month = month_key(record.get('date'))
+        meta = self.data.get('_partitions', {}).get('payments', {})
+        if month not in meta:
+            return None
+        stamp = (month, meta[month].get('count'))
+        if stamp not in self.archived_payment_keys:
+            self.archived_payment_keys[stamp] = {
+                self.payment_key(payment): payment for payment in read_archived_partition('payments', month, self.data)
+            }
+        return self.archived_payment_keys[stamp].get(self.payment_key(record))
+
+    @synchronized
+    def update(self, section, record_id, changes):
+        record = self.get(section, record_id)
+        if record is None:
+            return None
+        self._unindex(section, record)
+        record.update(changes)
+        self._index(section, record)
+        self.touched.add(section)
+        self.changed_ids[section].add(record_id)
+        return record
+
+    @synchronized
+    def set_attendance(self, day, lesson_id, student_id, mark):
+        """Записывает отметку и во вложенный словарь data['attendance'], и в таблицу"""
+        table = self.attendance()
+        self.data['attendance'].setdefault(day, {}).setdefault(lesson_id, {})[student_id] = mark
+        table.append(day, lesson_id, student_id, mark)
+        self._attendance_signature = self._attendance_days()
+        self.touched.add('attendance')
+        return mark
+
+    @synchronized
+    def remove_attendance(self, keys):
+        """Удаляет отметки по ключам (дата, занятие, ученик), убирая опустевшие уровни словаря"""
+        table = self.attendance()
+        attendance = self.data['attendance']
+        for day, lesson_id, student_id in keys:
+            marks = attendance.get(day, {}).get(lesson_id)
+            if marks is None or student_id not in marks:
+                continue
+            del marks[student_id]
+            if not marks:
+                del attendance[day][lesson_id]
+                if not attendance[day]:
+                    del attendance[day]
+            table.remove(day, lesson_id, student_id)
+        self._attendance_signature = self._attendance_days()
+        self.touched.add('attendance')
+
+    @synchronized
+    def delete(self, section, record_ids):
+        """Удаляет записи по id (список сохраняет порядок), возвращает удалённые"""
+        self._ensure(section)
+        record_ids = set(record_ids)
+        removed = [self.by_id[section][rid] for rid in record_ids if rid in self.by_id[section]]
+        if not removed:
+            return []
+        for record in removed:
+            self._unindex(section, record)
+        # Список меняется на месте: страницы держат ссылки на data[section]
+        self.data[section][:] = [r for r in self.data[section] if r.get('id') not in record_ids]
+        self._signatures[section] = self._signature(section)
+        self.touched.add(section)
+        self.changed_ids[section] -= record_ids
+        self.removed_ids[section] |= record_ids
+        return removed
+
+    # --- переименование ---
+    @synchronized
+    def rename_references(self, namespace, old_names):
+        """
+        Переносит новые названия направлений или преподавателей в ссылающиеся записи.
+        old_names — снимок reference_names(namespace) до правки; обходятся только записи,
+        ссылающиеся по id на переименованные сущности. Возвращает число обновлённых записей.
+        """
+        self._references = None
+        maps = self._reference_maps()
+        # Поднаправления не индексируются: родитель переименованного направления обновляется здесь
+        for sub in self.data.get('subdirections', []):
+            resolve_references('subdirections', sub, maps)
+        names = maps['names'][namespace]
+        renamed = {target_id: name for target_id, name in names.items()
+                   if target_id in old_names and old_names[target_id] != name}
+        if not renamed:
+            return 0
+
+        updated, changed_sections = 0, set()
+        for section, fields in REFERENCE_FIELDS.items():
+            fields = [field for field in fields if field[2] == namespace]
+            if not fields or section == 'subdirections':
+                continue
+            if section in self.ID_SECTIONS:
+                self._ensure(section)
+                by_target = self.referrers[section]
+                records = {record_id: record for target_id in renamed
+                           for record_id, record in by_target.get((namespace, target_id), {}).items()}.values()
             else:
-                st.error(f"Ошибка обновления Gist: {resp.status_code} {resp.text}")
-                return False
-        for payment in data['payments']:
-            if payment['student_id'] not in [s['id'] for s in data['students']]:
-                st.error(f"Ошибка целостности: платеж для несуществующего ученика {payment['student_id']}")
-                
-        return True
-        
+                # Материалы и классы — короткие списки без индекса
+                records = self.data.get(section, [])
+            for record in records:
+                if self._apply_names(record, fields, renamed):
+                    updated += 1
+                    changed_sections.add(section)
+
+        # Индексы, построенные по названиям (ученики по направлению, покрытие оплат), перестроятся лениво
+        self.invalidate(changed_sections)
+        self.touched |= changed_sections
+        return updated
+
+    @staticmethod
+    def _apply_names(record, fields, renamed):
+        changed = False
+        for name_field, id_field, _, is_list in fields:
+            if is_list:
+                names = record.get(name_field)
+                for i, target_id in enumerate(record.get(id_field) or []):
+                    if target_id in renamed and isinstance(names, list) and i < len(names):
+                        names[i] = renamed[target_id]
+                        changed = True
+            elif record.get(id_field) in renamed:
+                record[name_field] = renamed[record[id_field]]
+                changed = True
+        return changed
+
+    # --- проверка целостности ---
+    def _changed_outside_api(self, section):
+        """Список раздела заменён или изменил длину в обход insert/delete"""
+        return section in self._signatures and self._signatures[section] != self._signature(section)
+
+    @synchronized
+    def validate_changes(self):
+        """
+        Проверяет ссылки только у записей, добавленных или изменённых с прошлого сохранения,
+        и у записей, ссылавшихся на удалённые (по индексу обратных ссылок). Раздел, изменённый
+        в обход API, проверяется целиком. Возвращает список ошибок.
+        """
+        errors = []
+        for section, field, target, reverse_index, message in self.REFERENCES:
+            if self._changed_outside_api(section) or self._changed_outside_api(target):
+                errors += self._check_references(section, field, target, message, self.data.get(section, []))
+                continue
+            changed = self.changed_ids.get(section, set())
+            removed = self.removed_ids.get(target, set())
+            if not changed and not removed:
+                continue
+            self._ensure(section)
+            records = [self.by_id[section][rid] for rid in changed if rid in self.by_id[section]]
+            for target_id in removed:
+                records.extend(getattr(self, reverse_index).get(target_id, {}).values())
+            errors += self._check_references(section, field, target, message, records)
+        self.changed_ids.clear()
+        self.removed_ids.clear()
+        return errors
+
+    @synchronized
+    def validate_all(self):
+        """Полная проверка всех ссылок (по запросу со страницы управления данными)"""
+        errors = []
+        for section, field, target, _, message in self.REFERENCES:
+            errors += self._check_references(section, field, target, message, self.data.get(section, []))
+        return errors
+
+    def _check_references(self, section, field, target, message, records):
+        self._ensure(target)
+        live_ids = self.by_id[target]
+        return [f"{message} {record.get(field)}" for record in records if record.get(field) not in live_ids]
+
+    # --- каскадное удаление ---
+    @synchronized
+    def cascade_delete(self, section, record_ids):
+        """
+        Удаляет записи вместе с зависимыми по обратным ссылкам, не обходя разделы целиком:
+        ученик → оплаты, разовые занятия, отметки посещаемости и ссылка у родителя;
+        преподаватель → занятия расписания; занятие → его отметки. Сохранение остаётся
+        одним вызовом у вызывающего. Возвращает {раздел: число удалённых записей}.
+        """
+        record_ids = list(record_ids)
+        removed = defaultdict(int)
+        lessons = defaultdict(list)  # раздел занятий -> id удаляемых занятий
+        cells = set()
+
+        if section == 'students':
+            for student_id in record_ids:
+                student = self.get('students', student_id)
+                if student is None:
+                    continue
+                removed['payments'] += len(self.delete(
+                    'payments', [p['id'] for p in self.payments_of_student(student_id)]))
+                lessons['single_lessons'].extend(l['id'] for l in self.single_lessons_of_student(student_id))
+                cells.update((m['date'], m['lesson_id'], student_id) for m in self.attendance_of_student(student_id))
+                parent = self.get('parents', student.get('parent_id'))
+                if parent and student_id in parent.get('children_ids', []):
+                    self.update('parents', parent['id'], {
+                        'children_ids': [c for c in parent['children_ids'] if c != student_id]
+                    })
+        elif section == 'teachers':
+            for teacher_id in record_ids:
+                teacher = self.get('teachers', teacher_id)
+                if teacher is not None:
+                    lessons['schedule'].extend(l['id'] for l in self.lessons_of_teacher(teacher_id))
+        elif section in ('schedule', 'single_lessons'):
+            lessons[section].extend(record_ids)
+            record_ids = []
+
+        removed[section] += len(self.delete(section, record_ids)) if record_ids else 0
+        for lesson_section, lesson_ids in lessons.items():
+            for lesson_id in lesson_ids:
+                cells.update((m['date'], lesson_id, m['student_id']) for m in self.attendance_of_lesson(lesson_id))
+            removed[lesson_section] += len(self.delete(lesson_section, lesson_ids))
+        if cells:
+            self.remove_attendance(cells)
+            removed['attendance'] = len(cells)
+        return {name: count for name, count in removed.items() if count}
+
+def get_data_store():
+    """Индексы общего документа процесса"""
+    return get_shared_document().store
+
+
+# --- Общий документ процесса ---
+# Все сессии (ресепшен, преподаватели, администратор) работают с одним разобранным
+# документом на процесс сервера вместо отдельной загрузки Gist в каждой вкладке.
+# Страницы при отрисовке только читают документ. Каждый обработчик, который правит записи
+# (через DataStore или на месте), делает это вместе с save_data внутри committing() или
+# функции с @committed, поэтому ни правки двух сессий, ни правка и чужое сохранение не
+# перемежаются.
+SHARED_POLL_SECONDS = 30
+
+REQUIRED_KEYS = {
+    'news': [],
+    'directions': [],
+    'subdirections': [], 
+    'students': [],
+    'teachers': [],
+    'parents': [],
+    'payments': [],
+    'schedule': [],
+    'materials': [],
+    'single_lessons': [], 
+    'kanban_tasks': {'ToDo': [], 'InProgress': [], 'Done': []},
+    'attendance': {},
+    'settings': {'trial_cost': 500, 'single_cost_multiplier': 1.5},
+    '_partitions': {'gist_id': None, 'payments': {}, 'attendance': {}}
+}
+
+class SharedDocument:
+    """Документ, индексы и кэш ревизии, общие для всех сессий процесса"""
+
+    def __init__(self):
+        # lock — короткие операции с самим документом (загрузка, опрос, ревизии), его берёт
+        # каждый перезапуск страницы; write_lock — правки и сохранение, включая сериализацию.
+        # Порядок захвата: write_lock, затем lock
+        self.lock = threading.RLock()
+        self.write_lock = threading.RLock()
+        self.data = None
+        self.store = None
+        self.revision = 0
+        self.memo = {'revision': None, 'values': {}}
+        # Состояние Gist: отпечатки разделов, старая схема, последняя известная версия
+        self.fingerprints = {}
+        # Отпечатки локальных файлов разделов (None — ещё не прочитаны с диска)
+        self.local_fingerprints = None
+        self.legacy_layout = False
+        self.version = None
+        self.checked_at = 0
+        # Месяц, за который закрытые партиции уже перенесены в архив
+        self.rolled_month = None
+        # Ревизии отдельных разделов для представлений, зависящих от части документа
+        self.section_revisions = defaultdict(int)
+        self.section_memo = {}
+
+    def touch_sections(self, sections):
+        for section in sections:
+            self.section_revisions[section] += 1
+
+    def install(self, data):
+        """Делает data текущим документом процесса"""
+        with self.lock:
+            for key, default_value in REQUIRED_KEYS.items():
+                if key not in data:
+                    data[key] = json.loads(json.dumps(default_value))
+            migrate_references(data)
+            self.data = data
+            self.store = DataStore(data)
+            self.revision += 1
+            self.touch_sections(data.keys())
+            self.rolled_month = None
+
+@st.cache_resource
+def get_shared_document():
+    return SharedDocument()
+
+def committing():
+    """
+    Блокировка общего документа для обработчика, который правит записи: правка и её save_data
+    выполняются под ней целиком, поэтому сохранение другой сессии не запишет правку наполовину
+    """
+    return get_shared_document().write_lock
+
+def committed(func):
+    """Пакет изменений через DataStore и его save_data — под блокировкой общего документа"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with committing():
+            return func(*args, **kwargs)
+    return wrapper
+
+def fetch_latest_gist_version():
+    """SHA последней версии Gist (лёгкий условный запрос без содержимого файлов)"""
+    cache = get_gist_cache()
+    headers = {}
+    if cache.commits_etag:
+        headers['If-None-Match'] = cache.commits_etag
+    resp = github_client().get(
+        f"/gists/{GIST_ID}/commits",
+        headers=headers,
+        params={"per_page": 1},
+        timeout=(5, 10)
+    )
+    if resp.status_code == 304:
+        return cache.commits_version
+    resp.raise_for_status()
+    commits = resp.json()
+    cache.commits_version = commits[0]["version"] if commits else None
+    cache.commits_etag = resp.headers.get('ETag')
+    return cache.commits_version
+
+def sync_shared_document():
+    """Загружает общий документ при первом обращении и периодически сверяет его с Gist"""
+    shared = get_shared_document()
+    latest = None
+    with shared.lock:
+        if shared.data is not None and GITHUB_TOKEN and GIST_ID and time.monotonic() - shared.checked_at >= SHARED_POLL_SECONDS:
+            shared.checked_at = time.monotonic()
+            try:
+                latest = fetch_latest_gist_version()
+            except Exception:
+                latest = None  # Нет связи — продолжаем работать с тем, что есть
+            if latest and latest == get_sync_worker(GIST_ID, GITHUB_TOKEN).last_version:
+                shared.version = latest  # Это наша собственная запись
+        needs_load = shared.data is None or (latest and latest != shared.version)
+    # Замена документа и перенос закрытых месяцев — правки, поэтому под блокировкой записи
+    if needs_load:
+        with shared.write_lock, shared.lock:
+            if shared.data is None or (latest and latest != shared.version):
+                shared.install(load_data())
+                shared.checked_at = time.monotonic()
+    if shared.rolled_month != date.today().strftime('%Y-%m'):
+        with shared.write_lock:
+            if shared.rolled_month != date.today().strftime('%Y-%m'):
+                roll_due_partitions(shared)
+    return shared
+
+def reload_shared_document():
+    """Принудительно перечитывает общий документ из GitHub для всех сессий"""
+    shared = get_shared_document()
+    with shared.write_lock, shared.lock:
+        shared.install(load_data())
+        shared.checked_at = time.monotonic()
+    st.session_state.data = shared.data
+
+# --- Помесячные архивы оплат и посещаемости ---
+# В рабочем документе остаются только текущий и предыдущий месяцы. Закрытые месяцы
+# переносятся в партиции «раздел__ГГГГ-ММ.json»: локально в ARCHIVE_FOLDER и в отдельный
+# архивный Gist, чтобы основной Gist оставался маленьким. Сведения о партициях хранятся
+# в разделе '_partitions' документа, а отчёты, карточка ученика и статистика преподавателя
+# догружают архивные месяцы по запросу. Без GitHub архив не ведётся: локальная папка —
+# лишь кэш, поэтому записи остаются в рабочем документе.
+PARTITIONED_SECTIONS = ('payments', 'attendance')
+ARCHIVE_FOLDER = 'archive'
+ARCHIVE_GIST_DESCRIPTION = "Детский центр: помесячный архив оплат и посещаемости"
+
+def month_key(value):
+    """'ГГГГ-ММ' для даты в формате ISO или None, если дату не удалось распознать"""
+    text = str(value or '')[:7]
+    if len(text) == 7 and text[4] == '-' and text[:4].isdigit() and text[5:].isdigit():
+        return text
+    return None
+
+def live_window_start(today=None):
+    """Самый ранний месяц, остающийся в рабочем документе (предыдущий)"""
+    today = today or date.today()
+    return (today.replace(day=1) - timedelta(days=1)).strftime('%Y-%m')
+
+def partition_file_name(section, month):
+    return f"{section}__{month}.json"
+
+def partition_stats(section, value):
+    """Сводка партиции для '_partitions': число записей (и сумма для оплат)"""
+    if section == 'payments':
+        return {'count': len(value), 'total': sum(float(p.get('amount') or 0) for p in value)}
+    return {'count': sum(len(marks) for lessons in value.values() for marks in lessons.values())}
+
+def merge_partition(section, existing, closed):
+    """Добавляет закрытые записи к уже архивированной партиции (поздние оплаты и отметки)"""
+    if section == 'payments':
+        by_id = {p.get('id'): p for p in existing or []}
+        by_id.update((p.get('id'), p) for p in closed)
+        return sorted(by_id.values(), key=lambda p: str(p.get('date', '')))
+    merged = existing or {}
+    for day, lessons in closed.items():
+        day_marks = merged.setdefault(day, {})
+        for lesson_id, marks in lessons.items():
+            day_marks.setdefault(lesson_id, {}).update(marks)
+    return merged
+
+class PartitionArchive:
+    """Архивные партиции: кэш в памяти, локальная папка и архивный Gist"""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.texts = {}
+
+    def _keep(self, name, text):
+        with self.lock:
+            self.texts[name] = text
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            with open(os.path.join(self.folder, name), 'w', encoding='utf-8') as f:
+                f.write(text)
+        except OSError:
+            pass  # Локальная копия — только ускорение, источник истины — Gist
+
+    def _local(self, name):
+        with self.lock:
+            if name in self.texts:
+                return self.texts[name]
+        path = os.path.join(self.folder, name)
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                return f.read()
+        return None
+
+    def _download(self, gist_id):
+        """Загружает все партиции архивного Gist одним запросом"""
+        resp = github_client().get(f"/gists/{gist_id}")
+        resp.raise_for_status()
+        for name, file_info in resp.json().get("files", {}).items():
+            self._keep(name, read_gist_file(file_info))
+
+    def read(self, gist_id, section, month, expected_count=None):
+        """Партиция месяца; локальная копия перепроверяется в Gist, если не сходится число записей"""
+        name = partition_file_name(section, month)
+        text = self._local(name)
+        if text is not None and expected_count is not None:
+            if partition_stats(section, json.loads(text))['count'] != expected_count:
+                text = None  # Партицию дополнили на другом сервере
+        if text is None and gist_id and GITHUB_TOKEN:
+            self._download(gist_id)
+            text = self._local(name)
+        if text is None:
+            return [] if section == 'payments' else {}
+        with self.lock:
+            self.texts[name] = text
+        return json.loads(text)
+
+    def write(self, gist_id, partitions):
+        """
+        Записывает партиции {(раздел, месяц): значение} локально и в архивный Gist.
+        Возвращает id архивного Gist (создаёт его при первой архивации).
+        """
+        files = {partition_file_name(section, month): serialize_section(value)
+                 for (section, month), value in partitions.items()}
+        for name, text in files.items():
+            self._keep(name, text)
+        if not GITHUB_TOKEN:
+            return gist_id
+        payload = {name: {"content": text} for name, text in files.items()}
+        if gist_id:
+            resp = github_client().patch(f"/gists/{gist_id}", json={"files": payload})
+        else:
+            resp = github_client().post("/gists", json={
+                "description": ARCHIVE_GIST_DESCRIPTION, "public": False, "files": payload
+            })
+        if resp.status_code not in (200, 201):
+            raise RuntimeError(f"{resp.status_code} {resp.text[:200]}")
+        return resp.json()["id"]
+
+@st.cache_resource
+def get_partition_archive():
+    return PartitionArchive(ARCHIVE_FOLDER)
+
+def archived_months(section, data=None):
+    """Месяцы раздела, перенесённые в архив, по возрастанию"""
+    data = data if data is not None else st.session_state.data
+    return sorted(data.get('_partitions', {}).get(section, {}))
+
+def read_archived_partition(section, month, data=None):
+    """Значение архивной партиции (свежая копия, её можно изменять)"""
+    data = data if data is not None else st.session_state.data
+    meta = data.get('_partitions', {})
+    expected = meta.get(section, {}).get(month, {}).get('count')
+    return get_partition_archive().read(meta.get('gist_id'), section, month, expected)
+
+def load_archived_payments(months):
+    """Оплаты из архивных партиций указанных месяцев"""
+    payments = []
+    for month in months:
+        payments.extend(read_archived_partition('payments', month))
+    return payments
+
+def attendance_marks_on(date_key):
+    """Отметки дня {занятие: {ученик: отметка}}; для архивного месяца — из партиции с поздними правками поверх"""
+    data = st.session_state.data
+    live = data.get('attendance', {}).get(date_key, {})
+    month = month_key(date_key)
+    if month not in data.get('_partitions', {}).get('attendance', {}):
+        return live
+    day = read_archived_partition('attendance', month).get(date_key, {})
+    for lesson_id, marks in live.items():
+        day.setdefault(lesson_id, {}).update(marks)
+    return day
+
+@memoize_by_sections('_partitions')
+def get_archived_payments():
+    """Все архивные оплаты (перечитываются только при изменении состава архива)"""
+    return load_archived_payments(archived_months('payments'))
+
+@memoize_by_sections('_partitions')
+def get_archived_attendance_frame():
+    """Архивные отметки посещаемости в колонках get_attendance_frame"""
+    rows = []
+    for month in archived_months('attendance'):
+        for day, lessons in read_archived_partition('attendance', month).items():
+            for lesson_id, marks in lessons.items():
+                for student_id, mark in marks.items():
+                    rows.append((day, lesson_id, student_id, bool(mark.get('present')),
+                                 bool(mark.get('paid')), mark.get('note', '')))
+    return pd.DataFrame(rows, columns=['date', 'lesson_id', 'student_id', 'present', 'paid', 'note'])
+
+def roll_partitions(data, today=None):
+    """
+    Переносит закрытые месяцы оплат и посещаемости из data в архивные партиции.
+    Рабочие записи удаляются только после успешной записи архива в Gist и возвращаются
+    обратно, если рабочий документ сохранить не удалось. Без GitHub ничего не переносит.
+    Возвращает число перенесённых записей.
+    """
+    if not GITHUB_TOKEN:
+        return 0
+    start = live_window_start(today)
+    closed = {}
+    for payment in data.get('payments', []):
+        month = month_key(payment.get('date'))
+        if month and month < start:
+            closed.setdefault(('payments', month), []).append(payment)
+    for day, lessons in data.get('attendance', {}).items():
+        month = month_key(day)
+        if month and month < start:
+            closed.setdefault(('attendance', month), {})[day] = lessons
+    if not closed:
+        return 0
+
+    meta = data.setdefault('_partitions', {})
+    previous_meta = json.loads(json.dumps(meta))
+    merged = {}
+    for (section, month), value in closed.items():
+        existing = read_archived_partition(section, month, data) if month in meta.get(section, {}) else None
+        merged[(section, month)] = merge_partition(section, existing, value)
+    meta['gist_id'] = get_partition_archive().write(meta.get('gist_id'), merged)
+    for (section, month), value in merged.items():
+        meta.setdefault(section, {})[month] = partition_stats(section, value)
+
+    live_payments = list(data['payments'])
+    moved_payments = {id(p) for (section, _), value in closed.items() if section == 'payments' for p in value}
+    data['payments'][:] = [p for p in data['payments'] if id(p) not in moved_payments]
+    moved_days = {}
+    for (section, _), value in closed.items():
+        if section == 'attendance':
+            for day in value:
+                moved_days[day] = data['attendance'].pop(day)
+    if not save_data(data, sections=['payments', 'attendance', '_partitions']):
+        data['payments'][:] = live_payments
+        data['attendance'].update(moved_days)
+        data['_partitions'] = previous_meta
+        raise RuntimeError("рабочие данные не сохранены, закрытые месяцы оставлены в документе")
+    return sum(len(value) if section == 'payments' else partition_stats(section, value)['count']
+               for (section, _), value in closed.items())
+
+def roll_due_partitions(shared):
+    """Архивирует закрытые месяцы общего документа (после загрузки и при смене месяца)"""
+    try:
+        moved = roll_partitions(shared.data)
+        if moved:
+            st.toast(f"📦 В помесячный архив перенесено записей: {moved}")
     except Exception as e:
-        st.error(f"Ошибка сохранения: {str(e)}")
-        return False
+        st.warning(f"Не удалось перенести закрытые месяцы в архив: {str(e)}")
+    # Повторная попытка — при следующей загрузке документа или в следующем месяце
+    shared.rolled_month = date.today().strftime('%Y-%m')
 
 
 # Initialize session state for the app
-if 'data' not in st.session_state:
-    st.session_state.data = load_data()
-    required_keys = {
-        'news': [],
-        'directions': [],
-        'subdirections': [], 
-        'students': [],
-        'teachers': [],
-        'parents': [],
-        'payments': [],
-        'schedule': [],
-        'materials': [],
-        'single_lessons': [], 
-        'kanban_tasks': {'ToDo': [], 'InProgress': [], 'Done': []},
-        'attendance': {},
-        'settings': {'trial_cost': 500, 'single_cost_multiplier': 1.5}
-    }
-    
-    for key, default_value in required_keys.items():
-        if key not in st.session_state.data:
-            st.session_state.data[key] = default_value
+# Сессия получает ссылку на общий документ; новые версии из Gist подхватываются при опросе
+st.session_state.data = sync_shared_document().data
 
 session_vars = {
     'page': 'login',
@@ -319,7 +2080,7 @@ def logout():
     st.session_state.authenticated = False
     st.session_state.username = None
     st.session_state.role = None
-    st.cache_data.clear()
+    flush_pending_sync()
     st.session_state.page = 'login'
     st.info("Вы вышли из системы.")
     st.rerun()
@@ -327,6 +2088,11 @@ def logout():
 # --- Helper Functions ---
 def calculate_lessons_in_month(direction_name, selected_date):
     """Вычисляет количество занятий по направлению в текущем месяце"""
+    return count_lessons_in_month(direction_name, selected_date.year, selected_date.month)
+
+@memoize_by_revision
+def count_lessons_in_month(direction_name, year, month):
+    """Количество занятий направления в месяце (кэшируется до изменения данных)"""
     # Получаем дни недели для этого направления из расписания
     schedule_days = set()
     for lesson in st.session_state.data['schedule']:
@@ -349,8 +2115,6 @@ def calculate_lessons_in_month(direction_name, selected_date):
     
     # Считаем количество занятий в месяце
     from calendar import monthrange
-    year = selected_date.year
-    month = selected_date.month
     _, num_days = monthrange(year, month)
     
     count = 0
@@ -368,49 +2132,477 @@ def calculate_lessons_in_month(direction_name, selected_date):
     return count
 
 def get_student_by_id(student_id):
-    """Get student by ID without caching"""
-    return next((s for s in st.session_state.data['students'] if s.get('id') == student_id), None)
+    """Get student by ID via the id index"""
+    return get_data_store().get('students', student_id)
 def get_payments_for_student(student_id):
     """Get payments with immediate updates"""
-    payments = []
-    for p in st.session_state.data['payments']:
-        if p['student_id'] == student_id:
-            # Проверяем прямое направление
-            student = get_student_by_id(student_id)
-            if p['direction'] in student.get('directions', []):
-                payments.append(p)
-            # Проверяем поднаправления
-            elif any(p['direction'] == f"{s['parent']} ({s['name']})" 
-                    for s in st.session_state.data.get('subdirections', [])
-                    if s['name'] == student['name']):
-                payments.append(p)
-    return payments
-@st.cache_data
+    student = get_student_by_id(student_id)
+    if not student:
+        return []
+    subdirections = {
+        f"{s['parent']} ({s['name']})"
+        for s in st.session_state.data.get('subdirections', [])
+        if s['name'] == student['name']
+    }
+    # Прямые направления ученика и поднаправления вида "Основное направление (Имя ребенка)"
+    return [
+        p for p in get_data_store().payments_of_student(student_id)
+        if p['direction'] in student.get('directions', []) or p['direction'] in subdirections
+    ]
 def get_direction_by_id(direction_id):
-    """Get direction by ID. Uses caching to improve performance."""
-    return next((d for d in st.session_state.data['directions'] if d.get('id') == direction_id), None)
+    """Get direction by ID via the id index."""
+    return get_data_store().get('directions', direction_id)
 
-@st.cache_data
 def get_teacher_by_id(teacher_id):
-    """Get teacher by ID. Uses caching to improve performance."""
-    return next((t for t in st.session_state.data['teachers'] if t.get('id') == teacher_id), None)
+    """Get teacher by ID via the id index."""
+    return get_data_store().get('teachers', teacher_id)
 
-@st.cache_data
 def get_parent_by_id(parent_id):
-    """Get parent by ID. Uses caching to improve performance."""
-    return next((p for p in st.session_state.data['parents'] if p.get('id') == parent_id), None)
+    """Get parent by ID via the id index."""
+    return get_data_store().get('parents', parent_id)
+
+def get_direction_by_name(direction_name):
+    """Get direction by name via the name index."""
+    return get_data_store().find_by_name('directions', direction_name)
 
 def get_students_by_direction(direction_name):
     """Get students attending a specific direction."""
-    return [s for s in st.session_state.data['students'] if direction_name in s.get('directions', [])]
+    return get_data_store().students_in_direction(direction_name)
 
 def get_schedule_by_day(day):
     """Get schedule entries for a specific day."""
-    return [s for s in st.session_state.data['schedule'] if s.get('day') == day]
+    return get_data_store().lessons_on_day(day)
+
+@memoize_by_revision
+def get_subdirection_parent_map():
+    """Поднаправление вида "Основное направление (Имя)" -> основное направление"""
+    return {
+        f"{s['parent']} ({s['name']})": s['parent']
+        for s in st.session_state.data.get('subdirections', [])
+    }
+
+@memoize_by_revision
+def get_direction_student_counts():
+    """Для направлений с поднаправлениями - число поднаправлений, для обычных - число учеников"""
+    subdirection_counts = defaultdict(int)
+    for sub in st.session_state.data.get('subdirections', []):
+        subdirection_counts[sub['parent']] += 1
+    return {
+        d['name']: subdirection_counts[d['name']] or len(get_students_by_direction(d['name']))
+        for d in st.session_state.data.get('directions', [])
+    }
+
+@memoize_by_revision
+def get_lesson_catalog():
+    """Регулярные (schedule) и разовые (single_lessons) занятия по id; строится раз на ревизию данных"""
+    catalog = {l['id']: l for l in st.session_state.data.get('single_lessons', []) if 'id' in l}
+    # При совпадении id регулярное занятие важнее — как в прежнем поиске по schedule + single_lessons
+    catalog.update((l['id'], l) for l in st.session_state.data['schedule'] if 'id' in l)
+    return catalog
+
+@committed
+def delete_with_cascade(section, record_ids):
+    """Каскадное удаление записей и зависимых от них; все изменения уходят одним сохранением"""
+    store = get_data_store()
+    removed = store.cascade_delete(section, record_ids)
+    save_data(st.session_state.data, sections=sorted(store.touched))
+    return removed
+
+def schedule_resource_name(kind, resource):
+    """Преподаватель или класс из ключа ConflictIndex для сообщений"""
+    if kind == 'teacher':
+        teacher = get_data_store().get('teachers', resource)
+        return f"Преподаватель {teacher['name'] if teacher else resource}"
+    room = next((r for r in st.session_state.data.get('classrooms', []) if r['id'] == resource), None)
+    return f"Класс {room.get('name', resource) if room else resource}"
+
+def describe_schedule_conflict(kind, resource, lesson):
+    """Текст пересечения для сообщений: кто занят и каким занятием"""
+    return (f"{schedule_resource_name(kind, resource)} уже занят: {lesson.get('day')} "
+            f"{lesson.get('start_time')}-{lesson.get('end_time')} ({lesson.get('direction')})")
+
+def find_schedule_collisions(changed, schedule):
+    """Пересечения изменённых или новых занятий между собой и с остальным расписанием (один проход)"""
+    changed_ids = {lesson['id'] for lesson in changed}
+    lessons = [lesson for lesson in schedule if lesson['id'] not in changed_ids] + list(changed)
+    return [collision for collision in ConflictIndex.sweep(lessons)
+            if collision[3]['id'] in changed_ids or collision[4]['id'] in changed_ids]
+
+def get_lesson_students(lesson):
+    """Ученики занятия: для разового — его ученик, для регулярного — все ученики направления"""
+    if lesson.get('type') == 'single':
+        student = get_student_by_id(lesson.get('student_id'))
+        return [student] if student else []
+    return get_students_by_direction(lesson['direction'])
+
+@committed
+def commit_attendance(date_key, marks):
+    """Применяет пакет отметок одной транзакцией.
+
+    marks — список (lesson, student_id, {'present', 'paid', 'note'}). Оплаты за
+    разовые занятия создаются через upsert_payment (повтор не создаёт дубль), затем данные
+    записываются одним вызовом save_data. Возвращает созданные оплаты.
+    """
+    store = get_data_store()
+    attendance = st.session_state.data.setdefault('attendance', {})
+    created = []
+    for lesson, student_id, mark in marks:
+        current_paid = attendance.get(date_key, {}).get(lesson['id'], {}).get(student_id, {}).get('paid', False)
+        # Галочка оплаты поставлена впервые и платежа за этот день ещё нет
+        if (mark['paid'] and not current_paid and lesson.get('type') == 'single'
+                and not store.has_payment_on(student_id, [lesson['direction']], date_key)):
+            direction = get_direction_by_name(lesson['direction'])
+            payment, is_new = store.upsert_payment({
+                'id': str(uuid.uuid4()),
+                'student_id': student_id,
+                'date': date_key,
+                'amount': direction.get('trial_cost', 0) if direction else 0,
+                'direction': lesson['direction'],
+                'type': 'Разовое',
+                'notes': "Автоматически создано при отметке посещения"
+            })
+            if is_new:
+                created.append(payment)
+        store.set_attendance(date_key, lesson['id'], student_id, mark)
+    save_data(st.session_state.data, sections=['attendance', 'payments'] if created else ['attendance'])
+    return created
+
+@memoize_by_revision
+def get_teacher_lessons(teacher_name):
+    """Занятия преподавателя из каталога: (регулярные, разовые)"""
+    regular, single = [], []
+    for lesson in get_lesson_catalog().values():
+        if lesson.get('teacher') == teacher_name:
+            (single if 'date' in lesson else regular).append(lesson)
+    return regular, single
+
+
+# --- Календарь недели ---
+# Материализованное представление «какие занятия идут в день X»: занятия дня по времени,
+# число учеников на занятии и поминутные битовые маски занятости преподавателей и классов
+# (бит i — минута CALENDAR_START_MINUTES + i). Перестраивается только при изменении
+# расписания, разовых занятий или учеников, а не при каждом сохранении.
+WEEKDAYS = ("Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье")
+CALENDAR_START_MINUTES = 9 * 60
+CALENDAR_END_MINUTES = 20 * 60
+CALENDAR_SLOT_MINUTES = 15
+CALENDAR_SLOTS = [
+    f"{m // 60:02d}:{m % 60:02d}"
+    for m in range(CALENDAR_START_MINUTES, CALENDAR_END_MINUTES, CALENDAR_SLOT_MINUTES)
+]
+CALENDAR_DAY_MASK = (1 << (CALENDAR_END_MINUTES - CALENDAR_START_MINUTES)) - 1
+
+def weekday_name(day):
+    """Русское название дня недели для даты"""
+    return WEEKDAYS[day.weekday()]
+
+def time_to_minutes(value):
+    parsed = safe_time_parse(str(value))
+    return parsed.hour * 60 + parsed.minute
+
+def minutes_to_time(minutes):
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+def minute_mask(start, end):
+    """Биты минут [start, end) рабочего дня календаря"""
+    first = max(start, CALENDAR_START_MINUTES) - CALENDAR_START_MINUTES
+    last = min(end, CALENDAR_END_MINUTES) - CALENDAR_START_MINUTES
+    return ((1 << (last - first)) - 1) << first if last > first else 0
+
+def fit_mask(free, duration):
+    """Минуты, начиная с которых свободно подряд не меньше duration минут (сдвиги с удвоением)"""
+    run, span = free, 1
+    while span < duration:
+        step = min(span, duration - span)
+        run &= run >> step
+        span += step
+    return run
+
+def mask_slots(mask):
+    """Слоты сетки CALENDAR_SLOTS, чья начальная минута отмечена в маске"""
+    return [slot for i, slot in enumerate(CALENDAR_SLOTS) if mask >> (i * CALENDAR_SLOT_MINUTES) & 1]
+
+class CalendarDay:
+    """Занятия одного дня по времени начала с числом учеников и масками занятости (по id преподавателя и класса)"""
+
+    def __init__(self):
+        self.lessons = []
+        self.student_counts = {}
+        self.teacher_busy = defaultdict(int)
+        self.classroom_busy = defaultdict(int)
+
+    def add(self, lesson, students):
+        mask = minute_mask(time_to_minutes(lesson.get('start_time', '00:00')),
+                           time_to_minutes(lesson.get('end_time', '00:00')))
+        self.lessons.append(lesson)
+        self.student_counts[lesson['id']] = students
+        self.teacher_busy[lesson.get('teacher_id')] |= mask
+        if lesson.get('classroom'):
+            self.classroom_busy[lesson['classroom']] |= mask
+
+    def sort(self):
+        self.lessons.sort(key=lambda l: time_to_minutes(l.get('start_time', '00:00')))
+
+    def copy(self):
+        day = CalendarDay()
+        day.lessons = list(self.lessons)
+        day.student_counts = dict(self.student_counts)
+        day.teacher_busy = defaultdict(int, self.teacher_busy)
+        day.classroom_busy = defaultdict(int, self.classroom_busy)
+        return day
+
+    def free_mask(self, teacher_ids=(), classroom_ids=()):
+        """Минуты, в которые свободны все перечисленные преподаватели и классы"""
+        busy = 0
+        for teacher_id in teacher_ids:
+            busy |= self.teacher_busy.get(teacher_id, 0)
+        for classroom_id in classroom_ids:
+            busy |= self.classroom_busy.get(classroom_id, 0)
+        return CALENDAR_DAY_MASK & ~busy
+
+    def free_starts(self, duration, teacher_ids=(), classroom_ids=()):
+        """Слоты, с которых все перечисленные ресурсы свободны duration минут подряд"""
+        return mask_slots(fit_mask(self.free_mask(teacher_ids, classroom_ids), duration))
+
+    def any_free_starts(self, duration, teacher_ids, classroom_ids):
+        """Слоты, с которых свободны хотя бы один из преподавателей и хотя бы один из классов"""
+        teachers = 0
+        for teacher_id in teacher_ids:
+            teachers |= fit_mask(self.free_mask(teacher_ids=[teacher_id]), duration)
+        classrooms = 0
+        for classroom_id in classroom_ids:
+            classrooms |= fit_mask(self.free_mask(classroom_ids=[classroom_id]), duration)
+        return mask_slots(teachers & classrooms)
+
+    def free_resources(self, start, duration, teacher_ids=(), classroom_ids=()):
+        """Какие из перечисленных преподавателей и классов свободны в окне [start, start + duration)"""
+        window = minute_mask(start, start + duration)
+        return ([t for t in teacher_ids if not self.teacher_busy.get(t, 0) & window],
+                [c for c in classroom_ids if not self.classroom_busy.get(c, 0) & window])
+
+@memoize_by_sections('schedule', 'students')
+def get_week_calendar():
+    """Регулярные занятия по дням недели: день -> CalendarDay"""
+    calendar = {day: CalendarDay() for day in WEEKDAYS}
+    counts = {}
+    for lesson in get_data_store().records('schedule'):
+        day = calendar.get(lesson.get('day'))
+        if day is None:
+            continue
+        direction = lesson.get('direction')
+        if direction not in counts:
+            counts[direction] = len(get_students_by_direction(direction))
+        day.add(lesson, counts[direction])
+    for day in calendar.values():
+        day.sort()
+    return calendar
+
+@memoize_by_sections('single_lessons')
+def get_single_lessons_by_date():
+    by_date = defaultdict(list)
+    for lesson in get_data_store().records('single_lessons'):
+        by_date[lesson.get('date')].append(lesson)
+    return by_date
+
+@memoize_by_sections('schedule', 'single_lessons', 'students')
+def get_day_calendar(date_str):
+    """Все занятия даты 'ГГГГ-ММ-ДД': регулярные дня недели и разовые (с type='single')"""
+    weekday = weekday_name(datetime.strptime(date_str, "%Y-%m-%d").date())
+    day = get_week_calendar()[weekday].copy()
+    for lesson in get_single_lessons_by_date().get(date_str, []):
+        day.add({**lesson, 'day': weekday, 'type': 'single'}, 1)
+    day.sort()
+    return day
+
+@memoize_by_sections('directions', 'teachers', 'classrooms')
+def get_direction_resources():
+    """Направление -> (id преподавателей, id классов), которые могут его вести"""
+    resources = {}
+    classrooms = get_data_store().records('classrooms')
+    default_rooms = [r['id'] for r in classrooms if r.get('name') == 'Малый класс']
+    for direction in get_data_store().records('directions'):
+        name = direction['name']
+        teachers = [t['id'] for t in get_data_store().records('teachers') if name in t.get('directions', [])]
+        rooms = [r['id'] for r in classrooms if name in r.get('directions', [])]
+        resources[name] = (teachers, rooms or default_rooms)
+    return resources
+
+def search_week_availability(directions, start_date, weekdays, window_start, window_end, duration=45):
+    """Пакетный поиск на 7 дней вперёд: для каждого направления — дни, где есть группа в окне
+    или свободные преподаватель и класс на duration минут. Маска свободных стартов каждого
+    преподавателя и класса считается один раз на дату и переиспользуется всеми направлениями.
+    Возвращает список, отсортированный по числу подходящих дней, групп и слотов."""
+    starts = minute_mask(window_start, window_end - duration + 1)
+    resources = get_direction_resources()
+    results = {d['name']: {'direction': d, 'days': [], 'groups': 0, 'slots': 0} for d in directions}
+    for offset in range(7):
+        current = start_date + timedelta(days=offset)
+        if weekday_name(current) not in weekdays:
+            continue
+        calendar_day = get_day_calendar(current.strftime("%Y-%m-%d"))
+        teacher_fit, room_fit = {}, {}
+        for name, result in results.items():
+            teacher_ids, room_ids = resources.get(name, ([], []))
+            teachers = rooms = 0
+            for teacher_id in teacher_ids:
+                if teacher_id not in teacher_fit:
+                    teacher_fit[teacher_id] = fit_mask(calendar_day.free_mask(teacher_ids=[teacher_id]), duration)
+                teachers |= teacher_fit[teacher_id]
+            for room_id in room_ids:
+                if room_id not in room_fit:
+                    room_fit[room_id] = fit_mask(calendar_day.free_mask(classroom_ids=[room_id]), duration)
+                rooms |= room_fit[room_id]
+            slots = mask_slots(teachers & rooms & starts)
+            groups = [
+                l for l in calendar_day.lessons
+                if l.get('type') != 'single' and l.get('direction') == name
+                and window_start <= time_to_minutes(l['start_time']) < window_end
+            ]
+            if slots or groups:
+                result['days'].append({'date': current, 'groups': groups, 'slots': slots})
+                result['groups'] += len(groups)
+                result['slots'] += len(slots)
+    ranked = [r for r in results.values() if r['days']]
+    ranked.sort(key=lambda r: (-len(r['days']), -r['groups'], -r['slots'], r['direction']['name']))
+    return ranked
+
+@memoize_by_revision
+def get_attendance_frame():
+    """
+    Отметки посещаемости одной таблицей: рабочие (прямо из колонок AttendanceTable)
+    и архивные месяцы, догружаемые из партиций
+    """
+    table = get_data_store().attendance()
+    rows = np.fromiter(sorted(table.live.values()), dtype=np.int64, count=len(table.live))
+    live = pd.DataFrame({
+        'date': np.asarray(table.dates, dtype=object)[rows],
+        'lesson_id': np.asarray(table.lesson_ids, dtype=object)[rows],
+        'student_id': np.asarray(table.student_ids, dtype=object)[rows],
+        'present': np.frombuffer(table.present, dtype=np.int8)[rows].astype(bool),
+        'paid': np.frombuffer(table.paid, dtype=np.int8)[rows].astype(bool),
+        'note': np.asarray(table.notes, dtype=object)[rows]
+    })
+    archived = get_archived_attendance_frame()
+    if archived.empty:
+        return live
+    return pd.concat([live, archived], ignore_index=True).drop_duplicates(
+        ['date', 'lesson_id', 'student_id'], keep='first', ignore_index=True)
+
+TEACHER_ATTENDANCE_COLUMNS = ['Направление', 'Ученик', 'Дата', 'Занятие', 'Присутствовал', 'Оплачено', 'Примечание', 'Тип']
+
+@memoize_by_revision
+def get_teacher_attendance_frame(teacher_name):
+    """
+    Посещения занятий преподавателя по всем его направлениям сразу.
+    Столбец 'Направление' — основное направление (поднаправления сведены к нему).
+    Оплата: отметка 'paid', абонемент месяца или разовая/пробная оплата дня по направлению
+    либо его поднаправлениям; для разовых занятий — любая оплата в этот день по направлению.
+    """
+    direction_map = get_subdirection_parent_map()
+    regular, single = get_teacher_lessons(teacher_name)
+    attendance = get_attendance_frame()
+    students = pd.DataFrame(st.session_state.data['students'], columns=None if st.session_state.data['students'] else ['id', 'name', 'directions'])
+    student_names = students.set_index('id')['name'] if not students.empty else pd.Series(dtype=object)
+
+    all_payments = st.session_state.data['payments'] + get_archived_payments()
+    payments = pd.DataFrame(all_payments, columns=None if all_payments else ['student_id', 'direction', 'date', 'type'])
+    payments['day'] = payments['date'].astype(str).str[:10]
+    payments['month'] = payments['day'].str[:7]
+    payments['main'] = payments['direction'].map(lambda d: direction_map.get(d, d))
+
+    frames = []
+    if regular:
+        lessons = pd.DataFrame(regular)[['id', 'direction', 'start_time', 'end_time']].rename(columns={'id': 'lesson_id'})
+        lessons['main'] = lessons['direction'].map(lambda d: direction_map.get(d, d))
+        marks = attendance.merge(lessons, on='lesson_id')
+
+        # Учитываются только ученики, записанные на направление или его поднаправление
+        enrolled = students[['id', 'directions']].explode('directions').dropna()
+        enrolled = pd.concat([
+            pd.DataFrame({
+                'student_id': enrolled['id'],
+                'main': enrolled['directions'].map(lambda d: direction_map.get(d, d))
+            }),
+            # Ученики разовых занятий тоже считаются учениками направления
+            pd.DataFrame({'student_id': [l['student_id'] for l in single],
+                          'main': [l['direction'] for l in single]})
+        ]).drop_duplicates()
+        marks = marks.merge(enrolled, on=['student_id', 'main'])
+        marks['month'] = marks['date'].str[:7]
+
+        subscriptions = payments.loc[payments['type'].isin(DataStore.SUBSCRIPTION_TYPES), ['student_id', 'main', 'month']]
+        singles = payments.loc[payments['type'].isin(DataStore.SINGLE_PAYMENT_TYPES), ['student_id', 'main', 'day']]
+        by_month = marks.merge(subscriptions.drop_duplicates().assign(_month_paid=True),
+                               on=['student_id', 'main', 'month'], how='left')['_month_paid'].notna().to_numpy()
+        by_day = marks.merge(singles.rename(columns={'day': 'date'}).drop_duplicates().assign(_day_paid=True),
+                             on=['student_id', 'main', 'date'], how='left')['_day_paid'].notna().to_numpy()
+        marks['paid'] = marks['paid'].to_numpy() | by_month | by_day
+
+        frames.append(pd.DataFrame({
+            'Направление': marks['main'],
+            'Ученик': marks['student_id'].map(student_names),
+            'Дата': marks['date'],
+            'Занятие': marks['start_time'] + '-' + marks['end_time'],
+            'Присутствовал': np.where(marks['present'], 'Да', 'Нет'),
+            'Оплачено': np.where(marks['paid'], 'Да', 'Нет'),
+            'Примечание': marks['note'],
+            'Тип': np.where(marks['direction'] != marks['main'], 'Поднаправление', 'Основное')
+        }))
+
+    if single:
+        lessons = pd.DataFrame(single)
+        lessons = lessons.assign(notes=lessons['notes'] if 'notes' in lessons else '')
+        lessons = lessons[lessons['student_id'].isin(student_names.index)]
+        lessons = lessons.rename(columns={'id': 'lesson_id'}).merge(
+            attendance, on=['date', 'lesson_id', 'student_id'], how='left')
+        paid_days = payments[['student_id', 'direction', 'day']].drop_duplicates().rename(columns={'day': 'date'})
+        day_paid = lessons.merge(paid_days.assign(_paid=True), on=['student_id', 'direction', 'date'],
+                                 how='left')['_paid'].notna().to_numpy()
+        paid = lessons['paid'].fillna(False).astype(bool).to_numpy() | day_paid
+        note = lessons['note'].fillna('').astype(str)
+        frames.append(pd.DataFrame({
+            'Направление': lessons['direction'],
+            'Ученик': lessons['student_id'].map(student_names),
+            'Дата': lessons['date'],
+            'Занятие': lessons['start_time'] + '-' + lessons['end_time'],
+            'Присутствовал': np.where(lessons['present'].fillna(False).astype(bool), 'Да', 'Нет'),
+            'Оплачено': np.where(paid, 'Да', 'Нет'),
+            'Примечание': note.where(note != '', lessons['notes'].fillna('')),
+            'Тип': 'Разовое занятие'
+        }))
+
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=TEACHER_ATTENDANCE_COLUMNS)
+    df['Дата'] = pd.to_datetime(df['Дата'])
+    return df.sort_values('Дата', ascending=False, kind='stable')
+
+@memoize_by_revision
+def get_payments_frame():
+    """Таблица оплат с разобранными датами и именами учеников для отчётов"""
+    return build_payments_frame(st.session_state.data['payments'])
+
+@memoize_by_revision
+def get_archived_payments_frame(months):
+    """Та же таблица для архивных месяцев (партиции догружаются при первом обращении)"""
+    return build_payments_frame(load_archived_payments(months))
+
+PAYMENT_FRAME_COLUMNS = ['id', 'student_id', 'date', 'amount', 'direction', 'type', 'notes']
+
+def build_payments_frame(payments):
+    df_payments = pd.DataFrame(payments, columns=None if payments else PAYMENT_FRAME_COLUMNS)
+    df_payments['date'] = pd.to_datetime(df_payments['date'])
+    student_id_to_name = {s['id']: s['name'] for s in st.session_state.data['students']}
+    df_payments['student'] = df_payments['student_id'].map(student_id_to_name)
+    return df_payments
+
+@memoize_by_revision
+def get_materials_frame():
+    """Таблица закупок с разобранными датами для отчёта"""
+    df_materials = pd.DataFrame(st.session_state.data['materials'])
+    df_materials['date'] = pd.to_datetime(df_materials['date'])
+    return df_materials
 def refresh_data():
-    """Полностью перезагружает данные и очищает кэш"""
-    st.cache_data.clear()
-    st.session_state.data = load_data()
+    """Полностью перезагружает данные для всех сессий (новый объект данных сбрасывает кэш ревизии)"""
+    reload_shared_document()
     st.rerun()
 def calculate_age(birth_date):
     """Корректный расчёт возраста."""
@@ -442,46 +2634,356 @@ def suggest_directions(age, gender=None):
 def show_gist_history():
     """Выводит историю изменений Gist через GitHub API"""
     gist_id = st.secrets["GIST_ID"]
-    commits_url = f"{GITHUB_API}/gists/{gist_id}/commits"
 
     try:
-        commits_resp = requests.get(commits_url, headers=github_headers())
-        commits_resp.raise_for_status()
-        commits = commits_resp.json()
+        client = github_client()
+        cache = get_version_cache()
+        commits = cache.list_versions(client, gist_id, 1)
+        documents = cache.fetch_many(client, gist_id, [commit["version"] for commit in commits])
 
         st.write("Последние изменения:")
         for commit in commits:
-            commit_id = commit["version"]
-            committed_at = commit["committed_at"]
-
-            # Загружаем содержимое конкретной версии
-            gist_version_url = f"{GITHUB_API}/gists/{gist_id}/{commit_id}"
-            gist_version_resp = requests.get(gist_version_url, headers=github_headers())
-            gist_version_resp.raise_for_status()
-
-            files = gist_version_resp.json().get("files", {})
-            content = files.get("center_data.json", {}).get("content", "")
+            document = documents.get(commit["version"])
+            if isinstance(document, Exception):
+                raise document
+            content = json.dumps(document, indent=4, ensure_ascii=False) if document is not None else ""
 
-            st.write(f"Версия от {committed_at}:")
+            st.write(f"Версия от {commit['committed_at']}:")
             st.code(content[:200] + "...")  # Показываем начало файла
 
     except Exception as e:
         st.error(f"Ошибка при загрузке истории Gist: {str(e)}")
 
+# --- Автоматическое расписание ---
+# Локальный поиск недельного расписания. Каждое регулярное занятие — переменная
+# (день, слот начала, преподаватель, класс) на 15-минутной сетке календаря недели.
+# Занятость преподавателей и классов хранится в массивах [ресурс, день, слот], поэтому
+# все возможные ходы одного занятия оцениваются одним векторным проходом по префиксным суммам.
+SOLVER_CONFLICT_WEIGHT = 1000   # пересечение по преподавателю/классу или вне доступности, за слот
+SOLVER_SAME_DAY_WEIGHT = 10     # второе занятие направления в тот же день
+SOLVER_MOVE_WEIGHT = 1          # отличие от текущего расписания (день/время, преподаватель, класс)
+SOLVER_NOISE = 0.05             # доля случайных ходов для выхода из локальных минимумов
+
+def parse_availability(value):
+    """Строка вида "10:00-14:00, 16:00-20:00" -> минутная маска рабочего дня календаря"""
+    mask = 0
+    for part in str(value or '').split(','):
+        if '-' in part:
+            start, end = part.split('-', 1)
+            mask |= minute_mask(time_to_minutes(start.strip()), time_to_minutes(end.strip()))
+    return mask
+
+def format_availability(teacher, day):
+    """Доступность преподавателя в день недели строкой; без настроек — весь рабочий день"""
+    availability = teacher.get('availability')
+    if availability is None:
+        return f"{minutes_to_time(CALENDAR_START_MINUTES)}-{minutes_to_time(CALENDAR_END_MINUTES)}"
+    return availability.get(day, '')
+
+class ScheduleSolver:
+    """Недельное расписание без пересечений преподавателей и классов.
+
+    Стартует с текущего расписания: закреплённые занятия (pinned) не двигаются, остальные
+    переставляются, только если это убирает конфликты или нарушения доступности, поэтому
+    повторный запуск после переноса или закрепления одного занятия трогает лишь то, что
+    с ним пересекается. Если у направления задано lessons_per_week, недостающие занятия
+    добавляются, а лишние незакреплённые — предлагаются к удалению."""
+
+    def __init__(self, data, seed=None):
+        self.random = np.random.default_rng(seed)
+        self.slots = len(CALENDAR_SLOTS)
+        self.teachers = list(data.get('teachers', []))
+        self.rooms = list(data.get('classrooms', []))
+        self.teacher_index = {t['id']: i for i, t in enumerate(self.teachers)}
+        self.room_index = {r['id']: i for i, r in enumerate(self.rooms)}
+        # Доступные слоты преподавателей: слот свободен, если свободны все его минуты
+        slot_bits = (1 << CALENDAR_SLOT_MINUTES) - 1
+        self.available = np.ones((len(self.teachers), len(WEEKDAYS), self.slots), dtype=np.int32)
+        for i, teacher in enumerate(self.teachers):
+            for d, day in enumerate(WEEKDAYS):
+                mask = parse_availability(format_availability(teacher, day))
+                self.available[i, d] = [mask >> (k * CALENDAR_SLOT_MINUTES) & slot_bits == slot_bits
+                                        for k in range(self.slots)]
+        self.teacher_occ = np.zeros((len(self.teachers), len(WEEKDAYS), self.slots), dtype=np.int32)
+        self.room_occ = np.zeros((max(len(self.rooms), 1), len(WEEKDAYS), self.slots), dtype=np.int32)
+        self.units = []
+        self.removed = []
+        self.unplaced = []
+        self._build_units(data)
+        self.direction_day = np.zeros((len(self.direction_names), len(WEEKDAYS)), dtype=np.int32)
+        for unit in self.units:
+            if unit['state'] is not None:
+                self._place(unit, unit['state'])
+        self.initial_conflicts = self.conflicted_units()
+        # Занятиям без класса назначаем наименее занятый подходящий класс на их же время
+        for unit in self.units:
+            if unit['state'] is not None and unit['state'][3] < 0 <= unit['rooms'][0]:
+                day, slot, teacher, _ = unit['state']
+                self._place(unit, unit['state'], -1)
+                load = self.room_occ[unit['rooms'], day, slot:slot + unit['length']].sum(axis=1)
+                self._place(unit, (day, slot, teacher, int(unit['rooms'][np.argmin(load)])))
+
+    def _build_units(self, data):
+        parents = {f"{s['parent']} ({s['name']})": s['parent'] for s in data.get('subdirections', [])}
+        directions = {d['name']: d for d in data.get('directions', [])}
+        group_sizes = defaultdict(int)
+        for student in data.get('students', []):
+            for name in student.get('directions', []):
+                group_sizes[name] += 1
+        by_direction = defaultdict(list)
+        for lesson in data.get('schedule', []):
+            by_direction[lesson.get('direction')].append(lesson)
+        for name, direction in directions.items():
+            if direction.get('lessons_per_week'):
+                by_direction.setdefault(name, [])
+        self.direction_names = list(by_direction)
+
+        for index, (name, lessons) in enumerate(by_direction.items()):
+            main = parents.get(name, name)
+            teachers = [i for i, t in enumerate(self.teachers)
+                        if name in t.get('directions', []) or main in t.get('directions', [])]
+            size = group_sizes[name]
+            fitting = [i for i, r in enumerate(self.rooms) if r.get('capacity') is None or r['capacity'] >= size]
+            rooms = ([i for i in fitting if name in self.rooms[i].get('directions', [])
+                      or main in self.rooms[i].get('directions', [])] or fitting or list(range(len(self.rooms))))
+            wanted = directions[name].get('lessons_per_week') if name in directions else None
+            if wanted is not None and wanted < len(lessons):
+                # Лишние занятия убираем с конца, закреплённые не трогаем
+                extra = len(lessons) - int(wanted)
+                for lesson in reversed(list(lessons)):
+                    if extra and not lesson.get('pinned'):
+                        lessons.remove(lesson)
+                        self.removed.append(lesson)
+                        extra -= 1
+            default_duration = (directions.get(main, {}).get('lesson_duration') or
+                                (time_to_minutes(lessons[0]['end_time']) - time_to_minutes(lessons[0]['start_time'])
+                                 if lessons else 45))
+            for lesson in list(lessons) + [None] * max(0, int(wanted or 0) - len(lessons)):
+                duration = default_duration
+                origin = None
+                if lesson is not None:
+                    start = time_to_minutes(lesson.get('start_time', '00:00'))
+                    duration = time_to_minutes(lesson.get('end_time', '00:00')) - start
+                    origin = self._origin(lesson, start, duration)
+                unit_teachers = list(teachers)
+                unit_rooms = list(rooms)
+                if origin is not None:
+                    if origin[2] is not None and origin[2] not in unit_teachers:
+                        unit_teachers.append(origin[2])
+                    if origin[3] is not None and origin[3] not in unit_rooms:
+                        unit_rooms.append(origin[3])
+                unit = {
+                    'lesson': lesson,
+                    'direction': name,
+                    'direction_index': index,
+                    'duration': max(duration, CALENDAR_SLOT_MINUTES),
+                    'length': -(-max(duration, CALENDAR_SLOT_MINUTES) // CALENDAR_SLOT_MINUTES),
+                    'teachers': np.array(unit_teachers, dtype=np.int64),
+                    'rooms': np.array(unit_rooms or [-1], dtype=np.int64),
+                    'pinned': bool(lesson and lesson.get('pinned')),
+                    'origin': origin,
+                    'state': None,
+                }
+                if not unit_teachers or unit['length'] > self.slots:
+                    self.unplaced.append(unit)
+                    continue
+                if origin is not None and origin[2] is not None and origin[1] + unit['length'] <= self.slots:
+                    unit['state'] = (origin[0], origin[1], origin[2], origin[3] if origin[3] is not None else -1)
+                elif unit['pinned']:
+                    self.unplaced.append(unit)
+                    continue
+                self.units.append(unit)
+
+    def _origin(self, lesson, start, duration):
+        """(день, слот, преподаватель, класс) текущего занятия или None, если оно вне сетки"""
+        if lesson.get('day') not in WEEKDAYS or not CALENDAR_START_MINUTES <= start < CALENDAR_END_MINUTES:
+            return None
+        return (WEEKDAYS.index(lesson['day']),
+                (start - CALENDAR_START_MINUTES) // CALENDAR_SLOT_MINUTES,
+                self.teacher_index.get(lesson.get('teacher_id')),
+                self.room_index.get(lesson.get('classroom')))
+
+    def _place(self, unit, state, sign=1):
+        day, slot, teacher, room = state
+        window = slice(slot, slot + unit['length'])
+        self.teacher_occ[teacher, day, window] += sign
+        if room >= 0:
+            self.room_occ[room, day, window] += sign
+        self.direction_day[unit['direction_index'], day] += sign
+        unit['state'] = state if sign > 0 else None
+
+    @staticmethod
+    def _windows(grid, length):
+        """Суммы по всем окнам длины length вдоль оси слотов"""
+        prefix = np.concatenate([np.zeros(grid.shape[:-1] + (1,), dtype=grid.dtype), grid.cumsum(axis=-1)], axis=-1)
+        return prefix[..., length:] - prefix[..., :-length]
+
+    def _costs(self, unit):
+        """Стоимость каждого хода [преподаватель, класс, день, слот] для снятого с сетки занятия"""
+        length = unit['length']
+        teacher_cost = (self._windows(self.teacher_occ[unit['teachers']], length) +
+                        self._windows(1 - self.available[unit['teachers']], length))
+        rooms = unit['rooms']
+        room_cost = self._windows(self.room_occ[np.maximum(rooms, 0)], length) * (rooms >= 0)[:, None, None]
+        costs = SOLVER_CONFLICT_WEIGHT * (teacher_cost[:, None] + room_cost[None, :])
+        costs = costs + SOLVER_SAME_DAY_WEIGHT * self.direction_day[unit['direction_index']][None, None, :, None]
+        origin = unit['origin']
+        if origin is not None:
+            moved = np.ones(costs.shape[2:], dtype=np.int64)
+            if origin[1] < moved.shape[1]:
+                moved[origin[0], origin[1]] = 0
+            costs = costs + SOLVER_MOVE_WEIGHT * moved[None, None]
+            if origin[2] is not None:
+                costs = costs + SOLVER_MOVE_WEIGHT * (unit['teachers'] != origin[2])[:, None, None, None]
+            if origin[3] is not None:
+                costs = costs + SOLVER_MOVE_WEIGHT * (rooms != origin[3])[None, :, None, None]
+        return costs
+
+    def _unit_conflict(self, unit):
+        """Есть ли у размещённого занятия пересечение или выход за доступность преподавателя"""
+        day, slot, teacher, room = unit['state']
+        window = slice(slot, slot + unit['length'])
+        return bool((self.teacher_occ[teacher, day, window] > 1).any() or
+                    (room >= 0 and (self.room_occ[room, day, window] > 1).any()) or
+                    (not unit['pinned'] and not self.available[teacher, day, window].all()))
+
+    def conflicted_units(self):
+        return [unit for unit in self.units if unit['state'] is not None and self._unit_conflict(unit)]
+
+    def total_cost(self):
+        conflicts = (np.maximum(self.teacher_occ - 1, 0).sum() + np.maximum(self.room_occ - 1, 0).sum())
+        # Слоты вне доступности преподавателя — то же нарушение, что проверяет _unit_conflict
+        for unit in self.units:
+            if unit['state'] is not None and not unit['pinned']:
+                day, slot, teacher, _ = unit['state']
+                conflicts += unit['length'] - self.available[teacher, day, slot:slot + unit['length']].sum()
+        same_day = np.maximum(self.direction_day - 1, 0).sum()
+        return int(SOLVER_CONFLICT_WEIGHT * conflicts + SOLVER_SAME_DAY_WEIGHT * same_day)
+
+    def pin(self, lesson_id, day, start_time):
+        """Переносит занятие на день и время и закрепляет его перед повторным решением"""
+        for unit in self.units:
+            if unit['lesson'] is not None and unit['lesson']['id'] == lesson_id:
+                slot = (time_to_minutes(start_time) - CALENDAR_START_MINUTES) // CALENDAR_SLOT_MINUTES
+                slot = min(max(slot, 0), self.slots - unit['length'])
+                teacher, room = int(unit['teachers'][0]), int(unit['rooms'][0])
+                if unit['state'] is not None:
+                    teacher, room = unit['state'][2:]
+                    self._place(unit, unit['state'], -1)
+                self._place(unit, (WEEKDAYS.index(day), slot, teacher, room))
+                unit['pinned'] = True
+                return unit
+
+    def _move(self, unit, noise):
+        costs = self._costs(unit)
+        if noise:
+            choice = tuple(self.random.integers(0, n) for n in costs.shape)
+        else:
+            # Случайный шум меньше единицы веса разбивает ничьи между равными ходами
+            choice = np.unravel_index(np.argmin(costs + self.random.random(costs.shape) * 0.5), costs.shape)
+        t, r, day, slot = (int(x) for x in choice)
+        self._place(unit, (day, slot, int(unit['teachers'][t]), int(unit['rooms'][r])))
+
+    def solve(self, time_budget=3.0):
+        """Локальный поиск min-conflicts с шумом до исчерпания бюджета времени (в секундах)"""
+        started = time.monotonic()
+        movable = [unit for unit in self.units if not unit['pinned']]
+        for unit in movable:
+            if unit['state'] is None:
+                self._move(unit, noise=False)
+        best_cost, best = self._objective(), [unit['state'] for unit in self.units]
+        idle = 0
+        while movable and time.monotonic() - started < time_budget and idle < 50 * len(movable):
+            conflicted = [unit for unit in movable if self._unit_conflict(unit)]
+            pool = conflicted if conflicted and self.random.random() > SOLVER_NOISE else movable
+            unit = pool[self.random.integers(len(pool))]
+            self._place(unit, unit['state'], -1)
+            self._move(unit, noise=self.random.random() < SOLVER_NOISE)
+            cost = self._objective()
+            if cost < best_cost:
+                best_cost, best, idle = cost, [u['state'] for u in self.units], 0
+            else:
+                idle += 1
+        for unit, state in zip(self.units, best):
+            self._place(unit, unit['state'], -1)
+        for unit, state in zip(self.units, best):
+            self._place(unit, state)
+        self.elapsed = time.monotonic() - started
+        return self.proposal()
+
+    def _objective(self):
+        """Стоимость расстановки вместе со штрафом за отличия от текущего расписания"""
+        return self.total_cost() + SOLVER_MOVE_WEIGHT * sum(self._moved(unit) for unit in self.units)
+
+    @staticmethod
+    def _moved(unit):
+        origin, state = unit['origin'], unit['state']
+        if origin is None:
+            return 1
+        return (origin[:2] != state[:2]) + (origin[2] != state[2]) + (origin[3] is not None and origin[3] != state[3])
+
+    def proposal(self):
+        """Итоговые занятия: статус 'new', 'moved' или 'same' и поля для записи в расписание"""
+        rows = []
+        for unit in self.units:
+            day, slot, teacher, room = unit['state']
+            start = CALENDAR_START_MINUTES + slot * CALENDAR_SLOT_MINUTES
+            lesson = unit['lesson']
+            origin = unit['origin']
+            row = {
+                'id': lesson['id'] if lesson else str(uuid.uuid4()),
+                'direction': unit['direction'],
+                'day': WEEKDAYS[day],
+                'start_time': lesson['start_time'] if origin and origin[:2] == (day, slot) else minutes_to_time(start),
+                'end_time': (lesson['end_time'] if origin and origin[:2] == (day, slot)
+                             else minutes_to_time(start + unit['duration'])),
+                'teacher_id': self.teachers[teacher]['id'],
+                'teacher': self.teachers[teacher]['name'],
+                'classroom': self.rooms[room]['id'] if room >= 0 else None,
+                'classroom_name': self.rooms[room].get('name', '') if room >= 0 else '',
+                'pinned': unit['pinned'],
+                'conflict': self._unit_conflict(unit),
+            }
+            if lesson is None:
+                row['status'] = 'new'
+            elif (row['day'], row['start_time'], row['teacher_id'], row['classroom'], row['pinned']) == (
+                    lesson.get('day'), lesson.get('start_time'), lesson.get('teacher_id'),
+                    lesson.get('classroom'), bool(lesson.get('pinned'))):
+                row['status'] = 'same'
+            else:
+                row['status'] = 'moved'
+            rows.append(row)
+        rows.sort(key=lambda row: (WEEKDAYS.index(row['day']), row['start_time'], row['direction']))
+        return rows
+
+@committed
+def apply_schedule_proposal(rows, removed_ids):
+    """Записывает предложенное расписание одним сохранением"""
+    store = get_data_store()
+    for row in rows:
+        fields = {k: row[k] for k in ('direction', 'day', 'start_time', 'end_time', 'teacher', 'teacher_id',
+                                      'classroom', 'pinned')}
+        if row['status'] == 'new':
+            store.insert('schedule', {'id': row['id'], **fields})
+        elif row['status'] == 'moved':
+            store.update('schedule', row['id'], fields)
+    store.cascade_delete('schedule', removed_ids)
+    save_data(st.session_state.data, sections=sorted(store.touched | {'schedule'}))
+
 # Проверка соединения с GitHub (только для админов)
 if st.session_state.get('authenticated') and st.session_state.role == 'admin':
     if st.sidebar.button("Проверить GitHub соединение"):
         try:
-            resp = requests.get(f"https://api.github.com/gists/{GIST_ID}", headers=github_headers())
-            if resp.status_code == 200:
-                gist = resp.json()
-                content_preview = gist["files"]["center_data.json"]["content"][:200] + "..." if "center_data.json" in gist["files"] else "Файл не найден"
-                st.sidebar.success("✅ Соединение с GitHub установлено")
-                st.sidebar.markdown(f"**Последнее обновление:** {gist['updated_at']}")
-                st.sidebar.markdown(f"**Размер данных:** {len(content_preview)/1024:.1f} KB")
-                st.sidebar.text_area("Предпросмотр данных", content_preview, height=100)
-            else:
-                st.sidebar.error(f"❌ Ошибка подключения: {resp.status_code} {resp.text}")
+            document, gist_meta, modified = fetch_gist_document()
+            data_files = gist_meta['files']
+            content_preview = serialize_section(document)[:200] + "..." if document is not None else "Файл не найден"
+            st.sidebar.success("✅ Соединение с GitHub установлено")
+            if not modified:
+                st.sidebar.caption("Gist не изменился с последней загрузки (ответ 304)")
+            st.sidebar.markdown(f"**Последнее обновление:** {gist_meta['updated_at']}")
+            st.sidebar.markdown(f"**Размер данных:** {sum(data_files.values())/1024:.1f} KB "
+                                f"({len(data_files)} файлов)")
+            st.sidebar.text_area("Предпросмотр данных", content_preview, height=100)
         except Exception as e:
             st.sidebar.error(f"❌ Ошибка подключения: {str(e)}")
 if st.session_state.role == 'admin' or st.session_state.role == 'reception':
@@ -517,23 +3019,15 @@ def show_home_page():
     # --- Расписание на неделю ---
     st.subheader("📅 Расписание на неделю")
     
-    # Группировка расписания по дням недели
-    schedule_by_day = defaultdict(list)
-    for lesson in st.session_state.data['schedule']:
-        schedule_by_day[lesson['day']].append(lesson)
-    
-    days_order = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"]
+    week_calendar = get_week_calendar()
     
     # Отображение расписания по дням
-    for day in days_order:
-        if day in schedule_by_day:
+    for day in WEEKDAYS:
+        calendar_day = week_calendar[day]
+        if calendar_day.lessons:
             with st.expander(f"{day}", expanded=True):
-                lessons = schedule_by_day[day]
-                lessons.sort(key=lambda x: x['start_time'])
-                
-                for lesson in lessons:
-                    students_count = len([s for s in st.session_state.data['students'] 
-                                       if lesson['direction'] in s['directions']])
+                for lesson in calendar_day.lessons:
+                    students_count = calendar_day.student_counts[lesson['id']]
                     st.write(f"⏰ {lesson['start_time']}-{lesson['end_time']}: "
                             f"**{lesson['direction']}** (преп. {lesson['teacher']}) "
                             f"👥 {students_count} учеников")
@@ -548,14 +3042,6 @@ def show_home_page():
         min_value=date.today(),
         max_value=date.today() + timedelta(days=60))
 
-    # Определяем день недели
-    day_name = selected_date.strftime("%A")
-    day_map = {
-        "Monday": "Понедельник", "Tuesday": "Вторник", "Wednesday": "Среда",
-        "Thursday": "Четверг", "Friday": "Пятница", "Saturday": "Суббота", "Sunday": "Воскресенье"
-    }
-    russian_day = day_map.get(day_name, day_name)
-
     # Расширенный выбор стикеров
     sticker_options = {
         "Цветок": "🌸",
@@ -573,45 +3059,17 @@ def show_home_page():
     sticker = sticker_options[selected_sticker_name]
 
     if st.button("Сгенерировать сообщение"):
-        # 1. Собираем регулярные занятия
-        regular_lessons = [
-            {'time': l['start_time'], 'direction': l['direction']}
-            for l in st.session_state.data['schedule']
-            if l['day'] == russian_day
-        ]
-        
-        # 2. Добавляем разовые занятия на эту дату
-        single_lessons = [
+        # Регулярные и разовые занятия даты из календаря (уже отсортированы по времени)
+        all_lessons = [
             {'time': l['start_time'], 'direction': l['direction']}
-            for l in st.session_state.data.get('single_lessons', [])
-            if l['date'] == selected_date.strftime("%Y-%m-%d")
+            for l in get_day_calendar(selected_date.strftime("%Y-%m-%d")).lessons
         ]
         
-        # 3. Фильтруем по преподавателю (если это учитель)
+        # Фильтруем по преподавателю (если это учитель)
         if st.session_state.role == 'teacher':
             teacher = get_teacher_by_id(st.session_state.teacher_id)
             if teacher:
-                teacher_name = teacher.get('name', '')
-                regular_lessons = [
-                    l for l in regular_lessons 
-                    if any(
-                        t['name'] == teacher_name 
-                        for t in st.session_state.data['teachers'] 
-                        if l['direction'] in t.get('directions', [])
-                    )
-                ]
-                single_lessons = [
-                    l for l in single_lessons 
-                    if any(
-                        t['name'] == teacher_name 
-                        for t in st.session_state.data['teachers'] 
-                        if l['direction'] in t.get('directions', [])
-                    )
-                ]
-        
-        # 4. Объединяем и сортируем
-        all_lessons = regular_lessons + single_lessons
-        all_lessons.sort(key=lambda x: x['time'])
+                all_lessons = [l for l in all_lessons if l['direction'] in teacher.get('directions', [])]
         
         if all_lessons:
             # Формируем сообщение
@@ -679,11 +3137,12 @@ def show_home_page():
                         f.write(news_media.getbuffer())
                     news_data["media"] = f"{news_id}{ext}"
                 
-                if "news" not in st.session_state.data:
-                    st.session_state.data["news"] = []
+                with committing():
+                    if "news" not in st.session_state.data:
+                        st.session_state.data["news"] = []
                 
-                st.session_state.data["news"].insert(0, news_data)
-                save_data(st.session_state.data)
+                    st.session_state.data["news"].insert(0, news_data)
+                    save_data(st.session_state.data, sections=['news'])
                 st.success("Новость добавлена!")
                 st.rerun()
     
@@ -709,12 +3168,13 @@ def show_home_page():
                                 )
                 
                 if st.button("Удалить", key=f"del_news_{news['id']}"):
-                    st.session_state.data["news"] = [n for n in st.session_state.data["news"] if n['id'] != news['id']]
-                    if "media" in news:
-                        media_path = os.path.join(news_folder, news["media"])
-                        if os.path.exists(media_path):
-                            os.remove(media_path)
-                    save_data(st.session_state.data)
+                    with committing():
+                        st.session_state.data["news"] = [n for n in st.session_state.data["news"] if n['id'] != news['id']]
+                        if "media" in news:
+                            media_path = os.path.join(news_folder, news["media"])
+                            if os.path.exists(media_path):
+                                os.remove(media_path)
+                        save_data(st.session_state.data, sections=['news'])
                     st.success("Новость удалена!")
                     st.rerun()
     else:
@@ -752,8 +3212,9 @@ def show_directions_page():
                         "max_age": max_age,
                         "gender": gender if gender != "Любой" else None
                     }
-                    directions.append(new_direction)
-                    save_data(st.session_state.data)
+                    with committing():
+                        directions.append(new_direction)
+                        save_data(st.session_state.data)
                     st.success(f"Направление '{name}' добавлено.")
                     st.rerun()
                 else:
@@ -768,19 +3229,8 @@ def show_directions_page():
         if directions:
             table_data = []
             for d in directions:
-                if 'id' not in d:
-                    d['id'] = str(uuid.uuid4())  # фиксация KeyError
-                #  подсчет учеников :
-                student_count = 0
-                has_subdirections = any(sub['parent'] == d['name'] for sub in st.session_state.data.get('subdirections', []))
-
-                if has_subdirections:
-                    # Для направлений с поднаправлениями - считаем количество поднаправлений
-                    student_count = len([sub for sub in st.session_state.data.get('subdirections', []) 
-                                        if sub['parent'] == d['name']])
-                else:
-                    # Для обычных направлений - считаем учеников как раньше
-                    student_count = len([s for s in students if d['name'] in s.get("directions", [])])
+                #  подсчет учеников (поднаправления или ученики, кэшируется до изменения данных)
+                student_count = get_direction_student_counts().get(d['name'], 0)
                 table_data.append({
                     "id": d["id"],
                     "Название": d["name"],
@@ -806,21 +3256,25 @@ def show_directions_page():
             )
 
             if st.button("💾 Сохранить изменения"):
-                for i, row in edited_df.iterrows():
-                    for d in directions:
-                        if d["id"] == row["id"]:
-                            d["name"] = row["Название"]
-                            d["description"] = row["Описание"]
-                            d["cost"] = row["Стоимость"]
-                            d["trial_cost"] = row["Разовое"]
-                            d["gender"] = row["Пол"] if row["Пол"] != "Любой" else None
-                            try:
-                                min_a, max_a = map(int, str(row["Возраст"]).split('-'))
-                                d["min_age"] = min_a
-                                d["max_age"] = max_a
-                            except Exception:
-                                pass
-                save_data(st.session_state.data)
+                with committing():
+                    store = get_data_store()
+                    old_names = dict(store.reference_names('directions'))
+                    for i, row in edited_df.iterrows():
+                        changes = {
+                            "name": row["Название"],
+                            "description": row["Описание"],
+                            "cost": row["Стоимость"],
+                            "trial_cost": row["Разовое"],
+                            "gender": row["Пол"] if row["Пол"] != "Любой" else None
+                        }
+                        try:
+                            changes["min_age"], changes["max_age"] = map(int, str(row["Возраст"]).split('-'))
+                        except Exception:
+                            pass
+                        store.update('directions', row["id"], changes)
+                    # Новое название доходит до учеников, расписания, оплат и поднаправлений по id
+                    store.rename_references('directions', old_names)
+                    save_data(st.session_state.data)
                 st.success("Изменения сохранены.")
                 st.rerun()
         else:
@@ -830,19 +3284,8 @@ def show_directions_page():
     elif view_mode == "🧾 Карточки":
         if directions:
             for d in directions:
-                if 'id' not in d:
-                    d['id'] = str(uuid.uuid4())  # защита от KeyError
-                #  подсчет учеников:
-                student_count = 0
-                has_subdirections = any(sub['parent'] == d['name'] for sub in st.session_state.data.get('subdirections', []))
-
-                if has_subdirections:
-                    # Для направлений с поднаправлениями - считаем количество поднаправлений
-                    student_count = len([sub for sub in st.session_state.data.get('subdirections', []) 
-                                        if sub['parent'] == d['name']])
-                else:
-                    # Для обычных направлений - считаем учеников как раньше
-                    student_count = len([s for s in students if d['name'] in s.get("directions", [])])
+                #  подсчет учеников (поднаправления или ученики, кэшируется до изменения данных)
+                student_count = get_direction_student_counts().get(d['name'], 0)
                 with st.container(border=True):
                     st.subheader(d["name"])
                     st.caption(d.get("description", ""))
@@ -877,8 +3320,9 @@ def show_directions_page():
                         'parent': parent_dir,
                         'name': sub_name
                     }
-                    subdirections.append(new_sub)
-                    save_data(st.session_state.data)
+                    with committing():
+                        subdirections.append(new_sub)
+                        save_data(st.session_state.data)
                     st.success("Поднаправление добавлено!")
                     st.rerun()
                 else:
@@ -901,17 +3345,21 @@ def show_directions_page():
         )
         
         if st.button("💾 Сохранить изменения поднаправлений"):
-            for i, row in edited_subs.iterrows():
-                if not row['Удалить']:
-                    subdirections[i]['parent'] = row['parent']
-                    subdirections[i]['name'] = row['name']
-            
-            # Удаляем отмеченные
-            st.session_state.data['subdirections'] = [
-                s for i, s in enumerate(subdirections) 
-                if not edited_subs.iloc[i]['Удалить']
-            ]
-            save_data(st.session_state.data)
+            with committing():
+                store = get_data_store()
+                old_names = dict(store.reference_names('directions'))
+                for i, row in edited_subs.iterrows():
+                    if not row['Удалить']:
+                        subdirections[i]['parent'] = row['parent']
+                        subdirections[i]['name'] = row['name']
+            
+                # Удаляем отмеченные
+                st.session_state.data['subdirections'] = [
+                    s for i, s in enumerate(subdirections) 
+                    if not edited_subs.iloc[i]['Удалить']
+                ]
+                store.rename_references('directions', old_names)
+                save_data(st.session_state.data)
             st.success("Изменения сохранены!")
             st.rerun()
     else:
@@ -934,49 +3382,51 @@ def show_student_card(student_id):
 
         st.subheader("🎯 Направления")
 
-        # Гарантируем, что directions — список
-        if not isinstance(student.get("directions"), list):
-            student["directions"] = [student["directions"]] if student.get("directions") else []
+        # Гарантируем, что directions — список (без правки общей записи при отрисовке)
+        student_directions = student.get("directions")
+        if not isinstance(student_directions, list):
+            student_directions = [student_directions] if student_directions else []
 
         # Отображаем направления с кнопкой отписки
-        for d in student["directions"]:
+        for d in student_directions:
             with st.form(f"unassign_form_{student['id']}_{d}"):
                 if st.form_submit_button(f"❌ Отписать от {d}"):
-                    student["directions"] = [x for x in student["directions"] if x != d]
-                    save_data(st.session_state.data)
+                    with committing():
+                        get_data_store().update('students', student['id'], {
+                            "directions": [x for x in student_directions if x != d]
+                        })
+                        save_data(st.session_state.data, sections=['students'])
                     st.success(f"Ученик отписан от {d}")
                     st.rerun()
 
         # Добавление направления
         available = (
-            [d['name'] for d in st.session_state.data['directions'] if d['name'] not in student["directions"]] +
+            [d['name'] for d in st.session_state.data['directions'] if d['name'] not in student_directions] +
             [f"{s['parent']} ({s['name']})" for s in st.session_state.data.get('subdirections', []) 
-            if f"{s['parent']} ({s['name']})" not in student.get("directions", [])]
+            if f"{s['parent']} ({s['name']})" not in student_directions]
         )
 
         if available:
             with st.form(f"assign_dir_form_{student['id']}"):
                 new_dir = st.selectbox("Добавить направление", available, key=f"dir_sel_{student['id']}")
                 if st.form_submit_button("Добавить"):
-                    student["directions"].append(new_dir)
-                    save_data(st.session_state.data)
+                    with committing():
+                        get_data_store().update('students', student['id'], {
+                            "directions": student_directions + [new_dir]
+                        })
+                        save_data(st.session_state.data, sections=['students'])
                     st.success(f"Добавлено направление {new_dir}")
                     st.rerun()
 
 
         st.subheader("💳 Оплаты")
         # Получаем все оплаты ученика + проверяем поднаправления
-        payments = []
-        for p in st.session_state.data['payments']:
-            if p['student_id'] == student['id']:
-                # Проверяем прямое направление
-                if p['direction'] in student.get('directions', []):
-                    payments.append(p)
-                # Проверяем поднаправления (формат "Основное направление (Имя ребенка)")
-                elif any(p['direction'] == f"{s['parent']} ({s['name']})" 
-                        for s in st.session_state.data.get('subdirections', [])
-                        if s['name'] == student['name']):
-                    payments.append(p)
+        payments = get_payments_for_student(student['id'])
+        archive_months = archived_months('payments')
+        if archive_months and st.checkbox(f"Показать архивные оплаты ({archive_months[0]} — {archive_months[-1]})",
+                                          key=f"archived_payments_{student['id']}"):
+            payments = [p for p in load_archived_payments(archive_months)
+                        if p.get('student_id') == student['id']] + payments
 
         if payments:
             df_pay = pd.DataFrame(payments)
@@ -991,42 +3441,34 @@ def show_student_card(student_id):
         attendances = []
 
         # Создаем карту соответствия поднаправлений к основным направлениям
-        direction_map = {
-            f"{s['parent']} ({s['name']})": s['parent'] 
-            for s in st.session_state.data.get('subdirections', [])
-        }
-
-        # Собираем данные о посещениях
-        for day, lessons in st.session_state.data.get("attendance", {}).items():
-            for lesson_id, students_data in lessons.items():
-                if student_id in students_data:
-                    status = students_data[student_id]
-                    
-                    # Проверяем как регулярные занятия, так и разовые
-                    lesson = next(
-                        (l for l in st.session_state.data['schedule'] + st.session_state.data.get('single_lessons', []) 
-                        if l['id'] == lesson_id),
-                        None
-                    )
-                    
-                    if lesson:
-                        direction_name = lesson['direction']
-                        # Преобразуем поднаправление в основное направление для отображения
-                        direction_to_show = direction_map.get(direction_name, direction_name)
-                        
-                        # Определяем тип занятия
-                        lesson_type = "Разовое" if 'date' in lesson else "Регулярное"
-                        
-                        attendances.append({
-                            "Дата": day,
-                            "Направление": direction_to_show,
-                            "Фактическое направление": direction_name,
-                            "Преподаватель": lesson['teacher'],
-                            "Тип": lesson_type,
-                            "Был": "Да" if status.get('present') else "Нет",
-                            "Оплачено": "Да" if status.get('paid') else "Нет",
-                            "Примечание": status.get('note', '')
-                        })
+        direction_map = get_subdirection_parent_map()
+
+        # Собираем данные о посещениях (по индексу ученика в таблице посещаемости) и архивные месяцы
+        lesson_catalog = get_lesson_catalog()
+        archived_marks = get_archived_attendance_frame()
+        archived_marks = archived_marks[archived_marks['student_id'] == student_id].to_dict('records')
+        for status in get_data_store().attendance_of_student(student_id) + archived_marks:
+            # Проверяем как регулярные занятия, так и разовые
+            lesson = lesson_catalog.get(status['lesson_id'])
+            
+            if lesson:
+                direction_name = lesson['direction']
+                # Преобразуем поднаправление в основное направление для отображения
+                direction_to_show = direction_map.get(direction_name, direction_name)
+                
+                # Определяем тип занятия
+                lesson_type = "Разовое" if 'date' in lesson else "Регулярное"
+                
+                attendances.append({
+                    "Дата": status['date'],
+                    "Направление": direction_to_show,
+                    "Фактическое направление": direction_name,
+                    "Преподаватель": lesson['teacher'],
+                    "Тип": lesson_type,
+                    "Был": "Да" if status['present'] else "Нет",
+                    "Оплачено": "Да" if status['paid'] else "Нет",
+                    "Примечание": status['note']
+                })
 
         if attendances:
             df_att = pd.DataFrame(attendances).sort_values("Дата", ascending=False)
@@ -1063,28 +3505,24 @@ def show_student_card(student_id):
                     # Удаляем отмеченные посещения
                     to_delete = edited_att[edited_att['Удалить']]
                     
+                    store = get_data_store()
+                    lesson_catalog = get_lesson_catalog()
+                    marks_to_delete = []
                     for _, row in to_delete.iterrows():
                         date_key = row['Дата'].strftime("%Y-%m-%d") if hasattr(row['Дата'], 'strftime') else row['Дата']
                         direction = row['Фактическое направление']
                         
-                        # Находим и удаляем запись о посещении
-                        if date_key in st.session_state.data['attendance']:
-                            for lesson_id in st.session_state.data['attendance'][date_key]:
-                                if student_id in st.session_state.data['attendance'][date_key][lesson_id]:
-                                    lesson = next(
-                                        (l for l in st.session_state.data['schedule'] + 
-                                        st.session_state.data.get('single_lessons', [])
-                                        if l['id'] == lesson_id and l['direction'] == direction
-                                        ), None)
-                                    
-                                    if lesson:
-                                        del st.session_state.data['attendance'][date_key][lesson_id][student_id]
-                                        if not st.session_state.data['attendance'][date_key][lesson_id]:
-                                            del st.session_state.data['attendance'][date_key][lesson_id]
-                                        if not st.session_state.data['attendance'][date_key]:
-                                            del st.session_state.data['attendance'][date_key]
+                        # Находим записи о посещении этого дня по занятиям нужного направления
+                        for status in store.attendance_of_student(student_id):
+                            if status['date'] != date_key:
+                                continue
+                            lesson = lesson_catalog.get(status['lesson_id'])
+                            if lesson and lesson['direction'] == direction:
+                                marks_to_delete.append((date_key, status['lesson_id'], student_id))
+                    with committing():
+                        store.remove_attendance(marks_to_delete)
                     
-                    save_data(st.session_state.data)
+                        save_data(st.session_state.data, sections=['attendance'])
                     st.success("Изменения сохранены!")
                     st.rerun()
             
@@ -1193,19 +3631,20 @@ def show_teacher_card(teacher_id):
         # Кнопка сохранения изменений
         if st.session_state[state_key]["edited"]:
             if st.button("💾 Сохранить изменения", key=f"save_{teacher_id}"):
-                # Применяем изменения
-                teacher["directions"] = [
-                    d for d in teacher.get("directions", []) 
-                    if d not in st.session_state[state_key]["deleted_directions"]
-                ] + st.session_state[state_key]["added_directions"]
+                with committing():
+                    # Применяем изменения
+                    teacher["directions"] = [
+                        d for d in teacher.get("directions", []) 
+                        if d not in st.session_state[state_key]["deleted_directions"]
+                    ] + st.session_state[state_key]["added_directions"]
                 
-                # Обновляем данные
-                for i, t in enumerate(st.session_state.data['teachers']):
-                    if t['id'] == teacher_id:
-                        st.session_state.data['teachers'][i] = teacher
-                        break
+                    # Обновляем данные
+                    for i, t in enumerate(st.session_state.data['teachers']):
+                        if t['id'] == teacher_id:
+                            st.session_state.data['teachers'][i] = teacher
+                            break
                 
-                save_data(st.session_state.data)
+                    save_data(st.session_state.data)
                 
                 # Сбрасываем состояние
                 st.session_state[state_key] = {
@@ -1219,10 +3658,7 @@ def show_teacher_card(teacher_id):
                 st.rerun()
 
         # Статистика и посещения
-        direction_map = {
-            f"{s['parent']} ({s['name']})": s['parent'] 
-            for s in st.session_state.data.get('subdirections', [])
-        }
+        direction_map = get_subdirection_parent_map()
 
         all_directions_stats = set()
         for dir_name in teacher.get('directions', []):
@@ -1231,40 +3667,30 @@ def show_teacher_card(teacher_id):
             else:
                 all_directions_stats.add(dir_name)
 
+        teacher_attendance = get_teacher_attendance_frame(teacher['name'])
         for direction_name in sorted(all_directions_stats):
             st.markdown(f"### 📘 {direction_name}")
             
-            lessons = []
-            lessons.extend([l for l in st.session_state.data['schedule']
-                          if l['direction'] == direction_name 
-                          and l['teacher'] == teacher['name']])
-            
             subdirections = [k for k, v in direction_map.items() if v == direction_name]
+            teacher_regular, teacher_single = get_teacher_lessons(teacher['name'])
+            lessons = [l for l in teacher_regular if l['direction'] == direction_name]
             for subdir in subdirections:
-                lessons.extend([l for l in st.session_state.data['schedule']
-                              if l['direction'] == subdir
-                              and l['teacher'] == teacher['name']])
+                lessons.extend(l for l in teacher_regular if l['direction'] == subdir)
             
-            single_lessons = [
-                l for l in st.session_state.data.get('single_lessons', [])
-                if l['teacher'] == teacher['name'] and l['direction'] == direction_name
-            ]
+            single_lessons = [l for l in teacher_single if l['direction'] == direction_name]
             
             if not lessons and not single_lessons:
                 st.info("Нет занятий по этому направлению.")
                 continue
 
             students_in_dir = []
-            students_in_dir.extend([s for s in st.session_state.data['students'] 
-                                 if direction_name in s.get('directions', [])])
+            students_in_dir.extend(get_students_by_direction(direction_name))
             
             for subdir in subdirections:
-                students_in_dir.extend([s for s in st.session_state.data['students'] 
-                                      if subdir in s.get('directions', [])])
+                students_in_dir.extend(get_students_by_direction(subdir))
             
             for lesson in single_lessons:
-                student = next((s for s in st.session_state.data['students'] 
-                             if s['id'] == lesson['student_id']), None)
+                student = get_student_by_id(lesson['student_id'])
                 if student and student not in students_in_dir:
                     students_in_dir.append(student)
 
@@ -1272,79 +3698,10 @@ def show_teacher_card(teacher_id):
                 st.info("Нет учеников на этом направлении.")
                 continue
 
-            attendance_data = []
-            attendance = st.session_state.data.get("attendance", {})
-
-            for student in students_in_dir:
-                for lesson in lessons:
-                    lesson_id = lesson.get('id')
-                    for date_str, day_lessons in attendance.items():
-                        if lesson_id in day_lessons and student['id'] in day_lessons[lesson_id]:
-                            record = day_lessons[lesson_id][student['id']]
-                            
-                            paid_status = record.get('paid', False)
-                            if not paid_status:
-                                for payment in st.session_state.data['payments']:
-                                    if payment['student_id'] == student['id']:
-                                        payment_dir = payment['direction']
-                                        if (payment_dir == direction_name or 
-                                            payment_dir in subdirections):
-                                            payment_date = datetime.strptime(payment['date'], "%Y-%m-%d").date()
-                                            lesson_date = datetime.strptime(date_str, "%Y-%m-%d").date()
-                                            
-                                            if payment['type'] == "Абонемент":
-                                                if (payment_date.month == lesson_date.month and 
-                                                    payment_date.year == lesson_date.year):
-                                                    paid_status = True
-                                                    break
-                                            elif payment['type'] in ["Разовое", "Пробное"]:
-                                                if payment_date == lesson_date:
-                                                    paid_status = True
-                                                    break
-                            
-                            attendance_data.append({
-                                "Ученик": student['name'],
-                                "Дата": date_str,
-                                "Занятие": f"{lesson['start_time']}-{lesson['end_time']}",
-                                "Присутствовал": "Да" if record.get('present') else "Нет",
-                                "Оплачено": "Да" if paid_status else "Нет",
-                                "Примечание": record.get('note', ''),
-                                "Тип": "Поднаправление" if lesson['direction'] in subdirections else "Основное"
-                            })
-
-            for lesson in single_lessons:
-                date_str = lesson['date']
-                lesson_id = lesson['id']
-                student_id = lesson['student_id']
-                student = next((s for s in students_in_dir if s['id'] == student_id), None)
-                
-                if student:
-                    record = attendance.get(date_str, {}).get(lesson_id, {}).get(student_id, {})
-                    
-                    paid_status = record.get('paid', False)
-                    if not paid_status:
-                        for payment in st.session_state.data['payments']:
-                            if (payment['student_id'] == student_id and 
-                                payment['direction'] == direction_name and
-                                payment['date'] == date_str):
-                                paid_status = True
-                                break
-                    
-                    attendance_data.append({
-                        "Ученик": student['name'],
-                        "Дата": date_str,
-                        "Занятие": f"{lesson['start_time']}-{lesson['end_time']}",
-                        "Присутствовал": "Да" if record.get('present') else "Нет",
-                        "Оплачено": "Да" if paid_status else "Нет",
-                        "Примечание": record.get('note', '') or lesson.get('notes', ''),
-                        "Тип": "Разовое занятие"
-                    })
+            # Таблица посещений считается сразу для всех направлений преподавателя
+            df = teacher_attendance[teacher_attendance['Направление'] == direction_name].drop(columns=['Направление'])
 
-            if attendance_data:
-                df = pd.DataFrame(attendance_data)
-                df['Дата'] = pd.to_datetime(df['Дата'])
-                df = df.sort_values('Дата', ascending=False)
-                
+            if not df.empty:
                 st.dataframe(
                     df.drop(columns=['Тип']),
                     use_container_width=True,
@@ -1385,11 +3742,6 @@ def show_students_page():
     parents = st.session_state.data['parents']
     directions = st.session_state.data['directions']
 
-    # Добавим id для всех, если вдруг отсутствует
-    for s in students:
-        if 'id' not in s:
-            s['id'] = str(uuid.uuid4())
-
     view_mode = st.radio("Режим отображения", ["📋 Таблица", "🧾 Карточки"], horizontal=True)
 
     with st.expander("➕ Добавить нового ученика"):
@@ -1415,30 +3767,31 @@ def show_students_page():
 
             if st.form_submit_button("Добавить"):
                 if name:
-                    if not parent_id:
-                        new_parent = {
+                    with committing():
+                        if not parent_id:
+                            new_parent = {
+                                "id": str(uuid.uuid4()),
+                                "name": new_parent_name or f"Родитель {name}",
+                                "phone": new_parent_phone,
+                                "children_ids": []
+                            }
+                            get_data_store().insert('parents', new_parent)
+                            parent_id = new_parent['id']
+                        new_student = {
                             "id": str(uuid.uuid4()),
-                            "name": new_parent_name or f"Родитель {name}",
-                            "phone": new_parent_phone,
-                            "children_ids": []
+                            "name": name,
+                            "dob": str(dob),
+                            "gender": gender,
+                            "parent_id": parent_id,
+                            "directions": selected_dirs,
+                            "notes": notes,
+                            "registration_date": str(date.today())
                         }
-                        parents.append(new_parent)
-                        parent_id = new_parent['id']
-                    new_student = {
-                        "id": str(uuid.uuid4()),
-                        "name": name,
-                        "dob": str(dob),
-                        "gender": gender,
-                        "parent_id": parent_id,
-                        "directions": selected_dirs,
-                        "notes": notes,
-                        "registration_date": str(date.today())
-                    }
-                    students.append(new_student)
-                    for p in parents:
-                        if p['id'] == parent_id:
-                            p.setdefault("children_ids", []).append(new_student['id'])
-                    save_data(st.session_state.data)
+                        get_data_store().insert('students', new_student)
+                        parent = get_parent_by_id(parent_id)
+                        if parent:
+                            parent.setdefault("children_ids", []).append(new_student['id'])
+                        save_data(st.session_state.data, sections=['students', 'parents'])
                     st.success(f"Ученик {name} добавлен.")
                     st.rerun()
                 else:
@@ -1460,15 +3813,16 @@ def show_students_page():
             )
 
             if st.button("💾 Сохранить изменения"):
-                for i, row in edited.iterrows():
-                    for s in students:
-                        if s['id'] == row['id']:
-                            s['name'] = row['name']
-                            s['dob'] = str(row['dob']) if isinstance(row['dob'], date) else row['dob']
-                            s['gender'] = row['gender']
-                            s['notes'] = row['notes']
-                            s['directions'] = [d.strip() for d in str(row['directions']).split(',') if d.strip()]
-                save_data(st.session_state.data)
+                with committing():
+                    for i, row in edited.iterrows():
+                        for s in students:
+                            if s['id'] == row['id']:
+                                s['name'] = row['name']
+                                s['dob'] = str(row['dob']) if isinstance(row['dob'], date) else row['dob']
+                                s['gender'] = row['gender']
+                                s['notes'] = row['notes']
+                                s['directions'] = [d.strip() for d in str(row['directions']).split(',') if d.strip()]
+                    save_data(st.session_state.data)
                 st.success("Данные обновлены.")
                 st.rerun()
             # Создаем DataFrame с колонкой для удаления
@@ -1491,26 +3845,10 @@ def show_students_page():
             to_delete = edited_df[edited_df['Удалить']]['id'].tolist()
             
             if to_delete:
-                # Удаляем учеников
-                st.session_state.data['students'] = [
-                    s for s in students if s['id'] not in to_delete
-                ]
-                
-                # Удаляем связанные платежи
-                st.session_state.data['payments'] = [
-                    p for p in st.session_state.data['payments']
-                    if p['student_id'] not in to_delete
-                ]
-                
-                # Обновляем посещения
-                for date_key in st.session_state.data['attendance']:
-                    for lesson_id in list(st.session_state.data['attendance'][date_key].keys()):
-                        for student_id in list(st.session_state.data['attendance'][date_key][lesson_id].keys()):
-                            if student_id in to_delete:
-                                del st.session_state.data['attendance'][date_key][lesson_id][student_id]
-                
-                save_data(st.session_state.data)
-                st.success(f"Удалено {len(to_delete)} учеников!")
+                # Вместе с учениками удаляются их оплаты, разовые занятия и отметки посещаемости
+                removed = delete_with_cascade('students', to_delete)
+                st.success(f"Удалено {len(to_delete)} учеников! "
+                           f"Оплат: {removed.get('payments', 0)}, отметок посещаемости: {removed.get('attendance', 0)}")
                 st.rerun()
             else:
                 st.warning("Не выбрано ни одного ученика для удаления")
@@ -1548,62 +3886,46 @@ def show_students_page():
                     "type": p_type,
                     "notes": notes
                 }
-                st.session_state.data['payments'].append(new_payment)
+                with committing():
+                    store = get_data_store()
+                    store.insert('payments', new_payment)
+
+                    def mark_paid(date_key, lesson_id, note):
+                        mark = st.session_state.data['attendance'].get(date_key, {}).get(lesson_id, {}).get(selected_id)
+                        store.set_attendance(date_key, lesson_id, selected_id,
+                                             {**mark, 'paid': True} if mark else {'present': False, 'paid': True, 'note': note})
                 
-                # Синхронизация с посещениями
-                if p_type == "Абонемент":
-                    # Для абонемента отмечаем все занятия в этом месяце
-                    for schedule_item in st.session_state.data['schedule']:
-                        if schedule_item['direction'] == direction:
-                            # Находим все даты этого занятия в текущем месяце
-                            day_map = {
-                                "Понедельник": 0, "Вторник": 1, "Среда": 2,
-                                "Четверг": 3, "Пятница": 4, "Суббота": 5, "Воскресенье": 6
-                            }
-                            target_weekday = day_map.get(schedule_item['day'])
+                    # Синхронизация с посещениями
+                    if p_type == "Абонемент":
+                        # Для абонемента отмечаем все занятия в этом месяце
+                        for schedule_item in st.session_state.data['schedule']:
+                            if schedule_item['direction'] == direction:
+                                # Находим все даты этого занятия в текущем месяце
+                                day_map = {
+                                    "Понедельник": 0, "Вторник": 1, "Среда": 2,
+                                    "Четверг": 3, "Пятница": 4, "Суббота": 5, "Воскресенье": 6
+                                }
+                                target_weekday = day_map.get(schedule_item['day'])
                             
-                            if target_weekday is not None:
-                                current_date = p_date
-                                # Перебираем все дни месяца
-                                while current_date.month == p_date.month:
-                                    if current_date.weekday() == target_weekday:
-                                        date_key = current_date.strftime("%Y-%m-%d")
-                                        lesson_id = schedule_item['id']
+                                if target_weekday is not None:
+                                    current_date = p_date
+                                    # Перебираем все дни месяца
+                                    while current_date.month == p_date.month:
+                                        if current_date.weekday() == target_weekday:
+                                            date_key = current_date.strftime("%Y-%m-%d")
+                                            lesson_id = schedule_item['id']
                                         
-                                        # Инициализируем структуру данных для посещений
-                                        if date_key not in st.session_state.data['attendance']:
-                                            st.session_state.data['attendance'][date_key] = {}
-                                        if lesson_id not in st.session_state.data['attendance'][date_key]:
-                                            st.session_state.data['attendance'][date_key][lesson_id] = {}
-                                        if selected_id not in st.session_state.data['attendance'][date_key][lesson_id]:
-                                            st.session_state.data['attendance'][date_key][lesson_id][selected_id] = {
-                                                'present': False,
-                                                'paid': True,  # Отмечаем как оплаченное
-                                                'note': 'Абонемент'
-                                            }
-                                        else:
-                                            st.session_state.data['attendance'][date_key][lesson_id][selected_id]['paid'] = True
-                                    current_date += timedelta(days=1)
-                else:
-                    # Для разового/пробного отмечаем только текущий день
-                    date_key = p_date.strftime("%Y-%m-%d")
-                    for schedule_item in st.session_state.data['schedule']:
-                        if schedule_item['direction'] == direction:
-                            lesson_id = schedule_item['id']
-                            if date_key not in st.session_state.data['attendance']:
-                                st.session_state.data['attendance'][date_key] = {}
-                            if lesson_id not in st.session_state.data['attendance'][date_key]:
-                                st.session_state.data['attendance'][date_key][lesson_id] = {}
-                            if selected_id not in st.session_state.data['attendance'][date_key][lesson_id]:
-                                st.session_state.data['attendance'][date_key][lesson_id][selected_id] = {
-                                    'present': False,
-                                    'paid': True,  # Отмечаем как оплаченное
-                                    'note': p_type
-                                }
-                            else:
-                                st.session_state.data['attendance'][date_key][lesson_id][selected_id]['paid'] = True
+                                            # Отмечаем занятие как оплаченное
+                                            mark_paid(date_key, lesson_id, 'Абонемент')
+                                        current_date += timedelta(days=1)
+                    else:
+                        # Для разового/пробного отмечаем только текущий день
+                        date_key = p_date.strftime("%Y-%m-%d")
+                        for schedule_item in st.session_state.data['schedule']:
+                            if schedule_item['direction'] == direction:
+                                mark_paid(date_key, schedule_item['id'], p_type)
                 
-                save_data(st.session_state.data)
+                    save_data(st.session_state.data)
                 st.success("Оплата добавлена и синхронизирована с посещениями!")
                 st.rerun()
 
@@ -1615,11 +3937,6 @@ def show_teachers_page():
     teachers = st.session_state.data.get("teachers", [])
     directions = st.session_state.data.get("directions", [])
 
-    # Убедимся, что у всех есть id
-    for t in teachers:
-        if 'id' not in t:
-            t['id'] = str(uuid.uuid4())
-
     # ➕ Добавить преподавателя
     with st.expander("➕ Добавить преподавателя"):
         with st.form("new_teacher_form", clear_on_submit=True):
@@ -1643,8 +3960,9 @@ def show_teachers_page():
                         'notes': notes,
                         'hire_date': str(date.today())
                     }
-                    teachers.append(new_teacher)
-                    save_data(st.session_state.data)
+                    with committing():
+                        get_data_store().insert('teachers', new_teacher)
+                        save_data(st.session_state.data, sections=['teachers'])
                     st.success(f"Преподаватель {name} добавлен.")
                     st.rerun()
                 else:
@@ -1664,26 +3982,23 @@ def show_teachers_page():
         )
 
         if st.button("💾 Сохранить изменения"):
-            for i, row in edited_df.iterrows():
-                for t in teachers:
-                    if t['id'] == row['id']:
-                        t['name'] = row['name']
-                        t['phone'] = row['phone']
-                        t['email'] = row['email']
-                        t['notes'] = row['notes']
+            with committing():
+                store = get_data_store()
+                old_names = dict(store.reference_names('teachers'))
+                for i, row in edited_df.iterrows():
+                    store.update('teachers', row['id'], {
+                        'name': row['name'],
+                        'phone': row['phone'],
+                        'email': row['email'],
+                        'notes': row['notes'],
                         # Важно: сохраняем направления как список
-                        t['directions'] = [d.strip() for d in row['directions'].split(',') if d.strip()]
-                        break
+                        'directions': [d.strip() for d in row['directions'].split(',') if d.strip()]
+                    })
             
-            # Обновляем расписание, если изменилось имя преподавателя
-            for teacher in teachers:
-                old_name = next((t['name'] for t in st.session_state.data['teachers'] if t['id'] == teacher['id']), None)
-                if old_name and old_name != teacher['name']:
-                    for lesson in st.session_state.data['schedule']:
-                        if lesson['teacher'] == old_name:
-                            lesson['teacher'] = teacher['name']
+                # Новое имя преподавателя попадает в его занятия по ссылкам teacher_id, без обхода расписания
+                store.rename_references('teachers', old_names)
             
-            save_data(st.session_state.data)
+                save_data(st.session_state.data)
             st.success("Изменения сохранены!")
             st.rerun()
         # Создаем DataFrame с колонкой для удаления
@@ -1704,22 +4019,12 @@ def show_teachers_page():
         
         # Кнопка для удаления отмеченных строк
         if st.button("🗑️ Удалить выбранных преподавателей"):
-            # Получаем ID преподавателей для удаления
-            to_delete = edited_df[edited_df['Удалить']]['id'].tolist()
-            
-            if to_delete:
-                # Удаляем из основного списка
-                st.session_state.data['teachers'] = [
-                    t for t in teachers if t['id'] not in to_delete
-                ]
-                
-                # Удаляем из расписания
-                st.session_state.data['schedule'] = [
-                    lesson for lesson in st.session_state.data['schedule'] 
-                    if lesson['teacher'] not in [t['name'] for t in teachers if t['id'] in to_delete]
-                ]
-                
-                save_data(st.session_state.data)
+            # Получаем ID преподавателей для удаления
+            to_delete = edited_df[edited_df['Удалить']]['id'].tolist()
+            
+            if to_delete:
+                # Вместе с преподавателями удаляются их занятия в расписании
+                delete_with_cascade('teachers', to_delete)
                 st.success(f"Удалено {len(to_delete)} преподавателей!")
                 st.rerun()
             else:
@@ -1734,12 +4039,96 @@ def show_teachers_page():
         show_teacher_card(t['id'])
 
 
+def show_day_attendance_editor(lessons, selected_date):
+    """Пакетная отметка посещений за весь день: один редактор и одно сохранение"""
+    date_key = selected_date.strftime("%Y-%m-%d")
+    stage_key = f"day_att_{date_key}"
+    day_marks = attendance_marks_on(date_key)
+    store = get_data_store()
+    shared = get_shared_document()
+    stamp = tuple(shared.section_revisions[section] for section in ('attendance', 'students', 'schedule', 'single_lessons'))
+
+    # Исходные строки снимаются заново, когда другие сессии меняют посещаемость или состав занятий;
+    # правки копятся в состоянии редактора до сохранения и накладываются на свежие строки
+    staged = st.session_state.get(stage_key)
+    if staged is None or staged['stamp'] != stamp:
+        keys, rows = [], []
+        for lesson in lessons:
+            for s in get_lesson_students(lesson):
+                mark = day_marks.get(lesson['id'], {}).get(s['id']) or {
+                    'present': False,
+                    'paid': store.is_lesson_paid(s['id'], [lesson['direction']], selected_date),
+                    'note': ''
+                }
+                keys.append((lesson['id'], s['id']))
+                rows.append({
+                    "Время": f"{lesson['start_time']}-{lesson['end_time']}",
+                    "Занятие": f"{lesson['direction']}{' (Разовое)' if lesson.get('type') == 'single' else ''}",
+                    "Ученик": s['name'],
+                    "Присутствовал": bool(mark.get('present', False)),
+                    "Оплачено": bool(mark.get('paid', False)),
+                    "Примечание": mark.get('note', '')
+                })
+        if staged is not None and staged['keys'] != keys:
+            # Состав строк изменился — прежние правки по номерам строк применить нельзя
+            st.session_state.pop(f"day_editor_{date_key}", None)
+            st.warning("Список учеников на этот день изменился, несохранённые правки сброшены")
+        staged = {'keys': keys, 'rows': rows, 'stamp': stamp}
+        st.session_state[stage_key] = staged
+
+    if not staged['rows']:
+        st.info("Нет учеников на занятиях этого дня.")
+        return
+
+    base_df = pd.DataFrame(staged['rows'])
+    edited_df = st.data_editor(
+        base_df,
+        use_container_width=True,
+        hide_index=True,
+        key=f"day_editor_{date_key}",
+        disabled=["Время", "Занятие", "Ученик"],
+        column_config={
+            "Присутствовал": st.column_config.CheckboxColumn(),
+            "Оплачено": st.column_config.CheckboxColumn()
+        }
+    )
+    editable = ["Присутствовал", "Оплачено", "Примечание"]
+    changed = (edited_df[editable].astype(str) != base_df[editable].astype(str)).any(axis=1)
+    st.caption(f"Несохранённых изменений: {int(changed.sum())}")
+
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("💾 Сохранить день", key=f"save_day_{date_key}", type="primary"):
+            lessons_by_id = {lesson['id']: lesson for lesson in lessons}
+            # Записываются только изменённые строки, чтобы не затереть отметки других сессий
+            created = commit_attendance(date_key, [
+                (lessons_by_id[lesson_id], student_id, {
+                    'present': bool(row['Присутствовал']),
+                    'paid': bool(row['Оплачено']),
+                    'note': str(row['Примечание'])
+                })
+                for (lesson_id, student_id), row, is_changed in zip(staged['keys'], edited_df.to_dict('records'), changed)
+                if is_changed and lesson_id in lessons_by_id
+            ])
+            # Сбрасываем черновики дня и отдельных занятий — они построены по старым данным
+            for key in [stage_key, f"day_editor_{date_key}"] + [f"att_{lesson_id}_{date_key}" for lesson_id in lessons_by_id]:
+                st.session_state.pop(key, None)
+            if created:
+                st.success(f"Добавлено оплат за разовые занятия: {len(created)} на {sum(p['amount'] for p in created)} ₽")
+            st.success("Посещения за день сохранены!")
+            st.rerun()
+    with col2:
+        if st.button("↩️ Отменить изменения", key=f"reset_day_{date_key}"):
+            st.session_state.pop(stage_key, None)
+            st.session_state.pop(f"day_editor_{date_key}", None)
+            st.rerun()
+
+
 def show_schedule_page():
     st.header("📅 Расписание и посещения")
 
     data = st.session_state.data
     schedule = data.setdefault("schedule", [])
-    attendance = data.setdefault("attendance", {})
     payments = data.setdefault("payments", [])
     students = data.get("students", [])
     directions = data.get("directions", [])
@@ -1755,6 +4144,9 @@ def show_schedule_page():
                     subdirection_options = [f"{s['parent']} ({s['name']})" for s in st.session_state.data.get('subdirections', [])]
                     direction_name = st.selectbox("Направление*", direction_options + subdirection_options)
                     teacher = st.selectbox("Преподаватель*", [t['name'] for t in teachers])
+                    classroom_names = {r['id']: r.get('name', r['id']) for r in data.get('classrooms', [])}
+                    classroom = st.selectbox("Класс", [None] + list(classroom_names),
+                                             format_func=lambda x: "—" if x is None else classroom_names[x])
                 with col2:
                     start_time = st.time_input("Начало*", value=datetime.strptime("16:00", "%H:%M").time())
                     end_time = st.time_input("Конец*", value=datetime.strptime("17:00", "%H:%M").time())
@@ -1763,53 +4155,41 @@ def show_schedule_page():
                     ])
 
                 if st.form_submit_button("Добавить занятие"):
-                    schedule.append({
+                    lesson = {
                         'id': str(uuid.uuid4()),
                         'direction': direction_name,
                         'teacher': teacher,
                         'start_time': str(start_time),
                         'end_time': str(end_time),
-                        'day': day_of_week
-                    })
-                    save_data(data)
-                    st.success("Занятие добавлено.")
-                    st.rerun()
+                        'day': day_of_week,
+                        'classroom': classroom
+                    }
+                    with committing():
+                        conflicts = get_data_store().lesson_conflicts(lesson)
+                        if conflicts:
+                            for kind, resource, other in conflicts:
+                                st.error(describe_schedule_conflict(kind, resource, other))
+                        else:
+                            get_data_store().insert('schedule', lesson)
+                            save_data(data, sections=['schedule'])
+                        st.success("Занятие добавлено.")
+                        st.rerun()
 
     # === Календарь и занятия ===
     st.subheader("🗓️ Календарь занятий")
     selected_date = st.date_input("Выберите дату", value=st.session_state.get("selected_date", date.today()))
     st.session_state.selected_date = selected_date
-    day_name = selected_date.strftime("%A")
-
-    day_map = {
-        "Monday": "Понедельник", "Tuesday": "Вторник", "Wednesday": "Среда",
-        "Thursday": "Четверг", "Friday": "Пятница", "Saturday": "Суббота", "Sunday": "Воскресенье"
-    }
-    russian_day = day_map.get(day_name, day_name)
-
-    # Получаем все занятия на выбранную дату
-    regular_lessons = [s for s in schedule if s['day'] == russian_day]
-    single_lessons = [
-        {
-            'id': l['id'],
-            'direction': l['direction'],
-            'teacher': l['teacher'],
-            'start_time': l['start_time'],
-            'end_time': l['end_time'],
-            'day': russian_day,
-            'type': 'single',
-            'student_id': l['student_id']
-        }
-        for l in st.session_state.data.get('single_lessons', [])
-        if l['date'] == selected_date.strftime("%Y-%m-%d")
-    ]
+    russian_day = weekday_name(selected_date)
 
-    # Сортировка занятий с защитой от ошибок формата
-    all_lessons = sorted(
-        regular_lessons + single_lessons,
-        key=lambda x: safe_time_parse(x.get('start_time', '00:00')))
+    # Все занятия на выбранную дату (регулярные и разовые) из календаря недели
+    all_lessons = list(get_day_calendar(selected_date.strftime("%Y-%m-%d")).lessons)
 
-    if all_lessons:
+    mark_mode = st.radio("Отметка посещений", ["По занятиям", "Весь день"], horizontal=True)
+    # Для закрытого месяца отметки читаются из архива, чтобы сохранение не затёрло их значениями по умолчанию
+    day_marks = attendance_marks_on(selected_date.strftime("%Y-%m-%d")) if all_lessons else {}
+    if all_lessons and mark_mode == "Весь день":
+        show_day_attendance_editor(all_lessons, selected_date)
+    elif all_lessons:
         for lesson in all_lessons:
             lesson_type = "(Разовое)" if lesson.get('type') == 'single' else ""
             with st.expander(f"{lesson['direction']} {lesson_type} ({lesson['start_time']}-{lesson['end_time']}, {lesson['teacher']})", expanded=False):
@@ -1827,28 +4207,20 @@ def show_schedule_page():
                 # Найдём учеников
                 if lesson.get('type') == 'single':
                     # Для разовых занятий - только один ученик
-                    student = next((s for s in students if s['id'] == lesson.get('student_id')), None)
-                    if student:
-                        students_in_dir = [student]
-                        # Добавляем направление ученику, если его нет
-                        if lesson['direction'] not in student.get('directions', []):
-                            student['directions'].append(lesson['direction'])
-                            save_data(st.session_state.data)
-                    else:
-                        students_in_dir = []
+                    student = get_student_by_id(lesson.get('student_id'))
+                    # (направление ученику добавляется при записи на разовое занятие, не при отрисовке)
+                    students_in_dir = [student] if student else []
                 else:
                     # Для регулярных - все ученики направления
-                    students_in_dir = [s for s in students if lesson['direction'] in s.get('directions', [])]
+                    students_in_dir = get_students_by_direction(lesson['direction'])
                 
                 if not students_in_dir:
                     st.info("Нет учеников на этом занятии.")
                     continue
 
-                # Инициализация структуры посещений
-                if date_key not in attendance:
-                    attendance[date_key] = {}
-                if lesson_key not in attendance[date_key]:
-                    attendance[date_key][lesson_key] = {}
+                # Отметки занятия; недостающие показываются по умолчанию, в общий документ
+                # попадает только то, что сохранено
+                lesson_marks = day_marks.get(lesson_key, {})
 
                 # Подготовка данных для таблицы
                 att_rows = []
@@ -1856,30 +4228,14 @@ def show_schedule_page():
                     student_id = s['id']
                     
                     # Проверка оплаты
-                    paid = False
-                    for p in payments:
-                        if p['student_id'] == student_id and p['direction'] == lesson['direction']:
-                            p_date = datetime.strptime(p['date'], "%Y-%m-%d").date()
-                            if p['type'] == "Абонемент" and p_date.month == selected_date.month and p_date.year == selected_date.year:
-                                paid = True
-                                break
-                            elif p['type'] in ["Разовое", "Пробное"] and p_date == selected_date:
-                                paid = True
-                                break
-                    
-                    # Инициализация записи о посещении
-                    if student_id not in attendance[date_key][lesson_key]:
-                        attendance[date_key][lesson_key][student_id] = {
-                            'present': False,
-                            'paid': paid,
-                            'note': ''
-                        }
+                    paid = get_data_store().is_lesson_paid(student_id, [lesson['direction']], selected_date)
                     
+                    mark = lesson_marks.get(student_id) or {'present': False, 'paid': paid, 'note': ''}
                     att_rows.append({
                         "Ученик": s['name'],
-                        "Присутствовал": attendance[date_key][lesson_key][student_id]['present'],
-                        "Оплачено": attendance[date_key][lesson_key][student_id]['paid'],
-                        "Примечание": attendance[date_key][lesson_key][student_id]['note']
+                        "Присутствовал": mark.get('present', False),
+                        "Оплачено": mark.get('paid', False),
+                        "Примечание": mark.get('note', '')
                     })
 
                 # Инициализация таблицы
@@ -1898,64 +4254,29 @@ def show_schedule_page():
                     }
                 )
 
-                # В блоке сохранения посещений замените проверку оплаты на:
                 if st.button("💾 Сохранить посещения", key=f"save_{att_key}"):
-                    for idx, s in enumerate(students_in_dir):
-                        s_id = s['id']
-                        new_status = {
+                    created = commit_attendance(date_key, [
+                        (lesson, s['id'], {
                             'present': bool(edited_df.iloc[idx]['Присутствовал']),
                             'paid': bool(edited_df.iloc[idx]['Оплачено']),
                             'note': str(edited_df.iloc[idx]['Примечание'])
-                        }
-                        
-                        # Проверяем текущий статус оплаты
-                        current_paid_status = attendance[date_key][lesson_key][s_id].get('paid', False)
-                        
-                        # Если галочка оплаты была изменена с False на True
-                        if new_status['paid'] and not current_paid_status:
-                            # Проверяем, нет ли уже платежа за это занятие
-                            payment_exists = any(
-                                p['student_id'] == s_id and 
-                                p['direction'] == lesson['direction'] and
-                                p['date'] == date_key
-                                for p in st.session_state.data['payments']
-                            )
-                            
-                            if not payment_exists:
-                                # Для разовых занятий берем стоимость из направления
-                                if lesson.get('type') == 'single':
-                                    direction = next(
-                                        (d for d in st.session_state.data['directions'] 
-                                        if d['name'] == lesson['direction']), None)
-                                    cost = direction.get('trial_cost', 0) if direction else 0
-                                    
-                                    new_payment = {
-                                        'id': str(uuid.uuid4()),
-                                        'student_id': s_id,
-                                        'date': date_key,
-                                        'amount': cost,
-                                        'direction': lesson['direction'],
-                                        'type': 'Разовое',
-                                        'notes': "Автоматически создано при отметке посещения"
-                                    }
-                                    st.session_state.data['payments'].append(new_payment)
-                                    st.success(f"Добавлена оплата за разовое занятие: {cost} ₽")
-                        
-                        # Обновляем статус посещения
-                        if date_key not in attendance:
-                            attendance[date_key] = {}
-                        if lesson_key not in attendance[date_key]:
-                            attendance[date_key][lesson_key] = {}
-                        
-                        attendance[date_key][lesson_key][s_id] = new_status
-                    
-                    save_data(st.session_state.data)
+                        })
+                        for idx, s in enumerate(students_in_dir)
+                    ])
+                    for payment in created:
+                        st.success(f"Добавлена оплата за разовое занятие: {payment['amount']} ₽")
+                    st.session_state.pop(f"day_att_{date_key}", None)
                     st.success("Посещения сохранены!")
                     time.sleep(0.3)
                     st.rerun()
     else:
         st.info(f"На {russian_day} занятий нет.")
 
+    # === Автоматическое расписание ===
+    if st.session_state.role == 'admin':
+        with st.expander("🤖 Автоматическое расписание", expanded=False):
+            show_schedule_solver()
+
     # === Общее расписание ===
     st.subheader("📋 Общее расписание")
     if schedule:
@@ -1975,13 +4296,7 @@ def show_schedule_page():
             teacher_filter = st.multiselect("Преподаватель", sorted(df['teacher'].unique()))
         with col3:
             # Улучшенный фильтр направлений с учетом поднаправлений
-            subdir_to_main = {
-                subdir: main 
-                for main, subdir in [
-                    (s['parent'], f"{s['parent']} ({s['name']})") 
-                    for s in st.session_state.data.get('subdirections', [])
-                ]
-            }
+            subdir_to_main = get_subdirection_parent_map()
             
             all_directions = set(df['direction'])
             main_directions = set()
@@ -2016,15 +4331,21 @@ def show_schedule_page():
             df = df[df['direction'].isin(selected_dirs)]
 
         # Добавляем столбец с кнопками удаления
+        df['pinned'] = df['pinned'].eq(True) if 'pinned' in df else False
         df['Удалить'] = False
         
         # Отображаем таблицу
         edited_df = st.data_editor(
-            df[['day', 'start_time', 'end_time', 'teacher', 'direction', 'Удалить']],
+            df[['day', 'start_time', 'end_time', 'teacher', 'direction', 'pinned', 'Удалить']],
             use_container_width=True,
             hide_index=True,
             key="full_schedule_editor",
             column_config={
+                "pinned": st.column_config.CheckboxColumn(
+                    "📌",
+                    help="Закреплённые занятия автоматическое расписание не переносит",
+                    default=False
+                ),
                 "Удалить": st.column_config.CheckboxColumn(
                     "Удалить",
                     help="Выберите занятия для удаления",
@@ -2034,47 +4355,45 @@ def show_schedule_page():
         )
         # Кнопка для сохранения изменений
         if st.button("💾 Сохранить изменения расписания", key="save_schedule_changes"):
-            # Обновляем данные расписания
-            for i, row in edited_df.iterrows():
-                if i < len(schedule) and not row['Удалить']:
-                    # Обновляем существующие занятия
-                    schedule[i]['day'] = row['day']
-                    schedule[i]['start_time'] = row['start_time']
-                    schedule[i]['end_time'] = row['end_time']
-                    schedule[i]['teacher'] = row['teacher']
-                    schedule[i]['direction'] = row['direction']
-            
-            # Удаляем отмеченные занятия
-            rows_to_delete = edited_df[edited_df['Удалить']].index
-            if len(rows_to_delete) > 0:
-                for index in sorted(rows_to_delete, reverse=True):
-                    if index < len(schedule):
-                        lesson_id = schedule[index]['id']
-                        del schedule[index]
-                        
-                        # Также удаляем связанные посещения
-                        for date_key in list(attendance.keys()):
-                            if lesson_id in attendance[date_key]:
-                                del attendance[date_key][lesson_id]
-                            if not attendance[date_key]:
-                                del attendance[date_key]
+            with committing():
+                store = get_data_store()
+                updates = {}
+                for i, row in edited_df.iterrows():
+                    if i < len(schedule) and not row['Удалить']:
+                        changes = {field: row[field] for field in ('day', 'start_time', 'end_time', 'teacher', 'direction')}
+                        changes['pinned'] = bool(row['pinned'])
+                        if any(schedule[i].get(field, False if field == 'pinned' else None) != value
+                               for field, value in changes.items()):
+                            updates[schedule[i]['id']] = changes
+                lesson_ids = [schedule[index]['id'] for index in edited_df[edited_df['Удалить']].index if index < len(schedule)]
             
-            save_data(st.session_state.data)
-            st.success("Изменения в расписании сохранены!")
-            st.rerun()
+                # Изменённые занятия проверяем на пересечения с учётом удаляемых
+                remaining = [lesson for lesson in store.records('schedule') if lesson['id'] not in lesson_ids]
+                changed = [store.resolve('schedule', {**store.get('schedule', lesson_id), **changes})
+                           for lesson_id, changes in updates.items()]
+                collisions = find_schedule_collisions(changed, remaining)
+                if collisions:
+                    st.error(f"Изменения не сохранены: найдено пересечений — {len(collisions)}")
+                    for kind, resource, _, first, second in collisions:
+                        other, lesson = (first, second) if second['id'] in updates else (second, first)
+                        st.write(f"• {lesson['direction']} {lesson['day']} {lesson['start_time']}-{lesson['end_time']}: "
+                                 f"{describe_schedule_conflict(kind, resource, other)}")
+                else:
+                    # Обновляем данные расписания (через хранилище, чтобы индексы дня и преподавателя не устарели)
+                    for lesson_id, changes in updates.items():
+                        store.update('schedule', lesson_id, changes)
+                
+                    # Удаляем отмеченные занятия вместе с их посещениями
+                    store.cascade_delete('schedule', lesson_ids)
+                
+                    save_data(st.session_state.data, sections=sorted(store.touched | {'schedule'}))
+                st.success("Изменения в расписании сохранены!")
+                st.rerun()
         # Кнопка для удаления выбранных занятий
         if st.button("🗑️ Удалить выбранные занятия"):
             rows_to_delete = edited_df[edited_df['Удалить']].index
             if len(rows_to_delete) > 0:
-                for index in sorted(rows_to_delete, reverse=True):
-                    lesson_id = schedule[index]['id']
-                    del schedule[index]
-                    for date_key in list(attendance.keys()):
-                        if lesson_id in attendance[date_key]:
-                            del attendance[date_key][lesson_id]
-                        if not attendance[date_key]:
-                            del attendance[date_key]
-                save_data(data)
+                delete_with_cascade('schedule', [schedule[index]['id'] for index in rows_to_delete])
                 st.success(f"Удалено {len(rows_to_delete)} занятий!")
                 st.rerun()
             else:
@@ -2091,6 +4410,134 @@ def show_schedule_page():
 
 
 
+def show_schedule_solver():
+    """Параметры и запуск автоматического составления недельного расписания"""
+    data = st.session_state.data
+    store = get_data_store()
+    
+    st.markdown("**Параметры направлений** (пусто — оставить как в текущем расписании)")
+    directions_df = pd.DataFrame([{
+        'id': d['id'],
+        'Направление': d['name'],
+        'Занятий в неделю': d.get('lessons_per_week'),
+        'Длительность, мин': d.get('lesson_duration')
+    } for d in data.get('directions', [])], columns=['id', 'Направление', 'Занятий в неделю', 'Длительность, мин'])
+    edited_directions = st.data_editor(
+        directions_df,
+        use_container_width=True,
+        hide_index=True,
+        disabled=['Направление'],
+        column_config={
+            'id': None,
+            'Занятий в неделю': st.column_config.NumberColumn(min_value=0, max_value=14, step=1),
+            'Длительность, мин': st.column_config.NumberColumn(min_value=15, max_value=180, step=15)
+        },
+        key="solver_directions_editor"
+    )
+    
+    st.markdown("**Доступность преподавателей** (например: 10:00-14:00, 16:00-20:00; пусто — не работает)")
+    availability_df = pd.DataFrame([
+        {'id': t['id'], 'Преподаватель': t['name'], **{day: format_availability(t, day) for day in WEEKDAYS}}
+        for t in data.get('teachers', [])
+    ], columns=['id', 'Преподаватель', *WEEKDAYS])
+    edited_availability = st.data_editor(
+        availability_df,
+        use_container_width=True,
+        hide_index=True,
+        disabled=['Преподаватель'],
+        column_config={'id': None},
+        key="solver_availability_editor"
+    )
+    
+    if st.button("💾 Сохранить параметры", key="save_solver_settings"):
+        with committing():
+            for _, row in edited_directions.iterrows():
+                changes = {
+                    'lessons_per_week': None if pd.isna(row['Занятий в неделю']) else int(row['Занятий в неделю']),
+                    'lesson_duration': None if pd.isna(row['Длительность, мин']) else int(row['Длительность, мин'])
+                }
+                direction = store.get('directions', row['id'])
+                if any(direction.get(field) != value for field, value in changes.items()):
+                    store.update('directions', row['id'], changes)
+            for _, row in edited_availability.iterrows():
+                teacher = store.get('teachers', row['id'])
+                availability = {day: str(row[day] or '').strip() for day in WEEKDAYS}
+                if any(format_availability(teacher, day) != availability[day] for day in WEEKDAYS):
+                    store.update('teachers', row['id'], {'availability': availability})
+            save_data(data, sections=sorted(store.touched | {'directions', 'teachers'}))
+        st.success("Параметры сохранены")
+        st.rerun()
+    
+    st.markdown("**Составление**")
+    lesson_labels = {l['id']: f"{l['day']} {l['start_time']} — {l['direction']} ({l['teacher']})"
+                     for l in data.get('schedule', [])}
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        pinned_lesson = st.selectbox(
+            "Перенести и закрепить занятие",
+            options=[None] + list(lesson_labels),
+            format_func=lambda x: "—" if x is None else lesson_labels[x],
+            key="solver_pin_lesson"
+        )
+    with col2:
+        pin_day = st.selectbox("День", WEEKDAYS, key="solver_pin_day", disabled=pinned_lesson is None)
+    with col3:
+        pin_time = st.selectbox("Начало", CALENDAR_SLOTS, key="solver_pin_time", disabled=pinned_lesson is None)
+    time_budget = st.slider("Время на поиск, сек", min_value=1, max_value=30, value=3, key="solver_budget")
+    
+    if st.button("🚀 Составить расписание", key="run_schedule_solver"):
+        solver = ScheduleSolver(data)
+        if pinned_lesson is not None:
+            solver.pin(pinned_lesson, pin_day, pin_time)
+        rows = solver.solve(time_budget)
+        st.session_state.schedule_proposal = {
+            'rows': rows,
+            'removed': [l['id'] for l in solver.removed],
+            'unplaced': sorted({u['direction'] for u in solver.unplaced}),
+            'initial_conflicts': len(solver.initial_conflicts),
+            'elapsed': solver.elapsed
+        }
+    
+    proposal = st.session_state.get('schedule_proposal')
+    if not proposal:
+        return
+    rows = proposal['rows']
+    conflicts = sum(row['conflict'] for row in rows)
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Конфликтов было", proposal['initial_conflicts'])
+    col2.metric("Конфликтов стало", conflicts)
+    col3.metric("Изменений", sum(row['status'] != 'same' for row in rows) + len(proposal['removed']))
+    col4.metric("Время поиска", f"{proposal['elapsed']:.1f} с")
+    if proposal['unplaced']:
+        st.warning("Не удалось разместить (нет преподавателя или занятие не помещается в день): " +
+                   ", ".join(proposal['unplaced']))
+    if proposal['removed']:
+        st.info(f"Лишних занятий к удалению: {len(proposal['removed'])}")
+    statuses = {'new': "🆕 Новое", 'moved': "✏️ Изменено", 'same': ""}
+    st.dataframe(
+        pd.DataFrame([{
+            'День': row['day'],
+            'Начало': row['start_time'],
+            'Конец': row['end_time'],
+            'Направление': row['direction'],
+            'Преподаватель': row['teacher'],
+            'Класс': row['classroom_name'],
+            '📌': row['pinned'],
+            'Статус': ("❌ Конфликт " if row['conflict'] else "") + statuses[row['status']]
+        } for row in rows]),
+        use_container_width=True,
+        hide_index=True
+    )
+    col1, col2 = st.columns(2)
+    if col1.button("✅ Применить", key="apply_schedule_proposal"):
+        apply_schedule_proposal(rows, proposal['removed'])
+        st.session_state.pop('schedule_proposal')
+        st.success("Расписание обновлено")
+        st.rerun()
+    if col2.button("✖ Отменить", key="discard_schedule_proposal"):
+        st.session_state.pop('schedule_proposal')
+        st.rerun()
+
 def show_materials_page():
     """Page to manage materials and purchases."""
     st.header("🛍️ Материалы и закупки")
@@ -2126,8 +4573,9 @@ def show_materials_page():
                         'supplier': supplier,
                         'link': link
                     }
-                    st.session_state.data['materials'].append(new_material)
-                    save_data(st.session_state.data)
+                    with committing():
+                        st.session_state.data['materials'].append(new_material)
+                        save_data(st.session_state.data, sections=['materials'])
                     st.success("Материал успешно добавлен!")
                     st.rerun()
                 else:
@@ -2164,21 +4612,22 @@ def show_materials_page():
         )
         
         if st.button("💾 Сохранить изменения"):
-            # Update material data from edited DataFrame
-            for idx, row in edited_df.iterrows():
-                material_id = st.session_state.data['materials'][idx]['id']
-                for m in st.session_state.data['materials']:
-                    if m['id'] == material_id:
-                        m['name'] = row['name']
-                        m['direction'] = row['direction']
-                        m['quantity'] = row['quantity']
-                        m['cost'] = row['cost']
-                        m['total_cost'] = row['total_cost']
-                        m['date'] = str(row['date'].date())
-                        m['supplier'] = row['supplier']
-                        break
+            with committing():
+                # Update material data from edited DataFrame
+                for idx, row in edited_df.iterrows():
+                    material_id = st.session_state.data['materials'][idx]['id']
+                    for m in st.session_state.data['materials']:
+                        if m['id'] == material_id:
+                            m['name'] = row['name']
+                            m['direction'] = row['direction']
+                            m['quantity'] = row['quantity']
+                            m['cost'] = row['cost']
+                            m['total_cost'] = row['total_cost']
+                            m['date'] = str(row['date'].date())
+                            m['supplier'] = row['supplier']
+                            break
             
-            save_data(st.session_state.data)
+                save_data(st.session_state.data)
             st.success("Изменения сохранены!")
             st.rerun()
     else:
@@ -2213,8 +4662,9 @@ def show_kanban_board():
                         'created': str(date.today()),
                         'created_by': st.session_state.username
                     }
-                    st.session_state.data['kanban_tasks']['ToDo'].append(new_task)
-                    save_data(st.session_state.data)
+                    with committing():
+                        st.session_state.data['kanban_tasks']['ToDo'].append(new_task)
+                        save_data(st.session_state.data, sections=['kanban_tasks'])
                     st.success("Задача добавлена!")
                     st.rerun()
                 else:
@@ -2278,14 +4728,16 @@ def show_kanban_board():
                                     next_status = 'Done'
                             
                             if next_status:
-                                st.session_state.data['kanban_tasks'][status].remove(task)
-                                st.session_state.data['kanban_tasks'][next_status].append(task)
-                                save_data(st.session_state.data)
+                                with committing():
+                                    st.session_state.data['kanban_tasks'][status].remove(task)
+                                    st.session_state.data['kanban_tasks'][next_status].append(task)
+                                    save_data(st.session_state.data, sections=['kanban_tasks'])
                                 st.rerun()
                         with col2:
                             if st.button("🗑️", key=f"del_{task['id']}"):
-                                st.session_state.data['kanban_tasks'][status].remove(task)
-                                save_data(st.session_state.data)
+                                with committing():
+                                    st.session_state.data['kanban_tasks'][status].remove(task)
+                                    save_data(st.session_state.data, sections=['kanban_tasks'])
                                 st.rerun()
             else:
                 st.info("Нет задач")
@@ -2297,7 +4749,7 @@ def show_bulk_upload_page():
     # Select data type to upload
     data_type = st.selectbox(
         "Тип данных для загрузки",
-        ["Направления", "Ученики", "Родители", "Преподаватели", "Материалы","Расписание"]
+        ["Направления", "Ученики", "Родители", "Преподаватели", "Материалы", "Расписание", "Оплаты"]
     )
     
     # Upload CSV file
@@ -2316,194 +4768,282 @@ def show_bulk_upload_page():
             
             # Process based on data type
             if st.button("Импортировать данные"):
-                try:
-                    if data_type == "Направления":
-                        required_cols = ['name', 'cost']
-                        if all(col in df.columns for col in required_cols):
-                            new_directions = []
-                            for _, row in df.iterrows():
-                                new_direction = {
-                                    'id': str(uuid.uuid4()),
-                                    'name': row['name'],
-                                    'description': row.get('description', ''),
-                                    'cost': float(row['cost']),
-                                    'trial_cost': float(row.get('trial_cost', row['cost'] * 0.2)),
-                                    'min_age': int(row.get('min_age', 3)),
-                                    'max_age': int(row.get('max_age', 12)),
-                                    'gender': row.get('gender', None)
-                                }
-                                new_directions.append(new_direction)
+                with committing():
+                    try:
+                        if data_type == "Направления":
+                            required_cols = ['name', 'cost']
+                            if all(col in df.columns for col in required_cols):
+                                new_directions = []
+                                for _, row in df.iterrows():
+                                    new_direction = {
+                                        'id': str(uuid.uuid4()),
+                                        'name': row['name'],
+                                        'description': row.get('description', ''),
+                                        'cost': float(row['cost']),
+                                        'trial_cost': float(row.get('trial_cost', row['cost'] * 0.2)),
+                                        'min_age': int(row.get('min_age', 3)),
+                                        'max_age': int(row.get('max_age', 12)),
+                                        'gender': row.get('gender', None)
+                                    }
+                                    new_directions.append(new_direction)
                             
-                            st.session_state.data['directions'].extend(new_directions)
-                            st.success(f"Добавлено {len(new_directions)} направлений!")
+                                for record in new_directions:
+                                    get_data_store().insert('directions', record)
+                                st.success(f"Добавлено {len(new_directions)} направлений!")
                     
-                    elif data_type == "Ученики":
-                        required_cols = ['name', 'dob', 'gender']
-                        if all(col in df.columns for col in required_cols):
-                            new_students = []
-                            for _, row in df.iterrows():
-                                # Обработка родителя
-                                parent_id = None
-                                if 'parent_id' in row and pd.notna(row['parent_id']):
-                                    parent_id = row['parent_id']
-                                elif 'parent_name' in row and pd.notna(row['parent_name']):
-                                    # Ищем существующего родителя или создаем нового
-                                    parent_phone = str(row['parent_phone']) if 'parent_phone' in row else ''
-                                    existing_parent = next(
-                                        (p for p in st.session_state.data['parents'] 
-                                        if p['name'] == row['parent_name'] and 
-                                            (not parent_phone or p['phone'] == parent_phone)),
-                                        None
-                                    )
-                                    if existing_parent:
-                                        parent_id = existing_parent['id']
-                                    else:
-                                        new_parent = {
-                                            'id': str(uuid.uuid4()),
-                                            'name': row['parent_name'],
-                                            'phone': parent_phone,
-                                            'children_ids': []
-                                        }
-                                        st.session_state.data['parents'].append(new_parent)
-                                        parent_id = new_parent['id']
+                        elif data_type == "Ученики":
+                            required_cols = ['name', 'dob', 'gender']
+                            if all(col in df.columns for col in required_cols):
+                                new_students = []
+                                for _, row in df.iterrows():
+                                    # Обработка родителя
+                                    parent_id = None
+                                    if 'parent_id' in row and pd.notna(row['parent_id']):
+                                        parent_id = row['parent_id']
+                                    elif 'parent_name' in row and pd.notna(row['parent_name']):
+                                        # Ищем существующего родителя или создаем нового
+                                        parent_phone = str(row['parent_phone']) if 'parent_phone' in row else ''
+                                        existing_parent = next(
+                                            (p for p in get_data_store().find_all_by_name('parents', row['parent_name'])
+                                            if not parent_phone or p['phone'] == parent_phone),
+                                            None
+                                        )
+                                        if existing_parent:
+                                            parent_id = existing_parent['id']
+                                        else:
+                                            new_parent = {
+                                                'id': str(uuid.uuid4()),
+                                                'name': row['parent_name'],
+                                                'phone': parent_phone,
+                                                'children_ids': []
+                                            }
+                                            get_data_store().insert('parents', new_parent)
+                                            parent_id = new_parent['id']
                                 
-                                # Обработка направлений
-                                directions = []
-                                if 'directions' in row and pd.notna(row['directions']):
-                                    directions = [d.strip() for d in str(row['directions']).split(',')]
+                                    # Обработка направлений
+                                    directions = []
+                                    if 'directions' in row and pd.notna(row['directions']):
+                                        directions = [d.strip() for d in str(row['directions']).split(',')]
                                 
-                                new_student = {
-                                    'id': str(uuid.uuid4()),
-                                    'name': row['name'],
-                                    'dob': row['dob'],
-                                    'gender': row['gender'],
-                                    'parent_id': parent_id,
-                                    'directions': directions,
-                                    'notes': row.get('notes', ''),
-                                    'registration_date': row.get('registration_date', str(date.today()))
-                                }
-                                new_students.append(new_student)
+                                    new_student = {
+                                        'id': str(uuid.uuid4()),
+                                        'name': row['name'],
+                                        'dob': row['dob'],
+                                        'gender': row['gender'],
+                                        'parent_id': parent_id,
+                                        'directions': directions,
+                                        'notes': row.get('notes', ''),
+                                        'registration_date': row.get('registration_date', str(date.today()))
+                                    }
+                                    new_students.append(new_student)
                             
-                            st.session_state.data['students'].extend(new_students)
-                            save_data(st.session_state.data)
-                            st.success(f"Добавлено {len(new_students)} учеников!")
+                                for record in new_students:
+                                    get_data_store().insert('students', record)
+                                save_data(st.session_state.data)
+                                st.success(f"Добавлено {len(new_students)} учеников!")
                     
-                    elif data_type == "Родители":
-                        required_cols = ['name', 'phone']
-                        if all(col in df.columns for col in required_cols):
-                            new_parents = []
-                            for _, row in df.iterrows():
-                                new_parent = {
-                                    'id': str(uuid.uuid4()),
-                                    'name': row['name'],
-                                    'phone': str(row['phone']),
-                                    'email': row.get('email', ''),
-                                    'children_ids': []
-                                }
-                                new_parents.append(new_parent)
+                        elif data_type == "Родители":
+                            required_cols = ['name', 'phone']
+                            if all(col in df.columns for col in required_cols):
+                                new_parents = []
+                                for _, row in df.iterrows():
+                                    new_parent = {
+                                        'id': str(uuid.uuid4()),
+                                        'name': row['name'],
+                                        'phone': str(row['phone']),
+                                        'email': row.get('email', ''),
+                                        'children_ids': []
+                                    }
+                                    new_parents.append(new_parent)
                             
-                            st.session_state.data['parents'].extend(new_parents)
-                            st.success(f"Добавлено {len(new_parents)} родителей!")
+                                for record in new_parents:
+                                    get_data_store().insert('parents', record)
+                                st.success(f"Добавлено {len(new_parents)} родителей!")
                     
-                    elif data_type == "Преподаватели":
-                        required_cols = ['name']
-                        if all(col in df.columns for col in required_cols):
-                            new_teachers = []
-                            for _, row in df.iterrows():
-                                # Обработка направлений - разбиваем строку и сопоставляем с существующими направлениями
-                                raw_directions = row.get('directions', '')
-                                if pd.notna(raw_directions):
-                                    # Разбиваем строку направлений по запятым
-                                    raw_dir_list = [d.strip() for d in raw_directions.split(',')]
-                                    valid_directions = []
+                        elif data_type == "Преподаватели":
+                            required_cols = ['name']
+                            if all(col in df.columns for col in required_cols):
+                                new_teachers = []
+                                for _, row in df.iterrows():
+                                    # Обработка направлений - разбиваем строку и сопоставляем с существующими направлениями
+                                    raw_directions = row.get('directions', '')
+                                    if pd.notna(raw_directions):
+                                        # Разбиваем строку направлений по запятым
+                                        raw_dir_list = [d.strip() for d in raw_directions.split(',')]
+                                        valid_directions = []
                                     
-                                    # Сопоставляем с существующими направлениями
-                                    for dir_name in raw_dir_list:
-                                        # Ищем точное совпадение
-                                        exact_match = next((d for d in st.session_state.data['directions'] 
-                                                          if d['name'].lower() == dir_name.lower()), None)
-                                        if exact_match:
-                                            valid_directions.append(exact_match['name'])
-                                        else:
-                                            # Если точного совпадения нет, ищем частичное
-                                            partial_match = next((d for d in st.session_state.data['directions'] 
-                                                                if dir_name.lower() in d['name'].lower()), None)
-                                            if partial_match:
-                                                valid_directions.append(partial_match['name'])
+                                        # Сопоставляем с существующими направлениями
+                                        for dir_name in raw_dir_list:
+                                            # Ищем точное совпадение
+                                            exact_match = next((d for d in st.session_state.data['directions'] 
+                                                              if d['name'].lower() == dir_name.lower()), None)
+                                            if exact_match:
+                                                valid_directions.append(exact_match['name'])
+                                            else:
+                                                # Если точного совпадения нет, ищем частичное
+                                                partial_match = next((d for d in st.session_state.data['directions'] 
+                                                                    if dir_name.lower() in d['name'].lower()), None)
+                                                if partial_match:
+                                                    valid_directions.append(partial_match['name'])
                                     
-                                    directions = list(set(valid_directions))  # Удаляем дубликаты
-                                else:
-                                    directions = []
+                                        directions = list(set(valid_directions))  # Удаляем дубликаты
+                                    else:
+                                        directions = []
                                 
-                                new_teacher = {
-                                    'id': str(uuid.uuid4()),
-                                    'name': row['name'],
-                                    'phone': str(row.get('phone', '')),
-                                    'email': row.get('email', ''),
-                                    'directions': directions,
-                                    'notes': row.get('notes', ''),
-                                    'hire_date': str(date.today())
-                                }
-                                new_teachers.append(new_teacher)
+                                    new_teacher = {
+                                        'id': str(uuid.uuid4()),
+                                        'name': row['name'],
+                                        'phone': str(row.get('phone', '')),
+                                        'email': row.get('email', ''),
+                                        'directions': directions,
+                                        'notes': row.get('notes', ''),
+                                        'hire_date': str(date.today())
+                                    }
+                                    new_teachers.append(new_teacher)
                             
-                            st.session_state.data['teachers'].extend(new_teachers)
-                            st.success(f"Добавлено {len(new_teachers)} преподавателей!")
+                                for record in new_teachers:
+                                    get_data_store().insert('teachers', record)
+                                st.success(f"Добавлено {len(new_teachers)} преподавателей!")
                             
                     
-                    elif data_type == "Материалы":
-                        required_cols = ['name', 'cost', 'direction']
-                        if all(col in df.columns for col in required_cols):
-                            new_materials = []
-                            for _, row in df.iterrows():
-                                new_material = {
-                                    'id': str(uuid.uuid4()),
-                                    'name': row['name'],
-                                    'cost': float(row['cost']),
-                                    'quantity': int(row.get('quantity', 1)),
-                                    'total_cost': float(row['cost']) * int(row.get('quantity', 1)),
-                                    'direction': row['direction'],
-                                    'date': str(date.today()),
-                                    'supplier': row.get('supplier', ''),
-                                    'link': row.get('link', '')
-                                }
-                                new_materials.append(new_material)
+                        elif data_type == "Материалы":
+                            required_cols = ['name', 'cost', 'direction']
+                            if all(col in df.columns for col in required_cols):
+                                new_materials = []
+                                for _, row in df.iterrows():
+                                    new_material = {
+                                        'id': str(uuid.uuid4()),
+                                        'name': row['name'],
+                                        'cost': float(row['cost']),
+                                        'quantity': int(row.get('quantity', 1)),
+                                        'total_cost': float(row['cost']) * int(row.get('quantity', 1)),
+                                        'direction': row['direction'],
+                                        'date': str(date.today()),
+                                        'supplier': row.get('supplier', ''),
+                                        'link': row.get('link', '')
+                                    }
+                                    new_materials.append(new_material)
                             
-                            st.session_state.data['materials'].extend(new_materials)
-                            st.success(f"Добавлено {len(new_materials)} материалов!")
-                    # --- НОВЫЙ БЛОК ДЛЯ РАСПИСАНИЯ ---
-                    elif data_type == "Расписание":
-                        required_cols = ['direction', 'teacher', 'start_time', 'end_time', 'day']
-                        if all(col in df.columns for col in required_cols):
-                            new_schedule_entries = []
-                            for _, row in df.iterrows():
-                                # Проверка существования направления и преподавателя (опционально, но рекомендуется)
-                                direction_exists = any(d['name'] == row['direction'] for d in st.session_state.data['directions'])
-                                teacher_exists = any(t['name'] == row['teacher'] for t in st.session_state.data['teachers'])
-
-                                if not direction_exists:
-                                    st.warning(f"Направление '{row['direction']}' не найдено, занятие будет добавлено, но без привязки к существующему направлению.")
-                                if not teacher_exists:
-                                    st.warning(f"Преподаватель '{row['teacher']}' не найден, занятие будет добавлено, но без привязки к существующему преподавателю.")
+                                st.session_state.data['materials'].extend(new_materials)
+                                st.success(f"Добавлено {len(new_materials)} материалов!")
+                        elif data_type == "Оплаты":
+                            # Ученик задаётся колонкой student_id или student_name; повторная загрузка
+                            # того же файла не создаёт дублей благодаря ключу оплаты
+                            required_cols = ['direction', 'date', 'amount']
+                            if all(col in df.columns for col in required_cols) and (
+                                    'student_id' in df.columns or 'student_name' in df.columns):
+                                store = get_data_store()
+                                added, skipped, unknown = 0, 0, []
+                                for _, row in df.iterrows():
+                                    student = None
+                                    if 'student_id' in row and pd.notna(row['student_id']):
+                                        student = get_student_by_id(str(row['student_id']))
+                                    elif 'student_name' in row and pd.notna(row['student_name']):
+                                        student = store.find_by_name('students', row['student_name'])
+                                    if student is None:
+                                        unknown.append(str(row.get('student_name', row.get('student_id', ''))))
+                                        continue
+
+                                    p_type = row.get('type', 'Абонемент')
+                                    _, is_new = store.upsert_payment({
+                                        'id': str(uuid.uuid4()),
+                                        'student_id': student['id'],
+                                        'date': str(pd.to_datetime(row['date']).date()),
+                                        'amount': float(row['amount']),
+                                        'direction': row['direction'],
+                                        'type': p_type if pd.notna(p_type) else 'Абонемент',
+                                        'notes': row.get('notes', '') if pd.notna(row.get('notes', '')) else ''
+                                    })
+                                    if is_new:
+                                        added += 1
+                                    else:
+                                        skipped += 1
+
+                                st.success(f"Добавлено {added} оплат, пропущено дублей: {skipped}")
+                                if unknown:
+                                    st.warning(f"Ученики не найдены: {', '.join(unknown)}")
+                            else:
+                                st.error("В файле нет обязательных колонок: direction, date, amount "
+                                         "и student_id или student_name")
+                                return
+                        # --- НОВЫЙ БЛОК ДЛЯ РАСПИСАНИЯ ---
+                        elif data_type == "Расписание":
+                            required_cols = ['direction', 'teacher', 'start_time', 'end_time', 'day']
+                            if all(col in df.columns for col in required_cols):
+                                store = get_data_store()
+                                new_schedule_entries = []
+                                rows_by_id = {}
+                                report = []
+                                # Класс в файле задаётся id или названием; в занятии хранится id
+                                classrooms = st.session_state.data.get('classrooms', [])
+                                room_ids = {str(r['id']): r['id'] for r in classrooms}
+                                room_ids.update({str(r.get('name', '')).strip().lower(): r['id'] for r in classrooms
+                                                 if r.get('name')})
+                                for index, row in df.iterrows():
+                                    # Проверка существования направления и преподавателя (опционально, но рекомендуется)
+                                    direction_exists = store.find_by_name('directions', row['direction']) is not None
+                                    teacher_exists = store.find_by_name('teachers', row['teacher']) is not None
+
+                                    if not direction_exists:
+                                        st.warning(f"Направление '{row['direction']}' не найдено, занятие будет добавлено, но без привязки к существующему направлению.")
+                                    if not teacher_exists:
+                                        st.warning(f"Преподаватель '{row['teacher']}' не найден, занятие будет добавлено, но без привязки к существующему преподавателю.")
                                 
-                                new_schedule_entry = {
-                                    'id': str(uuid.uuid4()),
-                                    'direction': row['direction'],
-                                    'teacher': row['teacher'],
-                                    'start_time': str(row['start_time']), # Время должно быть в формате HH:MM
-                                    'end_time': str(row['end_time']),     # Время должно быть в формате HH:MM
-                                    'day': row['day'] # День недели, например "Понедельник"
-                                }
-                                new_schedule_entries.append(new_schedule_entry)
+                                    new_schedule_entry = {
+                                        'id': str(uuid.uuid4()),
+                                        'direction': row['direction'],
+                                        'teacher': row['teacher'],
+                                        'start_time': str(row['start_time']), # Время должно быть в формате HH:MM
+                                        'end_time': str(row['end_time']),     # Время должно быть в формате HH:MM
+                                        'day': row['day'] # День недели, например "Понедельник"
+                                    }
+                                    if 'classroom' in df.columns and pd.notna(row['classroom']):
+                                        room = str(row['classroom']).strip()
+                                        room_id = room_ids.get(room, room_ids.get(room.lower()))
+                                        if room_id is None:
+                                            report.append({
+                                                'Строка': index + 2,
+                                                'День': row['day'],
+                                                'Занятие': f"{row['direction']} {row['start_time']}-{row['end_time']}",
+                                                'Пересекается с': "класс не найден",
+                                                'Ресурс': f"Класс {room}"
+                                            })
+                                            continue
+                                        new_schedule_entry['classroom'] = room_id
+                                    new_schedule_entries.append(store.resolve('schedule', new_schedule_entry))
+                                    rows_by_id[new_schedule_entry['id']] = index + 2  # строка файла с учётом заголовка
+                            
+                                # Весь файл проверяем одним проходом: пересечения строк между собой и с расписанием
+                                collisions = find_schedule_collisions(new_schedule_entries, store.records('schedule'))
+                                if collisions or report:
+                                    if report:
+                                        st.error(f"Импорт отменён: не найдено классов — {len(report)}")
+                                    if collisions:
+                                        st.error(f"Импорт отменён: найдено пересечений — {len(collisions)}")
+                                    for kind, resource, day, first, second in collisions:
+                                        lesson, other = (second, first) if second['id'] in rows_by_id else (first, second)
+                                        report.append({
+                                            'Строка': rows_by_id[lesson['id']],
+                                            'День': day,
+                                            'Занятие': f"{lesson['direction']} {lesson['start_time']}-{lesson['end_time']}",
+                                            'Пересекается с': (f"строка {rows_by_id[other['id']]}" if other['id'] in rows_by_id
+                                                               else "расписание") +
+                                                              f": {other['direction']} {other['start_time']}-{other['end_time']}",
+                                            'Ресурс': schedule_resource_name(kind, resource)
+                                        })
+                                    st.dataframe(pd.DataFrame(report).sort_values('Строка'), hide_index=True)
+                                    return
                             
-                            st.session_state.data['schedule'].extend(new_schedule_entries)
-                            st.success(f"Добавлено {len(new_schedule_entries)} занятий в расписание!")
-                    # --- КОНЕЦ НОВОГО БЛОКА ---
+                                for record in new_schedule_entries:
+                                    store.insert('schedule', record)
+                                st.success(f"Добавлено {len(new_schedule_entries)} занятий в расписание!")
+                        # --- КОНЕЦ НОВОГО БЛОКА ---
                     
-                    save_data(st.session_state.data)
-                    st.rerun()
+                        save_data(st.session_state.data)
+                        st.rerun()
                 
-                except Exception as e:
-                    st.error(f"Ошибка при импорте данных: {str(e)}")
+                    except Exception as e:
+                        st.error(f"Ошибка при импорте данных: {str(e)}")
         
         except Exception as e:
             st.error(f"Ошибка при чтении файла: {str(e)}")
@@ -2523,11 +5063,32 @@ def show_data_management_page():
                 st.success("Резервная копия создана!")
     
     with col2:
-        if st.button("🧹 Оптимизировать данные"):
-            if archive_data():
-                st.success("Данные оптимизированы и архивированы!")
-                st.rerun()
-    
+        if st.button("🧹 Оптимизировать данные",
+                     help="Закрытые месяцы оплат и посещаемости переносятся в помесячный архив автоматически; "
+                          "кнопка делает это сразу"):
+            archive_data()
+
+    # При сохранении проверяются только изменённые записи; полная проверка — по кнопке
+    if st.button("🔎 Проверить целостность данных"):
+        errors = get_data_store().validate_all()
+        if errors:
+            for error in errors:
+                st.error(f"Ошибка целостности: {error}")
+        else:
+            st.success("Ссылки в данных целостны")
+
+    partitions = st.session_state.data.get('_partitions', {})
+    if any(partitions.get(section) for section in PARTITIONED_SECTIONS):
+        with st.expander("📦 Помесячный архив оплат и посещаемости"):
+            rows = [
+                {'Месяц': month, 'Оплат': partitions.get('payments', {}).get(month, {}).get('count', 0),
+                 'Сумма оплат': partitions.get('payments', {}).get(month, {}).get('total', 0),
+                 'Отметок посещаемости': partitions.get('attendance', {}).get(month, {}).get('count', 0)}
+                for month in sorted(set(archived_months('payments')) | set(archived_months('attendance')))
+            ]
+            st.dataframe(pd.DataFrame(rows), hide_index=True, use_container_width=True)
+            st.caption(f"В рабочих данных хранятся записи начиная с {live_window_start()}")
+
     st.markdown("---")
     st.subheader("Экспорт данных")
     
@@ -2569,15 +5130,212 @@ def show_data_management_page():
                 file_name=f"center_data_{datetime.now().strftime('%Y%m%d')}.csv",
                 mime="text/csv"
             )
-import requests
-
-GITHUB_API = "https://api.github.com"
+# --- История версий Gist ---
+# Список версий загружается постранично и без содержимого, а сами версии —
+# только по запросу, параллельно и с кэшем по SHA (версии Gist неизменяемы).
+VERSION_PAGE_SIZE = 10
+VERSION_LIST_TTL_SECONDS = 30
+VERSION_CACHE_SIZE = 30
+VERSION_FETCH_WORKERS = 4
+
+class GistVersionCache:
+    """Кэш содержимого версий Gist и пул потоков для их загрузки"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=VERSION_FETCH_WORKERS, thread_name_prefix="gist-version")
+        self.documents = OrderedDict()  # sha -> {раздел: компактный JSON}
+        self.pages = {}  # (gist_id, страница) -> (время загрузки, список версий)
+
+    def list_versions(self, client, gist_id, page):
+        """Метаданные версий на странице (без содержимого файлов)"""
+        with self.lock:
+            cached = self.pages.get((gist_id, page))
+        if cached and time.monotonic() - cached[0] < VERSION_LIST_TTL_SECONDS:
+            return cached[1]
+        resp = client.get(f"/gists/{gist_id}/commits", params={"per_page": VERSION_PAGE_SIZE, "page": page})
+        resp.raise_for_status()
+        commits = [
+            {'version': c['version'], 'committed_at': c['committed_at'],
+             'change_status': c.get('change_status', {})}
+            for c in resp.json()
+        ]
+        with self.lock:
+            self.pages[(gist_id, page)] = (time.monotonic(), commits)
+        return commits
+
+    def _fetch(self, client, gist_id, sha):
+        """Разделы версии как {раздел: компактный JSON}"""
+        resp = client.get(f"/gists/{gist_id}/{sha}")
+        resp.raise_for_status()
+        files = resp.json().get("files", {})
+        # Усечённые файлы догружаются по raw_url тем же клиентом
+        for file_info in files.values():
+            if file_info.get('truncated') and file_info.get('raw_url'):
+                raw = client.get(file_info['raw_url'])
+                raw.raise_for_status()
+                file_info['content'], file_info['truncated'] = raw.text, False
+        if is_sectioned_gist(files):
+            # Файлы разделов уже лежат в компактном виде — разбирать их не нужно
+            return {
+                section_from_file_name(name): info.get('content') or 'null'
+                for name, info in files.items() if section_from_file_name(name)
+            }
+        document = assemble_gist_document(files)
+        if not isinstance(document, dict):
+            return None
+        return {section: serialize_section(value) for section, value in document.items()}
+
+    def _ensure(self, client, gist_id, shas):
+        """Догружает недостающие в кэше версии параллельно; возвращает {sha: Exception} для ошибок"""
+        with self.lock:
+            missing = [sha for sha in dict.fromkeys(shas) if sha not in self.documents]
+        futures = {sha: self.executor.submit(self._fetch, client, gist_id, sha) for sha in missing}
+        errors = {}
+        for sha, future in futures.items():
+            try:
+                sections = future.result()
+            except Exception as e:
+                errors[sha] = e
+                continue
+            with self.lock:
+                self.documents[sha] = sections
+                while len(self.documents) > VERSION_CACHE_SIZE:
+                    self.documents.popitem(last=False)
+        return errors
+
+    def fetch_many(self, client, gist_id, shas):
+        """
+        Возвращает {sha: документ | Exception} для запрошенных версий.
+        Недостающие в кэше версии загружаются параллельно.
+        """
+        results = self._ensure(client, gist_id, shas)
+        with self.lock:
+            for sha in shas:
+                if sha in self.documents:
+                    self.documents.move_to_end(sha)
+                    sections = self.documents[sha]
+                    results[sha] = None if sections is None else {
+                        section: json.loads(text) for section, text in sections.items()
+                    }
+        return results
+
+    def sections(self, client, gist_id, sha):
+        """Разделы версии в виде JSON-строк; разбираются по одному при сравнении"""
+        error = self._ensure(client, gist_id, [sha]).get(sha)
+        if error:
+            raise error
+        with self.lock:
+            return self.documents.get(sha) or {}
+
+@st.cache_resource
+def get_version_cache():
+    return GistVersionCache()
+
+# --- Сравнение версий ---
+# Записи сопоставляются по id (посещаемость — по дате, занятию и ученику).
+# Разделы разбираются и сравниваются по одному, поэтому в памяти одновременно
+# находится только один раздел каждой из сравниваемых версий.
+DIFF_SECTIONS = ['students', 'payments', 'schedule', 'attendance']
+CURRENT_VERSION = "current"  # «Версия» для текущих данных
+
+def iter_section_entities(section, value):
+    """Пары (ключ, запись) раздела"""
+    if section == 'attendance':
+        for day, lessons in (value or {}).items():
+            for lesson_id, marks in (lessons or {}).items():
+                for student_id, mark in (marks or {}).items():
+                    yield (day, lesson_id, student_id), mark
+    else:
+        for record in value or []:
+            yield record.get('id'), record
+
+def diff_section(section, old_value, new_value):
+    """
+    Добавленные и удалённые записи раздела как (ключ, запись),
+    изменённые — как (ключ, новая запись, {поле: (было, стало)})
+    """
+    old_entities = dict(iter_section_entities(section, old_value))
+    added, changed = [], []
+    for key, record in iter_section_entities(section, new_value):
+        previous = old_entities.pop(key, None)
+        if previous is None:
+            added.append((key, record))
+        elif previous != record:
+            fields = sorted(set(previous) | set(record))
+            changed.append((key, record, {
+                field: (previous.get(field), record.get(field))
+                for field in fields if previous.get(field) != record.get(field)
+            }))
+    # Всё, что не встретилось в новой версии, удалено
+    return {'added': added, 'removed': list(old_entities.items()), 'changed': changed}
+
+def diff_documents(load_old, load_new, sections=DIFF_SECTIONS):
+    """Сравнивает документы по разделам; load_old/load_new возвращают значение раздела по имени"""
+    for section in sections:
+        yield section, diff_section(section, load_old(section), load_new(section))
+
+def version_section_loader(client, gist_id, sha):
+    """Загрузчик разделов версии Gist (или текущих данных для CURRENT_VERSION)"""
+    if sha == CURRENT_VERSION:
+        return lambda section: st.session_state.data.get(section)
+    texts = get_version_cache().sections(client, gist_id, sha)
+    return lambda section: json.loads(texts[section]) if section in texts else None
+
+def describe_entity(section, key, record):
+    """Короткое описание записи для таблицы изменений"""
+    record = record or {}
+    if section == 'attendance':
+        day, _, student_id = key
+        student = get_student_by_id(student_id)
+        return f"{day}: {student['name'] if student else student_id}"
+    if section == 'students':
+        return record.get('name', key)
+    if section == 'payments':
+        student = get_student_by_id(record.get('student_id'))
+        return f"{record.get('date', '')} {student['name'] if student else ''} {record.get('amount', '')} ₽".strip()
+    if section == 'schedule':
+        return f"{record.get('day', '')} {record.get('start_time', '')} {record.get('direction', '')}"
+    return str(key)
+
+def show_version_diff(client, gist_id, base_sha, target_sha, labels):
+    """Выводит структурное сравнение двух версий и выборочное восстановление"""
+    base_name, target_name = labels[base_sha], labels[target_sha]
+    st.markdown(f"**{base_name}** → **{target_name}**")
+    load_base = version_section_loader(client, gist_id, base_sha)
+    load_target = version_section_loader(client, gist_id, target_sha)
+
+    changed_sections = []
+    for section, diff in diff_documents(load_base, load_target):
+        counts = {kind: len(records) for kind, records in diff.items()}
+        st.markdown(f"**{section}**: +{counts['added']} / −{counts['removed']} / ✎{counts['changed']}")
+        if not any(counts.values()):
+            continue
+        changed_sections.append(section)
+        rows = [
+            {'Изменение': 'добавлено', 'Запись': describe_entity(section, key, record), 'Поля': ''}
+            for key, record in diff['added']
+        ] + [
+            {'Изменение': 'удалено', 'Запись': describe_entity(section, key, record), 'Поля': ''}
+            for key, record in diff['removed']
+        ] + [
+            {'Изменение': 'изменено', 'Запись': describe_entity(section, key, record),
+             'Поля': '; '.join(f"{f}: {old} → {new}" for f, (old, new) in fields.items())}
+            for key, record, fields in diff['changed']
+        ]
+        st.dataframe(pd.DataFrame(rows), use_container_width=True, hide_index=True)
 
-def github_headers():
-    return {
-        "Authorization": f"token {st.secrets['GITHUB_TOKEN']}",
-        "Accept": "application/vnd.github.v3+json"
-    }
+    if base_sha == CURRENT_VERSION or st.session_state.role != 'admin':
+        return
+    available = sorted(get_version_cache().sections(client, gist_id, base_sha))
+    chosen = st.multiselect(f"Разделы для восстановления из «{base_name}»", available,
+                            default=[s for s in changed_sections if s in available])
+    if st.button("↩️ Восстановить выбранные разделы", disabled=not chosen):
+        with committing():
+            for section in chosen:
+                st.session_state.data[section] = load_base(section)
+            if save_data(st.session_state.data, sections=chosen):
+                st.success(f"Восстановлены разделы: {', '.join(chosen)}")
 
 def show_version_history_page():
     """Страница для просмотра истории изменений данных через GitHub API"""
@@ -2585,53 +5343,89 @@ def show_version_history_page():
 
     try:
         gist_id = st.secrets["GIST_ID"]
-        commits_url = f"{GITHUB_API}/gists/{gist_id}/commits"
-        commits_resp = requests.get(commits_url, headers=github_headers())
-        commits_resp.raise_for_status()
+        client = github_client()
+        cache = get_version_cache()
+        page = st.session_state.setdefault('history_page', 1)
+        opened = st.session_state.setdefault('history_opened', set())
 
-        commits = commits_resp.json()
-        if not commits:
+        commits = cache.list_versions(client, gist_id, page)
+        if not commits and page == 1:
             st.info("История изменений не найдена")
             return
 
-        st.subheader(f"Последние изменения (всего {len(commits)} версий)")
+        st.subheader(f"Изменения, страница {page}")
+        nav_prev, nav_all, nav_next = st.columns([1, 2, 1])
+        with nav_prev:
+            if page > 1 and st.button("← Новее"):
+                st.session_state.history_page = page - 1
+                st.rerun()
+        with nav_all:
+            if commits and st.button("Загрузить все версии на странице"):
+                opened.update(c['version'] for c in commits)
+        with nav_next:
+            if len(commits) == VERSION_PAGE_SIZE and st.button("Старее →"):
+                st.session_state.history_page = page + 1
+                st.rerun()
+
+        if commits:
+            with st.expander("🔍 Сравнение версий", expanded='history_diff' in st.session_state):
+                labels = {CURRENT_VERSION: "Текущие данные"}
+                labels.update({c['version']: f"Версия от {c['committed_at']}" for c in commits})
+                choices = list(labels)
+                col_base, col_target = st.columns(2)
+                base_sha = col_base.selectbox("Версия", choices[1:], format_func=labels.get)
+                target_sha = col_target.selectbox("Сравнить с", choices, format_func=labels.get)
+                if st.button("Сравнить"):
+                    st.session_state.history_diff = (base_sha, target_sha)
+                if st.session_state.get('history_diff') == (base_sha, target_sha):
+                    show_version_diff(client, gist_id, base_sha, target_sha, labels)
+
+        # Содержимое открытых версий страницы загружается одним параллельным пакетом
+        documents = cache.fetch_many(client, gist_id, [c['version'] for c in commits if c['version'] in opened])
 
-        for i, commit in enumerate(commits[:10]):
+        for commit in commits:
             commit_id = commit["version"]
             committed_at = commit["committed_at"]
+            changes = commit.get("change_status") or {}
+            title = f"Версия от {committed_at}"
+            if changes:
+                title += f" (+{changes.get('additions', 0)} / -{changes.get('deletions', 0)})"
+
+            with st.expander(title, expanded=commit_id in opened):
+                if commit_id not in documents:
+                    if st.button("Показать содержимое", key=f"open_{commit_id}"):
+                        opened.add(commit_id)
+                        st.rerun()
+                    continue
+
+                document = documents[commit_id]
+                if isinstance(document, Exception):
+                    st.error(f"Не удалось загрузить версию: {document}")
+                    opened.discard(commit_id)
+                    continue
 
-            with st.expander(f"Версия от {committed_at}"):
                 col1, col2 = st.columns([3, 1])
                 with col1:
-                    # Загружаем содержимое файла этой версии
-                    gist_version_url = f"{GITHUB_API}/gists/{gist_id}/{commit_id}"
-                    gist_version_resp = requests.get(gist_version_url, headers=github_headers())
-                    gist_version_resp.raise_for_status()
-                    files = gist_version_resp.json()["files"]
-                    content = files.get("center_data.json", {}).get("content", "")
+                    content = json.dumps(document, indent=4, ensure_ascii=False) if document is not None else ""
                     st.code("\n".join(content.split("\n")[:10]))
 
                 with col2:
-                    if st.button("Просмотреть", key=f"view_{i}"):
+                    if st.button("Просмотреть", key=f"view_{commit_id}"):
                         st.session_state.viewing_version = content
                         st.session_state.page = "view_version"
                         st.rerun()
 
-                    if st.button("Восстановить", key=f"restore_{i}"):
+                    if st.button("Восстановить", key=f"restore_{commit_id}"):
                         if st.session_state.role != 'admin':
                             st.warning("Только администратор может восстанавливать версии")
                         else:
                             confirm = st.checkbox(f"Подтвердите восстановление версии от {committed_at}")
                             if confirm:
-                                restored_data = json.loads(content)
-                                save_data(restored_data)
+                                save_data(document)
                                 st.success("Версия восстановлена! Обновите страницу.")
                                 time.sleep(2)
                                 st.rerun()
 
-        if len(commits) > 10:
-            st.write(f"Показано 10 из {len(commits)} версий")
-
     except Exception as e:
         st.error(f"Ошибка при загрузке истории: {str(e)}")
 
@@ -2639,12 +5433,13 @@ def show_data_archives_page():
     """Страница для управления архивными копиями данных через GitHub API"""
     st.header("📦 Архивы данных")
 
-    gist_api = "https://api.github.com/gists"
+    gist_api = "/gists"
 
     # Инициализация списка архивов
     if "_archives" not in st.session_state.data:
-        st.session_state.data["_archives"] = []
-        save_data(st.session_state.data)
+        with committing():
+            st.session_state.data["_archives"] = []
+            save_data(st.session_state.data)
 
     # Создание нового архива
     with st.expander("➕ Создать новый архив", expanded=False):
@@ -2664,7 +5459,7 @@ def show_data_archives_page():
                             "archive.json": {"content": archive_data}
                         }
                     }
-                    resp = requests.post(gist_api, headers=github_headers(), json=payload)
+                    resp = github_client().post(gist_api, json=payload)
                     resp.raise_for_status()
                     gist_info = resp.json()
 
@@ -2678,8 +5473,9 @@ def show_data_archives_page():
                         'filename': "archive.json"
                     }
 
-                    st.session_state.data["_archives"].append(new_archive)
-                    save_data(st.session_state.data)
+                    with committing():
+                        st.session_state.data["_archives"].append(new_archive)
+                        save_data(st.session_state.data)
 
                     st.success(f"Архив успешно создан! [Открыть]({gist_info['html_url']})")
                     st.rerun()
@@ -2712,8 +5508,8 @@ def show_data_archives_page():
                             st.warning("Только администратор может восстанавливать архивы")
                         else:
                             try:
-                                gist_url = f"{GITHUB_API}/gists/{archive.get('id')}"
-                                gist_resp = requests.get(gist_url, headers=github_headers())
+                                gist_url = f"/gists/{archive.get('id')}"
+                                gist_resp = github_client().get(gist_url)
                                 gist_resp.raise_for_status()
                                 files = gist_resp.json().get("files", {})
                                 content = next((f["content"] for f in files.values() if "content" in f), "")
@@ -2736,15 +5532,16 @@ def show_data_archives_page():
                             st.warning("Только администратор может удалять архивы")
                         else:
                             try:
-                                gist_url = f"{GITHUB_API}/gists/{archive.get('id')}"
-                                del_resp = requests.delete(gist_url, headers=github_headers())
+                                gist_url = f"/gists/{archive.get('id')}"
+                                del_resp = github_client().delete(gist_url)
                                 
                                 if del_resp.status_code == 204:
-                                    st.session_state.data["_archives"] = [
-                                        a for a in st.session_state.data["_archives"]
-                                        if a.get("id") != archive.get("id")
-                                    ]
-                                    save_data(st.session_state.data)
+                                    with committing():
+                                        st.session_state.data["_archives"] = [
+                                            a for a in st.session_state.data["_archives"]
+                                            if a.get("id") != archive.get("id")
+                                        ]
+                                        save_data(st.session_state.data)
                                     st.success("Архив удален!")
                                     st.rerun()
                                 else:
@@ -2767,17 +5564,14 @@ def show_version_view_page():
 def show_payments_report():
     st.header("📊 Отчет по оплатам")
     
-    if not st.session_state.data['payments']:
+    archive_months = archived_months('payments')
+    if not st.session_state.data['payments'] and not archive_months:
         st.info("Нет данных по оплатам.")
         return
     
-    # Создаем DataFrame с оплатами
-    df_payments = pd.DataFrame(st.session_state.data['payments'])
-    
-    # Преобразуем даты и добавляем имена учеников
-    df_payments['date'] = pd.to_datetime(df_payments['date'])
-    student_id_to_name = {s['id']: s['name'] for s in st.session_state.data['students']}
-    df_payments['student'] = df_payments['student_id'].map(student_id_to_name)
+    # DataFrame с оплатами, датами и именами учеников (кэшируется до изменения данных)
+    df_payments = get_payments_frame()
+    window_start = datetime.strptime(live_window_start() + '-01', '%Y-%m-%d').date()
     
     # Фильтры
     with st.expander("🔍 Фильтры", expanded=True):
@@ -2785,41 +5579,50 @@ def show_payments_report():
         with col1:
             start_date = st.date_input(
                 "Начальная дата", 
-                value=df_payments['date'].min().date(),
+                value=df_payments['date'].min().date() if not df_payments.empty else window_start,
                 key="payments_start_date"
             )
         with col2:
             end_date = st.date_input(
                 "Конечная дата", 
-                value=df_payments['date'].max().date(),
+                value=df_payments['date'].max().date() if not df_payments.empty else date.today(),
                 key="payments_end_date"
             )
+        if archive_months:
+            st.caption(f"Оплаты за {archive_months[0]} — {archive_months[-1]} хранятся в архиве и "
+                       f"загружаются, если начальная дата раньше {window_start.strftime('%d.%m.%Y')}")
+        
+        # Архивные месяцы из выбранного периода догружаются по запросу
+        period_months = [m for m in archive_months
+                         if start_date.strftime('%Y-%m') <= m <= end_date.strftime('%Y-%m')]
+        df_archived = get_archived_payments_frame(tuple(period_months)) if period_months else None
+        df_all = pd.concat([df_payments, df_archived]) if df_archived is not None else df_payments
         
         direction_filter = st.multiselect(
             "Фильтр по направлениям",
-            options=df_payments['direction'].unique(),
+            options=df_all['direction'].unique(),
             key="payments_direction_filter"
         )
         
         type_filter = st.multiselect(
             "Фильтр по типам оплат",
-            options=df_payments['type'].unique(),
+            options=df_all['type'].unique(),
             key="payments_type_filter"
         )
     
-    # Применяем фильтры
-    df_filtered = df_payments[
-        (df_payments['date'].dt.date >= start_date) & 
-        (df_payments['date'].dt.date <= end_date)
-    ]
+    def apply_filters(df):
+        df = df[(df['date'].dt.date >= start_date) & (df['date'].dt.date <= end_date)]
+        if direction_filter:
+            df = df[df['direction'].isin(direction_filter)]
+        if type_filter:
+            df = df[df['type'].isin(type_filter)]
+        return df
     
-    if direction_filter:
-        df_filtered = df_filtered[df_filtered['direction'].isin(direction_filter)]
-    
-    if type_filter:
-        df_filtered = df_filtered[df_filtered['type'].isin(type_filter)]
+    # Применяем фильтры
+    df_filtered = apply_filters(df_payments)
+    df_archived_filtered = apply_filters(df_archived) if df_archived is not None else df_payments.iloc[0:0]
     
-    if df_filtered.empty:
+    if df_filtered.empty and df_archived_filtered.empty:
         st.info("Нет данных по оплатам за выбранный период.")
         return
     
@@ -2870,26 +5673,22 @@ def show_payments_report():
     with col1:
         if st.button("💾 Сохранить изменения", key="save_payments_changes"):
             # Обновляем данные
-            for _, row in edited_df.iterrows():
-                if not row['Удалить']:
-                    payment_id = row['id']
-                    for payment in st.session_state.data['payments']:
-                        if payment['id'] == payment_id:
-                            payment['date'] = row['date'].strftime("%Y-%m-%d")
-                            payment['amount'] = float(row['amount'])
-                            payment['direction'] = row['direction']
-                            payment['type'] = row['type']
-                            payment['notes'] = row['notes']
-                            break
+            with committing():
+                store = get_data_store()
+                for _, row in edited_df.iterrows():
+                    if not row['Удалить']:
+                        store.update('payments', row['id'], {
+                            'date': row['date'].strftime("%Y-%m-%d"),
+                            'amount': float(row['amount']),
+                            'direction': row['direction'],
+                            'type': row['type'],
+                            'notes': row['notes']
+                        })
             
-            # Удаляем отмеченные платежи
-            payments_to_delete = edited_df[edited_df['Удалить']]['id'].tolist()
-            st.session_state.data['payments'] = [
-                p for p in st.session_state.data['payments']
-                if p['id'] not in payments_to_delete
-            ]
+                # Удаляем отмеченные платежи
+                store.delete('payments', edited_df[edited_df['Удалить']]['id'].tolist())
             
-            save_data(st.session_state.data)
+                save_data(st.session_state.data, sections=['payments'])
             st.success("Изменения сохранены!")
             st.rerun()
     
@@ -2901,8 +5700,24 @@ def show_payments_report():
             st.session_state.pop('payments_type_filter', None)
             st.rerun()
     
+    if not df_archived_filtered.empty:
+        st.subheader("Архивные оплаты")
+        st.caption("Закрытые месяцы доступны только для просмотра")
+        st.dataframe(
+            df_archived_filtered[['student', 'date', 'amount', 'direction', 'type', 'notes']],
+            use_container_width=True,
+            hide_index=True,
+            column_config={
+                "date": st.column_config.DateColumn("Дата", format="DD.MM.YYYY"),
+                "amount": st.column_config.NumberColumn("Сумма", format="%.2f ₽")
+            }
+        )
+    
+    # Статистика и экспорт — по рабочим и архивным оплатам вместе
+    df_report = pd.concat([df_archived_filtered, df_filtered.drop(columns=['Удалить'])])
+    
     with col3:
-        csv = df_filtered.drop(columns=['Удалить']).to_csv(index=False).encode('utf-8')
+        csv = df_report.to_csv(index=False).encode('utf-8')
         st.download_button(
             "📥 Экспорт в CSV",
             data=csv,
@@ -2934,8 +5749,7 @@ def show_payments_report():
             )
             
             if direction_transfer:
-                direction = next((d for d in st.session_state.data['directions'] 
-                                if d['name'] == direction_transfer), None)
+                direction = get_direction_by_name(direction_transfer)
                 
                 if direction:
                     monthly_cost = direction.get('cost', 0)
@@ -2985,14 +5799,14 @@ def show_payments_report():
                         st.warning("Для выбранного направления нет занятий в этом месяце!")
     # Статистика
     st.subheader("📈 Статистика")
-    total_payments = df_filtered['amount'].sum()
+    total_payments = df_report['amount'].sum()
     st.metric("Общая сумма оплат", f"{total_payments:.2f} ₽")
     
     tab1, tab2 = st.tabs(["По направлениям", "По типам оплат"])
     
     with tab1:
-        if not df_filtered.empty:
-            payments_by_direction = df_filtered.groupby('direction')['amount'].sum().reset_index()
+        if not df_report.empty:
+            payments_by_direction = df_report.groupby('direction')['amount'].sum().reset_index()
             st.bar_chart(payments_by_direction.set_index('direction'))
             
             with st.expander("Таблица данных"):
@@ -3010,8 +5824,8 @@ def show_payments_report():
                 )
     
     with tab2:
-        if not df_filtered.empty:
-            payments_by_type = df_filtered.groupby('type')['amount'].sum().reset_index()
+        if not df_report.empty:
+            payments_by_type = df_report.groupby('type')['amount'].sum().reset_index()
             st.bar_chart(payments_by_type.set_index('type'))
             
             with st.expander("Таблица данных"):
@@ -3033,10 +5847,8 @@ def show_materials_report():
     st.header("📊 Отчет по закупкам")
     
     if st.session_state.data['materials']:
-        df_materials = pd.DataFrame(st.session_state.data['materials'])
-        
-        # Convert date strings to datetime
-        df_materials['date'] = pd.to_datetime(df_materials['date'])
+        # Cached until the data changes
+        df_materials = get_materials_frame()
         
         # Date range filter
         col1, col2 = st.columns(2)
@@ -3080,12 +5892,68 @@ def show_materials_report():
     else:
         st.info("Нет данных по закупкам.")
 
+def show_week_search():
+    """Поиск вариантов занятий на неделю вперёд по возрасту, дням недели и времени"""
+    with st.form("week_search_form"):
+        col1, col2 = st.columns(2)
+        with col1:
+            child_age = st.number_input("Возраст ребенка", min_value=0, max_value=30, value=7, key="week_search_age")
+            gender = st.selectbox("Пол ребенка", ["Не важно", "Девочка", "Мальчик"], key="week_search_gender")
+            start_date = st.date_input("Начиная с", value=date.today(), key="week_search_start")
+        with col2:
+            weekdays = st.multiselect("Дни недели", WEEKDAYS, default=WEEKDAYS[:5], key="week_search_days")
+            time_from, time_to = st.select_slider(
+                "Время",
+                options=CALENDAR_SLOTS + ["20:00"],
+                value=("16:00", "20:00"),
+                key="week_search_time"
+            )
+            duration = st.selectbox("Продолжительность", [30, 45, 60], index=1,
+                                    format_func=lambda x: f"{x} мин", key="week_search_duration")
+        submitted = st.form_submit_button("🔍 Найти варианты")
+    
+    if not submitted:
+        return
+    
+    directions = suggest_directions(child_age, gender if gender != "Не важно" else None)
+    results = search_week_availability(
+        directions, start_date, set(weekdays),
+        time_to_minutes(time_from), time_to_minutes(time_to), duration
+    )
+    if not results:
+        st.info("Нет подходящих вариантов на выбранные дни и время.")
+        return
+    
+    st.success(f"Найдено {len(results)} направлений из {len(directions)} подходящих по возрасту")
+    st.dataframe(
+        pd.DataFrame([{
+            'Направление': r['direction']['name'],
+            'Дней': len(r['days']),
+            'Групп': r['groups'],
+            'Свободных слотов': r['slots'],
+            'Разовое занятие': r['direction'].get('trial_cost', '')
+        } for r in results]),
+        use_container_width=True,
+        hide_index=True
+    )
+    for result in results:
+        with st.expander(f"**{result['direction']['name']}** — {len(result['days'])} дн."):
+            for day in result['days']:
+                line = f"**{weekday_name(day['date'])}, {day['date'].strftime('%d.%m')}:** "
+                parts = [f"группа {l['start_time']}-{l['end_time']} ({l.get('teacher', '')})" for l in day['groups']]
+                if day['slots']:
+                    parts.append("свободно: " + ", ".join(day['slots']))
+                st.markdown(line + "; ".join(parts))
+
 def show_reception_helper():
     """Page for reception helper to suggest directions."""
     st.header("👋 Помощник ресепшена")
     
      # Создаем вкладки
-    tab1, tab2 = st.tabs(["Подбор направлений",  "Запись на разовые занятия"])
+    tab1, tab2, tab3 = st.tabs(["Подбор направлений",  "Запись на разовые занятия", "Поиск на неделю"])
+
+    with tab3:
+        show_week_search()
 
     with tab1:
         # Создаем словарь категорий направлений
@@ -3227,8 +6095,7 @@ def show_reception_helper():
                 )
                 
                 if direction_transfer:
-                    direction = next((d for d in st.session_state.data['directions'] 
-                                    if d['name'] == direction_transfer), None)
+                    direction = get_direction_by_name(direction_transfer)
                     
                     if direction:
                         monthly_cost = direction.get('cost', 0)
@@ -3310,8 +6177,6 @@ def show_reception_helper():
                                 'phone': parent_phone,
                                 'children_ids': []
                             }
-                            st.session_state.data['parents'].append(new_parent)
-                            
                             # Создаем нового ученика
                             new_student = {
                                 'id': str(uuid.uuid4()),
@@ -3322,9 +6187,11 @@ def show_reception_helper():
                                 'directions': [],
                                 'registration_date': str(date.today())
                             }
-                            st.session_state.data['students'].append(new_student)
+                            with committing():
+                                get_data_store().insert('parents', new_parent)
+                                get_data_store().insert('students', new_student)
+                                save_data(st.session_state.data, sections=['parents', 'students'])
                             selected_student_id = new_student['id']
-                            save_data(st.session_state.data)
                             st.success("Ученик добавлен!")
                             st.rerun()
         
@@ -3350,11 +6217,6 @@ def show_reception_helper():
                 key="single_lesson_date"
             )
             date_str = selected_date.strftime("%Y-%m-%d")
-            day_name = selected_date.strftime("%A")
-            russian_day = {
-                "Monday": "Понедельник", "Tuesday": "Вторник", "Wednesday": "Среда",
-                "Thursday": "Четверг", "Friday": "Пятница", "Saturday": "Суббота", "Sunday": "Воскресенье"
-            }.get(day_name, day_name)
         
         # 4. Поиск преподавателей и классов
         with st.expander("👩‍🏫 Преподаватели и классы", expanded=True):
@@ -3380,80 +6242,60 @@ def show_reception_helper():
             )
             selected_teacher = next((t for t in teachers_for_direction if t['id'] == selected_teacher_id), None)
             
-            # Поиск подходящего класса
+            # Классы, привязанные к направлению; если привязки нет — класс по умолчанию
             classrooms = st.session_state.data.get('classrooms', [])
-            suitable_classroom = None
-            
-            # Проверяем привязку направления к классу
-            for room in classrooms:
-                if selected_direction in room.get('directions', []):
-                    suitable_classroom = room
-                    break
-            
-            # Если направление не привязано, ищем класс по умолчанию
-            if not suitable_classroom:
-                suitable_classroom = next(
-                    (r for r in classrooms if r.get('name') == 'Малый класс'),
-                    None
-                )
+            direction_rooms = (
+                [r for r in classrooms if selected_direction in r.get('directions', [])]
+                or [r for r in classrooms if r.get('name') == 'Малый класс']
+            )
             
-            if not suitable_classroom:
+            if not direction_rooms:
                 st.error("Не удалось определить подходящий класс")
                 return
             
-            st.info(f"**Выбранный класс:** {suitable_classroom.get('name', 'Неизвестно')}")
+            if len(direction_rooms) > 1:
+                room_options = {r['id']: r.get('name', 'Неизвестно') for r in direction_rooms}
+                selected_room_id = st.selectbox(
+                    "Класс*",
+                    options=list(room_options.keys()),
+                    format_func=lambda x: room_options[x],
+                    key="single_lesson_classroom"
+                )
+                suitable_classroom = next(r for r in direction_rooms if r['id'] == selected_room_id)
+            else:
+                suitable_classroom = direction_rooms[0]
+                st.info(f"**Выбранный класс:** {suitable_classroom.get('name', 'Неизвестно')}")
         
         with st.expander("🕒 Выбор времени", expanded=True):
-            # Получаем все занятия на выбранную дату
-            regular_lessons = [
-                l for l in st.session_state.data['schedule']
-                if l['day'] == russian_day
-            ]
-            single_lessons = [
-                l for l in st.session_state.data.get('single_lessons', [])
-                if l['date'] == date_str
-            ]
-            all_lessons = regular_lessons + single_lessons
+            # Занятия и поминутные маски занятости на выбранную дату из календаря недели
+            calendar_day = get_day_calendar(date_str)
+            time_slots = CALENDAR_SLOTS
             
-            # Временные слоты с шагом 15 минут
-            time_slots = [f"{h:02d}:{m:02d}" for h in range(9, 20) for m in [0, 15, 30, 45]]
+            duration = st.selectbox(
+                "Продолжительность*",
+                options=["30 мин", "45 мин", "60 мин"],
+                index=1
+            )
+            duration_mins = int(duration.split()[0])
             
-            # Создаем DataFrame для отображения занятости
-            schedule_df = pd.DataFrame(index=time_slots)
-            schedule_df['Преподаватель'] = "✅ Свободно"
-            schedule_df['Класс'] = "✅ Свободно"
+            # Подписи занятости: слот занят, если его начальная минута попадает в занятие
+            columns = {'Преподаватель': ["✅ Свободно"] * len(time_slots),
+                       'Класс': ["✅ Свободно"] * len(time_slots)}
+            for lesson in calendar_day.lessons:
+                mask = minute_mask(time_to_minutes(lesson['start_time']), time_to_minutes(lesson['end_time']))
+                label = f"❌ {lesson['start_time']}-{lesson['end_time']} ({lesson['direction']})"
+                for column, busy in (('Преподаватель', lesson.get('teacher_id') == selected_teacher_id),
+                                     ('Класс', lesson.get('classroom') == suitable_classroom['id'])):
+                    if busy:
+                        for i in range(len(time_slots)):
+                            if mask >> (i * CALENDAR_SLOT_MINUTES) & 1:
+                                columns[column][i] = label
+            schedule_df = pd.DataFrame(columns, index=time_slots)
             
-            # Заполняем занятость преподавателя (исправленная версия)
-            for lesson in all_lessons:
-                if lesson.get('teacher') == selected_teacher['name']:
-                    lesson_start = datetime.strptime(lesson['start_time'], "%H:%M")
-                    lesson_end = datetime.strptime(lesson['end_time'], "%H:%M")
-
-                    for slot in time_slots:
-                        slot_time = datetime.strptime(slot, "%H:%M")
-                        
-                        # Проверяем, если начало 15-минутного слота попадает в интервал занятия
-                        if lesson_start <= slot_time < lesson_end:
-                            schedule_df.at[slot, 'Преподаватель'] = f"❌ {lesson['start_time']}-{lesson['end_time']} ({lesson['direction']})"
-            # Заполняем занятость класса (исправленная версия)
-            for lesson in all_lessons:
-                if lesson.get('classroom') == suitable_classroom['id']:
-                    lesson_start = datetime.strptime(lesson['start_time'], "%H:%M")
-                    lesson_end = datetime.strptime(lesson['end_time'], "%H:%M")
-                    
-                    for slot in time_slots:
-                        slot_time = datetime.strptime(slot, "%H:%M")
-                        slot_end = slot_time + timedelta(minutes=45)
-                        
-                        if lesson_start <= slot_time < lesson_end:
-                            schedule_df.at[slot, 'Класс'] = f"❌ {lesson['start_time']}-{lesson['end_time']} ({lesson['direction']})"
-            
-            # Определяем свободные слоты
-            available_slots = [
-                slot for slot in time_slots
-                if "✅ Свободно" in schedule_df.at[slot, 'Преподаватель'] and 
-                "✅ Свободно" in schedule_df.at[slot, 'Класс']
-            ]
+            # Свободные слоты: преподаватель и класс свободны всю продолжительность занятия
+            available_slots = calendar_day.free_starts(
+                duration_mins, [selected_teacher_id], [suitable_classroom['id']]
+            )
             
             # Отображаем таблицу занятости с подсветкой
             def color_availability(val):
@@ -3471,30 +6313,43 @@ def show_reception_helper():
             )
             
             if not available_slots:
+                # Тот же движок отвечает, когда свободен хоть кто-то из преподавателей направления
+                # и хоть один класс направления — подсказка для выбора другого преподавателя или класса
+                alternative_slots = calendar_day.any_free_starts(
+                    duration_mins,
+                    [t['id'] for t in teachers_for_direction],
+                    [r['id'] for r in direction_rooms]
+                )
                 st.error("Нет свободных временных окон на выбранную дату")
+                if alternative_slots:
+                    st.info("Свободно у других преподавателей или в других классах: " +
+                            ", ".join(alternative_slots))
                 return
             
-            # Выбор времени с указанием продолжительности
-            col1, col2 = st.columns(2)
-            with col1:
-                selected_time = st.selectbox(
-                    "Выберите время начала*",
-                    options=available_slots,
-                    key="single_lesson_time"
-                )
-            with col2:
-                duration = st.selectbox(
-                    "Продолжительность*",
-                    options=["30 мин", "45 мин", "60 мин"],
-                    index=1
-                )
+            selected_time = st.selectbox(
+                "Выберите время начала*",
+                options=available_slots,
+                key="single_lesson_time"
+            )
             
             # Рассчитываем время окончания
             start_dt = datetime.strptime(selected_time, "%H:%M")
-            duration_mins = int(duration.split()[0])
             end_time = (start_dt + timedelta(minutes=duration_mins)).strftime("%H:%M")
             
             st.success(f"Выбрано время: {selected_time}-{end_time} ({duration})")
+            
+            # Кто ещё свободен в это окно — для замены преподавателя или класса
+            free_teachers, free_rooms = calendar_day.free_resources(
+                time_to_minutes(selected_time), duration_mins,
+                [t['id'] for t in teachers_for_direction if t['id'] != selected_teacher_id],
+                [r['id'] for r in direction_rooms if r['id'] != suitable_classroom['id']]
+            )
+            if free_teachers or free_rooms:
+                room_names = {r['id']: r.get('name', '') for r in direction_rooms}
+                st.caption(
+                    "Также свободны в это время: " +
+                    ", ".join([teacher_options[t] for t in free_teachers] + [room_names[r] for r in free_rooms])
+                )
         
         # 6. Дополнительная информация
         with st.expander("📝 Дополнительно", expanded=False):
@@ -3511,7 +6366,7 @@ def show_reception_helper():
                 'teacher_id': selected_teacher_id,
                 'date': date_str,
                 'start_time': selected_time,
-                'end_time': (datetime.strptime(selected_time, "%H:%M") + timedelta(minutes=45)).strftime("%H:%M"),
+                'end_time': end_time,
                 'classroom': suitable_classroom['id'],
                 'classroom_name': suitable_classroom.get('name', ''),
                 'notes': notes,
@@ -3519,29 +6374,23 @@ def show_reception_helper():
                 'created_by': st.session_state.username
             }
             
-            # Добавляем в список разовых занятий
-            st.session_state.data.setdefault('single_lessons', []).append(new_lesson)
-            
-            # Добавляем направление ученику (если еще нет)
-            student = next((s for s in st.session_state.data['students'] if s['id'] == selected_student_id), None)
-            if student and selected_direction not in student.get('directions', []):
-                student['directions'].append(selected_direction)
-            
-            save_data(st.session_state.data)
-            
-            # Создаем запись о посещении
-            if date_str not in st.session_state.data['attendance']:
-                st.session_state.data['attendance'][date_str] = {}
-            
-            st.session_state.data['attendance'][date_str][new_lesson['id']] = {
-                selected_student_id: {
-                    'present': False,
-                    'paid': False,
-                    'note': notes
-                }
-            }
-            
-            save_data(st.session_state.data)
+            with committing():
+                store = get_data_store()
+                # Добавляем в список разовых занятий
+                store.insert('single_lessons', new_lesson)
+                
+                # Добавляем направление ученику (если еще нет)
+                student = store.get('students', selected_student_id)
+                if student and selected_direction not in student.get('directions', []):
+                    store.update('students', selected_student_id, {
+                        'directions': student.get('directions', []) + [selected_direction]
+                    })
+                
+                # Создаем запись о посещении
+                store.set_attendance(date_str, new_lesson['id'], selected_student_id,
+                                     {'present': False, 'paid': False, 'note': notes})
+                
+                save_data(st.session_state.data, sections=sorted(store.touched))
             st.success("Разовое занятие успешно записано!")
             st.rerun()
 # --- Main App Title and Navigation ---
@@ -3563,7 +6412,6 @@ else:
     st.sidebar.title("🧭 Навигация")
     
     def _navigate_to(page_name):
-        st.cache_data.clear() 
         st.session_state.page = page_name
         st.rerun()
 
@@ -3607,6 +6455,7 @@ else:
         st.sidebar.button("📊 Отчет по оплатам", on_click=lambda: _navigate_to('payments_report'))
     st.sidebar.markdown("---")
     st.sidebar.text(f"👤 {st.session_state.username} ({st.session_state.role})")
+    show_sync_status()
     st.sidebar.button("🚪 Выйти", on_click=logout)
     
     # Clear data confirmation (admin only)
@@ -3703,8 +6552,8 @@ else:
                                     }
                                 ]
                 }
+                # save_data делает очищенный документ общим для всех сессий
                 save_data(initial_data)
-                st.session_state.data = load_data()
                 st.success("Все данные очищены!")
                 st.session_state.show_clear_confirm = False
                 st.rerun()
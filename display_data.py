@@ -14,136 +14,144 @@ def time_to_minutes(t):
 def minutes_to_time(m):
     return f"{m // 60:02d}:{m % 60:02d}"
 
-def is_time_overlap(slot_start, slot_end, lesson_start, lesson_end):
-    return not (slot_end <= lesson_start or slot_start >= lesson_end)
-
-def get_busy_times_for_teachers(data, day):
-    teacher_busy = defaultdict(list)
-    for lesson in data['schedule']:
-        if lesson['day'] == day:
-            start = time_to_minutes(lesson['start_time'])
-            end = time_to_minutes(lesson['end_time'])
-            teacher_busy[lesson['teacher']].append((start, end))
-    return teacher_busy
-
-def get_busy_times_for_classrooms(data, day):
-    classroom_busy = defaultdict(list)
-    for lesson in data['schedule']:
-        if lesson['day'] == day:
-            start = time_to_minutes(lesson['start_time'])
-            end = time_to_minutes(lesson['end_time'])
-            # Находим какие классы подходят для этого направления
-            for classroom in data['classrooms']:
-                if lesson['direction'] in classroom['directions']:
-                    classroom_busy[classroom['name']].append((start, end))
-    return classroom_busy
-
-def find_available_slots(data, direction_name, day, min_duration=60):
-    direction = next((d for d in data['directions'] if d['name'] == direction_name), None)
-    if not direction:
-        return []
-    
-    teachers = [t['name'] for t in data['teachers'] if direction_name in t['directions']]
-    classrooms = [c['name'] for c in data['classrooms'] if direction_name in c['directions']]
-    
-    if not teachers or not classrooms:
-        return []
-    
-    day_schedule = [lesson for lesson in data['schedule'] if lesson['day'] == day]
-    day_schedule.sort(key=lambda x: time_to_minutes(x['start_time']))
-    
-    teacher_busy = get_busy_times_for_teachers(data, day)
-    classroom_busy = get_busy_times_for_classrooms(data, day)
-    
-    work_start = 9 * 60
-    work_end = 20 * 60
-    available_slots = []
-    prev_end = work_start
-    
-    for lesson in day_schedule:
-        lesson_start = time_to_minutes(lesson['start_time'])
-        lesson_end = time_to_minutes(lesson['end_time'])
-        
-        if lesson_start > prev_end:
-            duration = lesson_start - prev_end
-            if duration >= min_duration:
-                slot = {
-                    'start': prev_end,
-                    'end': lesson_start,
-                    'duration': duration,
-                    'day': day,
-                    'direction': direction_name,
-                    'available_teachers': [],
-                    'available_classrooms': []
-                }
-                
-                # Проверяем доступность преподавателей
-                for teacher in teachers:
-                    teacher_available = True
-                    for busy_start, busy_end in teacher_busy.get(teacher, []):
-                        if is_time_overlap(prev_end, lesson_start, busy_start, busy_end):
-                            teacher_available = False
-                            break
-                    if teacher_available:
-                        slot['available_teachers'].append(teacher)
-                
-                # Проверяем доступность классов
-                for classroom in classrooms:
-                    classroom_available = True
-                    for busy_start, busy_end in classroom_busy.get(classroom, []):
-                        if is_time_overlap(prev_end, lesson_start, busy_start, busy_end):
-                            classroom_available = False
-                            break
-                    if classroom_available:
-                        slot['available_classrooms'].append(classroom)
-                
-                if slot['available_teachers'] and slot['available_classrooms']:
-                    available_slots.append(slot)
-        
-        prev_end = max(prev_end, lesson_end)
-    
-    if work_end > prev_end:
-        duration = work_end - prev_end
-        if duration >= min_duration:
-            slot = {
-                'start': prev_end,
-                'end': work_end,
-                'duration': duration,
-                'day': day,
-                'direction': direction_name,
-                'available_teachers': [],
-                'available_classrooms': []
-            }
-            
+WORK_START = 9 * 60
+WORK_END = 20 * 60
+WEEK_DAYS = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота"]
+
+def merge_intervals(intervals):
+    """Сортирует интервалы и склеивает пересекающиеся и смежные"""
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [(start, end) for start, end in merged]
+
+def free_intervals(busy, work_start=WORK_START, work_end=WORK_END):
+    """Дополнение склеенных занятых интервалов до рабочего дня"""
+    free = []
+    cursor = work_start
+    for start, end in busy:
+        if start > cursor:
+            free.append((cursor, min(start, work_end)))
+        cursor = max(cursor, end)
+        if cursor >= work_end:
+            break
+    if cursor < work_end:
+        free.append((cursor, work_end))
+    return [(start, end) for start, end in free if end > start]
+
+def intersect_intervals(first, second):
+    """Пересечение двух отсортированных списков непересекающихся интервалов (два указателя)"""
+    result = []
+    i = j = 0
+    while i < len(first) and j < len(second):
+        start = max(first[i][0], second[j][0])
+        end = min(first[i][1], second[j][1])
+        if start < end:
+            result.append((start, end))
+        if first[i][1] < second[j][1]:
+            i += 1
+        else:
+            j += 1
+    return result
+
+class AvailabilityIndex:
+    """
+    Свободные окна преподавателей и классов, построенные один раз для набора данных.
+    Для каждого дня хранится отсортированный склеенный список занятых интервалов каждого
+    преподавателя и класса и его дополнение до рабочего дня; запросы сводятся к
+    пересечению отсортированных списков без повторного обхода расписания.
+    """
+
+    def __init__(self, data, work_start=WORK_START, work_end=WORK_END):
+        self.data = data
+        self.work_start = work_start
+        self.work_end = work_end
+        teacher_busy = defaultdict(lambda: defaultdict(list))
+        classroom_busy = defaultdict(lambda: defaultdict(list))
+        classrooms_by_direction = defaultdict(list)
+        for classroom in data.get('classrooms', []):
+            for direction in classroom.get('directions', []):
+                classrooms_by_direction[direction].append(classroom['name'])
+
+        for lesson in data.get('schedule', []):
+            interval = (time_to_minutes(lesson['start_time']), time_to_minutes(lesson['end_time']))
+            teacher_busy[lesson['day']][lesson['teacher']].append(interval)
+            # Занятие занимает все классы, подходящие для его направления
+            for classroom in classrooms_by_direction.get(lesson['direction'], []):
+                classroom_busy[lesson['day']][classroom].append(interval)
+
+        self.busy = {
+            'teacher': {day: {name: merge_intervals(i) for name, i in by_name.items()}
+                        for day, by_name in teacher_busy.items()},
+            'classroom': {day: {name: merge_intervals(i) for name, i in by_name.items()}
+                          for day, by_name in classroom_busy.items()},
+        }
+        self._free = {}
+
+    def free(self, kind, name, day):
+        """Свободные интервалы ресурса ('teacher' или 'classroom') в день day"""
+        key = (kind, name, day)
+        if key not in self._free:
+            busy = self.busy[kind].get(day, {}).get(name, [])
+            self._free[key] = free_intervals(busy, self.work_start, self.work_end)
+        return self._free[key]
+
+    def resource_gaps(self, kind, name, day, min_duration=0):
+        """Окна ресурса не короче min_duration минут"""
+        return [(start, end) for start, end in self.free(kind, name, day) if end - start >= min_duration]
+
+    def find_windows(self, direction_name, min_duration=60, days=WEEK_DAYS):
+        """
+        Окна не короче min_duration для направления по всем дням за один проход: для каждой
+        пары преподаватель-класс пересекаются их свободные интервалы, одинаковые окна
+        объединяются со списками доступных преподавателей и классов.
+        """
+        if not any(d['name'] == direction_name for d in self.data.get('directions', [])):
+            return []
+        teachers = [t['name'] for t in self.data.get('teachers', []) if direction_name in t.get('directions', [])]
+        classrooms = [c['name'] for c in self.data.get('classrooms', []) if direction_name in c.get('directions', [])]
+        if not teachers or not classrooms:
+            return []
+
+        slots = []
+        for day in days:
+            windows = {}
             for teacher in teachers:
-                teacher_available = True
-                for busy_start, busy_end in teacher_busy.get(teacher, []):
-                    if is_time_overlap(prev_end, work_end, busy_start, busy_end):
-                        teacher_available = False
-                        break
-                if teacher_available:
-                    slot['available_teachers'].append(teacher)
-            
-            for classroom in classrooms:
-                classroom_available = True
-                for busy_start, busy_end in classroom_busy.get(classroom, []):
-                    if is_time_overlap(prev_end, work_end, busy_start, busy_end):
-                        classroom_available = False
-                        break
-                if classroom_available:
-                    slot['available_classrooms'].append(classroom)
-            
-            if slot['available_teachers'] and slot['available_classrooms']:
-                available_slots.append(slot)
-    
-    return available_slots
+                teacher_free = self.free('teacher', teacher, day)
+                for classroom in classrooms:
+                    for start, end in intersect_intervals(teacher_free, self.free('classroom', classroom, day)):
+                        if end - start < min_duration:
+                            continue
+                        slot = windows.setdefault((start, end), {
+                            'start': start,
+                            'end': end,
+                            'duration': end - start,
+                            'day': day,
+                            'direction': direction_name,
+                            'available_teachers': [],
+                            'available_classrooms': []
+                        })
+                        if teacher not in slot['available_teachers']:
+                            slot['available_teachers'].append(teacher)
+                        if classroom not in slot['available_classrooms']:
+                            slot['available_classrooms'].append(classroom)
+            slots.extend(windows[key] for key in sorted(windows))
+        return slots
+
+def find_available_slots(data, direction_name, day, min_duration=60, index=None):
+    """Свободные окна направления в один день; index позволяет переиспользовать построенный AvailabilityIndex"""
+    index = index or AvailabilityIndex(data)
+    return index.find_windows(direction_name, min_duration, days=[day])
 
 def print_all_slots(slots):
     if not slots:
         print("Нет свободных окон в расписании.")
         return
     
-    days_order = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота"]
+    days_order = WEEK_DAYS
     slots_by_day = defaultdict(list)
     
     for slot in slots:
@@ -179,12 +187,7 @@ def main():
     
     min_duration = int(input("Минимальная продолжительность занятия (мин): ") or 45)
     
-    all_slots = []
-    days = ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота"]
-    
-    for day in days:
-        slots = find_available_slots(data, selected_direction, day, min_duration)
-        all_slots.extend(slots)
+    all_slots = AvailabilityIndex(data).find_windows(selected_direction, min_duration)
     
     print(f"\nВсе свободные окна для '{selected_direction}':")
     print_all_slots(all_slots)
@@ -0,0 +1,10 @@
+import pytest
+import streamlit as st
+
+
+@pytest.fixture(autouse=True)
+def clear_streamlit_caches():
+    # Общий документ живёт в st.cache_resource процесса: каждый тест начинает со своего center_data.json
+    st.cache_resource.clear()
+    st.cache_data.clear()
+    yield
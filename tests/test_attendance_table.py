@@ -0,0 +1,38 @@
+import json
+from pathlib import Path
+
+from streamlit.testing.v1 import AppTest
+
+APP = Path(__file__).resolve().parent.parent / 'app.py'
+
+TABLE_SNIPPET = '''
+nested = {'2025-01-01': {'l1': {'s1': {'present': True, 'paid': False, 'note': '', 'marked_by': 't1'},
+                                's2': {'present': False, 'paid': True, 'note': 'Абонемент'}}}}
+table = AttendanceTable.from_nested(nested)
+round_trip = table.to_nested()
+table.remove('2025-01-01', 'l1', 's2')
+table.append('2025-01-01', 'l1', 's2', {'present': True, 'paid': True, 'note': ''})
+for i in range(1200):
+    table.append('2025-01-01', 'l1', 's1', {'present': bool(i % 2), 'paid': False, 'note': '', 'marked_by': 't2'})
+st.session_state['_out'] = (nested, round_trip, table.for_lesson('l1'), len(table.dates), len(table.extras))
+'''
+
+
+def test_table_round_trip_and_rescans(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'center_data.json').write_text(json.dumps({}), encoding='utf-8')
+    (tmp_path / 'app.py').write_text(APP.read_text(encoding='utf-8') + TABLE_SNIPPET, encoding='utf-8')
+    at = AppTest.from_file(str(tmp_path / 'app.py'), default_timeout=60)
+    at.secrets['GITHUB_TOKEN'] = ''
+    at.secrets['GIST_ID'] = ''
+    at.secrets['users'] = {}
+    at.run()
+    assert not at.exception
+    nested, round_trip, lesson_marks, rows, extras = at.session_state['_out']
+    # Дополнительные поля отметки переживают импорт и экспорт
+    assert round_trip == nested
+    # Повторная отметка после удаления не дублирует запись, сжатие сохраняет поля
+    assert sorted((m['student_id'], m['present']) for m in lesson_marks) == [('s1', True), ('s2', True)]
+    assert next(m for m in lesson_marks if m['student_id'] == 's1')['marked_by'] == 't2'
+    # Устаревшие строки сжаты; поля сверх колонок хранятся только у строк, где они есть
+    assert rows < 1000 and extras == rows - 1
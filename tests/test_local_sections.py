@@ -0,0 +1,41 @@
+import json
+from pathlib import Path
+
+from streamlit.testing.v1 import AppTest
+
+APP = Path(__file__).resolve().parent.parent / 'app.py'
+
+# Первое сохранение раскладывает документ по файлам разделов, следующее переписывает только изменённый
+SAVE_SNIPPET = '''
+data = st.session_state.data
+save_data(data)
+before = {name: os.stat(os.path.join(DATA_SECTIONS_FOLDER, name)).st_mtime_ns
+          for name in os.listdir(DATA_SECTIONS_FOLDER)}
+time.sleep(0.05)
+with committing():
+    data['news'].insert(0, {'id': 'n1', 'text': 'Новость', 'date': '2025-01-01'})
+    save_data(data, sections=['news'])
+after = {name: os.stat(os.path.join(DATA_SECTIONS_FOLDER, name)).st_mtime_ns
+         for name in os.listdir(DATA_SECTIONS_FOLDER)}
+st.session_state['_out'] = (sorted(name for name in after if after[name] != before.get(name)),
+                            load_local_sections(), data)
+'''
+
+
+def test_save_rewrites_only_changed_sections(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    data = {'students': [{'id': 's1', 'name': 'Ученик', 'directions': []}], 'news': []}
+    (tmp_path / 'center_data.json').write_text(json.dumps(data, ensure_ascii=False), encoding='utf-8')
+    (tmp_path / 'app.py').write_text(APP.read_text(encoding='utf-8') + SAVE_SNIPPET, encoding='utf-8')
+    at = AppTest.from_file(str(tmp_path / 'app.py'), default_timeout=60)
+    at.secrets['GITHUB_TOKEN'] = ''
+    at.secrets['GIST_ID'] = ''
+    at.secrets['users'] = {}
+    at.run()
+    assert not at.exception
+    rewritten, local, document = at.session_state['_out']
+    assert rewritten == ['center_data__news.json']
+    assert local['news'][0]['id'] == 'n1'
+    assert local['students'] == document['students']
+    # Единый файл больше не переписывается
+    assert json.loads((tmp_path / 'center_data.json').read_text(encoding='utf-8')) == data
@@ -0,0 +1,47 @@
+import json
+from pathlib import Path
+
+from streamlit.testing.v1 import AppTest
+
+APP = Path(__file__).resolve().parent.parent / 'app.py'
+
+# Обычное сохранение помечает учеников и преподавателей устаревшими, затем направление переименовывается
+RENAME_SNIPPET = '''
+store = get_data_store()
+save_data(st.session_state.data)
+old_names = dict(store.reference_names('directions'))
+store.update('directions', 'd1', {'name': 'Английский язык (взрослые)'})
+store.rename_references('directions', old_names)
+data = st.session_state.data
+st.session_state['_records'] = (data['students'][0], data['teachers'][0], data['schedule'][0])
+'''
+
+
+def run_rename(tmp_path, monkeypatch, data):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'center_data.json').write_text(json.dumps(data, ensure_ascii=False), encoding='utf-8')
+    (tmp_path / 'app.py').write_text(APP.read_text(encoding='utf-8') + RENAME_SNIPPET, encoding='utf-8')
+    at = AppTest.from_file(str(tmp_path / 'app.py'), default_timeout=60)
+    at.secrets['GITHUB_TOKEN'] = ''
+    at.secrets['GIST_ID'] = ''
+    at.secrets['users'] = {}
+    at.run()
+    assert not at.exception
+    return at.session_state['_records']
+
+
+def test_rename_direction_after_save(tmp_path, monkeypatch):
+    data = {
+        'directions': [{'id': 'd1', 'name': 'Английский язык'}, {'id': 'd2', 'name': 'Шахматы'}],
+        'students': [{'id': 's1', 'name': 'Ученик', 'directions': ['Шахматы', 'Английский язык']}],
+        'teachers': [{'id': 't1', 'name': 'Преподаватель', 'directions': ['Английский язык']}],
+        'schedule': [{'id': 'l1', 'direction': 'Английский язык', 'teacher': 'Преподаватель',
+                      'start_time': '10:00', 'end_time': '10:45', 'day': 'Понедельник'}],
+    }
+    student, teacher, lesson = run_rename(tmp_path, monkeypatch, data)
+    assert student['directions'] == ['Шахматы', 'Английский язык (взрослые)']
+    assert student['direction_ids'] == ['d2', 'd1']
+    assert teacher['directions'] == ['Английский язык (взрослые)']
+    assert teacher['direction_ids'] == ['d1']
+    assert lesson['direction'] == 'Английский язык (взрослые)'
+    assert lesson['direction_id'] == 'd1'
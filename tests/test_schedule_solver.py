@@ -0,0 +1,41 @@
+import json
+from pathlib import Path
+
+from streamlit.testing.v1 import AppTest
+
+APP = Path(__file__).resolve().parent.parent / 'app.py'
+
+# Сценарий запускается внутри приложения: решатель строится по данным общего документа
+SOLVE_SNIPPET = '''
+solver = ScheduleSolver(st.session_state.data, seed=0)
+st.session_state['_rows'] = solver.solve(time_budget=2)
+'''
+
+
+def run_solver(tmp_path, monkeypatch, data):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'center_data.json').write_text(json.dumps(data, ensure_ascii=False), encoding='utf-8')
+    (tmp_path / 'app.py').write_text(APP.read_text(encoding='utf-8') + SOLVE_SNIPPET, encoding='utf-8')
+    at = AppTest.from_file(str(tmp_path / 'app.py'), default_timeout=60)
+    at.secrets['GITHUB_TOKEN'] = ''
+    at.secrets['GIST_ID'] = ''
+    at.secrets['users'] = {}
+    at.run()
+    assert not at.exception
+    return at.session_state['_rows']
+
+
+def test_lesson_outside_availability_is_moved(tmp_path, monkeypatch):
+    # Преподаватель работает только во вторник, занятие стоит в понедельник
+    data = {
+        'directions': [{'id': 'd1', 'name': 'Английский язык'}],
+        'teachers': [{'id': 't1', 'name': 'Преподаватель', 'directions': ['Английский язык'],
+                      'availability': {'Вторник': '10:00-20:00'}}],
+        'classrooms': [{'id': 'c1', 'name': 'Малый класс', 'capacity': 6, 'directions': ['Английский язык']}],
+        'schedule': [{'id': 'l1', 'direction': 'Английский язык', 'teacher': 'Преподаватель',
+                      'start_time': '10:00', 'end_time': '10:45', 'day': 'Понедельник', 'classroom': 'c1'}],
+    }
+    [row] = run_solver(tmp_path, monkeypatch, data)
+    assert row['day'] == 'Вторник'
+    assert row['status'] == 'moved'
+    assert not row['conflict']